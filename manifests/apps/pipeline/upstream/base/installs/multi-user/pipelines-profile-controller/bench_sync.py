@@ -0,0 +1,568 @@
+# Copyright 2020-2021 The Kubeflow Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the pipelines-profile-controller sync webhook
+
+load:   serves sync.py on a free local port and replays one sync call per profile
+        namespace from several concurrent clients, the way metacontroller does on
+        every resync. Prints requests/sec and latency percentiles for each server
+        mode and namespace count.
+render: times building the sync response from the precompiled child templates
+        against rebuilding and re-encoding the children on every call.
+keepalive: replays the syncs of N namespaces over one kept-alive HTTP/1.1
+        connection against one new connection per sync.
+metrics: times the metric updates made for one sync request against the cost of
+        serving that sync, to check the instrumentation stays negligible.
+replay: generates synthetic metacontroller traffic (namespace counts, label mixes,
+        observed children sizes, with and without a default pipeline root), replays it
+        for several resync rounds and writes throughput, latency percentiles and peak
+        RSS to a JSON report. Given the report of a baseline commit, it fails when a
+        scenario regressed by more than the allowed fraction.
+prefork: runs sync.py with 1, 2, 4 and 8 pre-forked worker processes and loads each
+        from client processes, to show how throughput scales with the pod's cores.
+
+Example:
+    python bench_sync.py load --namespaces 10 100 1000 --clients 8 --modes single threaded
+    python bench_sync.py render --iterations 2000
+    python bench_sync.py keepalive --namespaces 1000
+    python bench_sync.py metrics --iterations 20000
+    python bench_sync.py replay --namespaces 100 1000 --output after.json --baseline before.json
+    python bench_sync.py prefork --processes 1 2 4 8 --namespaces 2000 --clients 16
+"""
+
+import argparse
+import contextlib
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import sync
+from sync import (DEFAULT_CONTROLLER_VARIANT, SERVER_MODE_THREADED, SERVER_MODES, desired_children,
+                  server_factory, variant_child_resources)
+
+SETTINGS = {
+    "visualization_server_image": "gcr.io/ml-pipeline/visualization-server",
+    "visualization_server_tag": "x.y.z",
+    "frontend_image": "gcr.io/ml-pipeline/frontend",
+    "frontend_tag": "x.y.z",
+    "disable_istio_sidecar": False,
+    "minio_access_key": "YWJjZGVm",
+    "minio_secret_key": "dXZ3eHl6",
+    "controller_port": 0,
+}
+
+
+def make_observation(namespace, ready=True):
+    """
+    Returns the body metacontroller posts for one profile namespace
+    """
+    count = 1 if ready else 0
+    return {
+        "parent": {
+            "metadata": {
+                "labels": {
+                    "pipelines.kubeflow.org/enabled": "true"
+                },
+                "name": namespace
+            }
+        },
+        "children": {
+            "Secret.v1": [{}] * count,
+            "ConfigMap.v1": [{}] * count,
+            "Deployment.apps/v1": [{}] * 2 * count,
+            "Service.v1": [{}] * 2 * count,
+            "DestinationRule.networking.istio.io/v1alpha3": [{}] * count,
+            "AuthorizationPolicy.security.istio.io/v1beta1": [{}] * count,
+        }
+    }
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def post_sync(address, body, connection=None):
+    """
+    Posts one sync call and returns its latency in seconds
+
+    The call goes over the given connection, or over a fresh one when none is given.
+    """
+    start = time.perf_counter()
+    reused = connection is not None
+    if not reused:
+        connection = http.client.HTTPConnection(*address)
+    try:
+        connection.request("POST", "/sync", body=body,
+                           headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"sync returned HTTP {response.status}")
+    finally:
+        if not reused:
+            connection.close()
+    return time.perf_counter() - start
+
+
+def run_load(server_mode, namespaces, clients, workers):
+    """
+    Replays one sync per namespace against a fresh server and returns the measurements
+    """
+    server = server_factory(server_mode=server_mode, server_workers=workers, url="127.0.0.1", **SETTINGS)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    address = server.server_address[:2]
+    bodies = [json.dumps(make_observation(f"profile-{i}", ready=i % 2 == 0)).encode("utf-8")
+              for i in range(namespaces)]
+
+    # Keep the controller's per-request output from drowning the report
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            latencies = sorted(pool.map(lambda body: post_sync(address, body), bodies))
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        server.server_close()
+
+    return {
+        "server_mode": server_mode,
+        "namespaces": namespaces,
+        "requests_per_sec": namespaces / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def run_keepalive(namespaces):
+    """
+    Replays one sync per namespace sequentially, once over a single kept-alive
+    connection and once with a new connection per sync
+    """
+    server = server_factory(server_mode=SERVER_MODE_THREADED, url="127.0.0.1",
+                            max_requests_per_connection=namespaces + 1, **SETTINGS)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    address = server.server_address[:2]
+    bodies = [json.dumps(make_observation(f"profile-{i}")).encode("utf-8") for i in range(namespaces)]
+
+    results = []
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        for name, keep_alive in (("one-connection", True), ("per-request", False)):
+            connection = http.client.HTTPConnection(*address) if keep_alive else None
+            start = time.perf_counter()
+            latencies = sorted(post_sync(address, body, connection) for body in bodies)
+            elapsed = time.perf_counter() - start
+            if connection is not None:
+                connection.close()
+            results.append({
+                "connections": name,
+                "requests_per_sec": namespaces / elapsed,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+            })
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def rebuilt_sync_json(parent, children):
+    """
+    Builds the sync response the way the controller did before child templates were
+    precompiled: fresh child dicts and a full json.dumps on every call
+    """
+    namespace = parent["metadata"]["name"]
+    settings = {k: v for k, v in SETTINGS.items() if k != "controller_port"}
+    desired_resources = desired_children(namespace, **settings)
+    print(json.dumps(parent, indent=2, sort_keys=True))
+    print(json.dumps(desired_resources[:-1], indent=2, sort_keys=True))
+    desired_status = {"kubeflow-pipelines-ready": "True"}
+    return json.dumps({"status": desired_status, "children": desired_resources})
+
+
+def run_render(iterations):
+    """
+    Times one sync response per iteration with and without the precompiled templates
+    """
+    server = server_factory(url="127.0.0.1", **SETTINGS)
+    server.server_close()
+    # The handler is never attached to a connection, only its sync_json is timed
+    controller = object.__new__(server.RequestHandlerClass)
+    observation = make_observation("profile-0")
+
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, sync_json in (("rebuilt", rebuilt_sync_json), ("templates", controller.sync_json)):
+            elapsed = timeit.timeit(lambda: sync_json(observation["parent"], observation["children"]),
+                                    number=iterations)
+            results[name] = elapsed / iterations * 1e6
+    return results
+
+
+def generate_traffic(namespaces, enabled_fraction, ready_fraction, child_size, kfp_default_pipeline_root,
+                     seed):
+    """
+    Returns the encoded sync requests metacontroller sends for one resync of the cluster
+
+    Namespaces get the pipelines label with enabled_fraction probability, the others
+    either no label or a "false" one. Enabled namespaces have all their desired children
+    observed with ready_fraction probability, a random subset otherwise. Observed children
+    are padded to about child_size bytes to stand in for the full objects metacontroller
+    sends. The same arguments always generate the same traffic.
+    """
+    rng = random.Random(seed)
+    settings = dict(SETTINGS, kfp_default_pipeline_root=kfp_default_pipeline_root)
+    desired_counts = Counter(child.observed_key for child in variant_child_resources(DEFAULT_CONTROLLER_VARIANT)
+                             if child.enabled(settings))
+    padding = "x" * child_size
+
+    bodies = []
+    for i in range(namespaces):
+        namespace = f"profile-{i}"
+        labels = {}
+        if rng.random() < enabled_fraction:
+            labels["pipelines.kubeflow.org/enabled"] = "true"
+        elif rng.random() < 0.5:
+            labels["pipelines.kubeflow.org/enabled"] = "false"
+
+        ready = rng.random() < ready_fraction
+        children = {}
+        for observed_key, count in desired_counts.items():
+            observed = count if ready else rng.randint(0, count)
+            children[observed_key] = [
+                {"metadata": {"name": f"child-{n}", "namespace": namespace}, "padding": padding}
+                for n in range(observed)
+            ]
+
+        observation = {"parent": {"metadata": {"name": namespace, "labels": labels}}, "children": children}
+        bodies.append(json.dumps(observation).encode("utf-8"))
+    return bodies
+
+
+def run_replay(bodies, rounds, clients, kfp_default_pipeline_root):
+    """
+    Replays the traffic of rounds resyncs from clients kept-alive connections
+    """
+    server = server_factory(server_mode=SERVER_MODE_THREADED, server_workers=clients, url="127.0.0.1",
+                            kfp_default_pipeline_root=kfp_default_pipeline_root, **SETTINGS)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    address = server.server_address[:2]
+
+    def replay_client(client_bodies):
+        connection = http.client.HTTPConnection(*address)
+        try:
+            return [post_sync(address, body, connection) for body in client_bodies]
+        finally:
+            connection.close()
+
+    latencies = []
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            for _ in range(rounds):
+                for client_latencies in pool.map(replay_client, [bodies[i::clients] for i in range(clients)]):
+                    latencies += client_latencies
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        server.server_close()
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "request_bytes": sum(len(body) for body in bodies) * rounds,
+        "requests_per_sec": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        # Peak of the whole benchmark process so far, in KiB on Linux
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Replay parameters that only select scenarios, which are matched by name
+SCENARIO_PARAMS = ("namespaces", "pipeline_root")
+
+
+def compare_reports(baseline, report, max_regression):
+    """
+    Returns the regressions of report against baseline as (scenario, metric, before, after)
+
+    Throughput may not drop, and the p99 latency may not grow, by more than max_regression.
+    Raises ValueError if the reports were generated with different traffic parameters, as
+    their scenarios would then share names without replaying the same traffic.
+    """
+    mismatched = sorted(key for key in set(baseline["params"]) | set(report["params"])
+                        if key not in SCENARIO_PARAMS
+                        and baseline["params"].get(key) != report["params"].get(key))
+    if mismatched:
+        raise ValueError("the baseline was generated with different parameters: " + ", ".join(
+            f"{key}={baseline['params'].get(key)!r} (now {report['params'].get(key)!r})"
+            for key in mismatched))
+    baseline_scenarios = {scenario["name"]: scenario for scenario in baseline["scenarios"]}
+    regressions = []
+    for scenario in report["scenarios"]:
+        before = baseline_scenarios.get(scenario["name"])
+        if before is None:
+            continue
+        if scenario["requests_per_sec"] < before["requests_per_sec"] * (1 - max_regression):
+            regressions.append((scenario["name"], "requests_per_sec",
+                                before["requests_per_sec"], scenario["requests_per_sec"]))
+        if scenario["p99_ms"] > before["p99_ms"] * (1 + max_regression):
+            regressions.append((scenario["name"], "p99_ms", before["p99_ms"], scenario["p99_ms"]))
+    return regressions
+
+
+def post_syncs(address, bodies):
+    return [post_sync(address, body) for body in bodies]
+
+
+def run_prefork(processes, bodies, clients):
+    """
+    Loads sync.py served by processes pre-forked workers from clients client processes
+
+    The controller runs as its own process, as in the pod, and the clients are processes
+    too so that the load generator is not held back by its own GIL. Every sync uses a
+    new connection, letting the kernel spread them over the workers.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    environ = dict(os.environ, KFP_VERSION=SETTINGS["frontend_tag"], MINIO_ACCESS_KEY="abcdef",
+                   MINIO_SECRET_KEY="uvwxyz", CONTROLLER_PORT=str(port), SERVER_MODE=SERVER_MODE_THREADED,
+                   SERVER_PROCESSES=str(processes), LOG_LEVEL="WARNING")
+    controller = subprocess.Popen([sys.executable, sync.__file__], env=environ,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    address = ("127.0.0.1", port)
+    try:
+        for _ in range(100):
+            try:
+                connection = http.client.HTTPConnection(*address)
+                connection.request("GET", "/healthz")
+                connection.getresponse().read()
+                connection.close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        with multiprocessing.Pool(clients) as pool:
+            start = time.perf_counter()
+            latencies = []
+            for client_latencies in pool.starmap(post_syncs, [(address, bodies[i::clients])
+                                                               for i in range(clients)]):
+                latencies += client_latencies
+            elapsed = time.perf_counter() - start
+    finally:
+        controller.send_signal(signal.SIGTERM)
+        controller.wait()
+
+    latencies.sort()
+    return {
+        "processes": processes,
+        "requests_per_sec": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def run_metrics(iterations):
+    """
+    Times the metric updates done for one sync request and one cached sync_response call
+    """
+    server = server_factory(url="127.0.0.1", **SETTINGS)
+    server.server_close()
+    controller = object.__new__(server.RequestHandlerClass)
+    metrics = server.metrics
+    observation = make_observation("profile-0")
+
+    def instrumentation():
+        # Mirrors the updates do_POST and sync_response make for a cached sync
+        metrics.in_flight.inc()
+        metrics.decode_duration.observe(0.0001)
+        metrics.request_size.observe(512)
+        metrics.syncs.inc("True")
+        metrics.sync_duration.observe(0.0001)
+        metrics.response_size.observe(8192)
+        metrics.in_flight.dec()
+
+    results = {
+        "instrumentation": timeit.timeit(instrumentation, number=iterations) / iterations * 1e6,
+        "sync_response": timeit.timeit(
+            lambda: controller.sync_response(observation["parent"], observation["children"]),
+            number=iterations) / iterations * 1e6,
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipelines-profile-controller sync webhook")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    load = subparsers.add_parser("load", help="load test the webhook over HTTP")
+    load.add_argument("--namespaces", type=int, nargs="+", default=[10, 100, 1000],
+                      help="number of profile namespaces to sync per run")
+    load.add_argument("--clients", type=int, default=8,
+                      help="number of concurrent clients")
+    load.add_argument("--workers", type=int, default=16,
+                      help="size of the server worker pool in threaded mode")
+    load.add_argument("--modes", nargs="+", choices=SERVER_MODES, default=list(SERVER_MODES),
+                      help="server modes to compare")
+
+    render = subparsers.add_parser("render", help="time building a single sync response")
+    render.add_argument("--iterations", type=int, default=2000,
+                        help="number of sync responses to build per implementation")
+
+    keepalive = subparsers.add_parser("keepalive", help="compare one kept-alive connection with one per sync")
+    keepalive.add_argument("--namespaces", type=int, default=1000,
+                           help="number of profile namespaces to sync")
+
+    metrics = subparsers.add_parser("metrics", help="time the metric updates of a sync request")
+    metrics.add_argument("--iterations", type=int, default=20000,
+                         help="number of requests to instrument")
+
+    replay = subparsers.add_parser("replay", help="replay synthetic traffic and write a comparable report")
+    replay.add_argument("--namespaces", type=int, nargs="+", default=[100, 1000],
+                        help="number of namespaces in the cluster, one scenario each")
+    replay.add_argument("--enabled-fraction", type=float, default=0.8,
+                        help="fraction of namespaces with pipelines enabled")
+    replay.add_argument("--ready-fraction", type=float, default=0.9,
+                        help="fraction of enabled namespaces with all children observed")
+    replay.add_argument("--child-size", type=int, default=2048,
+                        help="approximate size in bytes of each observed child")
+    replay.add_argument("--pipeline-root", choices=["off", "on", "both"], default="both",
+                        help="run the scenarios without and/or with a default pipeline root")
+    replay.add_argument("--rounds", type=int, default=3,
+                        help="number of resyncs of every namespace")
+    replay.add_argument("--clients", type=int, default=8,
+                        help="number of concurrent kept-alive connections")
+    replay.add_argument("--seed", type=int, default=0,
+                        help="seed of the traffic generator")
+    replay.add_argument("--output", help="file to write the JSON report to, stdout by default")
+    replay.add_argument("--baseline", help="JSON report of a previous run to compare with")
+    replay.add_argument("--max-regression", type=float, default=0.2,
+                        help="allowed relative drop in throughput or growth in p99 latency")
+
+    prefork = subparsers.add_parser("prefork", help="measure throughput across pre-forked worker counts")
+    prefork.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8],
+                         help="numbers of worker processes to run the controller with")
+    prefork.add_argument("--namespaces", type=int, default=2000,
+                         help="number of sync calls per run, one per namespace")
+    prefork.add_argument("--child-size", type=int, default=8192,
+                         help="approximate size in bytes of each observed child")
+    prefork.add_argument("--clients", type=int, default=16,
+                         help="number of client processes")
+    args = parser.parse_args()
+
+    if args.benchmark == "load":
+        print(f"{'mode':<10} {'namespaces':>10} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+        for server_mode in args.modes:
+            for namespaces in args.namespaces:
+                result = run_load(server_mode, namespaces, args.clients, args.workers)
+                print(f"{result['server_mode']:<10} {result['namespaces']:>10} "
+                      f"{result['requests_per_sec']:>10.1f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}")
+    elif args.benchmark == "render":
+        results = run_render(args.iterations)
+        for name, usec in results.items():
+            print(f"{name:<10} {usec:>10.1f} us/sync")
+        print(f"speedup    {results['rebuilt'] / results['templates']:>10.1f}x")
+    elif args.benchmark == "keepalive":
+        print(f"{'connections':<16} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+        for result in run_keepalive(args.namespaces):
+            print(f"{result['connections']:<16} {result['requests_per_sec']:>10.1f} "
+                  f"{result['p50_ms']:>8.3f} {result['p99_ms']:>8.3f}")
+    elif args.benchmark == "replay":
+        pipeline_roots = {"off": [None], "on": ["minio://mlpipeline"],
+                          "both": [None, "minio://mlpipeline"]}[args.pipeline_root]
+        params = {k: v for k, v in vars(args).items()
+                  if k not in ("benchmark", "output", "baseline", "max_regression")}
+        report = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": params,
+            "scenarios": [],
+        }
+        for namespaces in args.namespaces:
+            for pipeline_root in pipeline_roots:
+                bodies = generate_traffic(namespaces, args.enabled_fraction, args.ready_fraction,
+                                          args.child_size, pipeline_root, args.seed)
+                result = run_replay(bodies, args.rounds, args.clients, pipeline_root)
+                name = f"namespaces={namespaces},pipeline_root={'on' if pipeline_root else 'off'}"
+                report["scenarios"].append(dict(name=name, **result))
+                print(f"{name:<40} {result['requests_per_sec']:>10.1f} req/s "
+                      f"p99 {result['p99_ms']:>8.3f} ms", file=sys.stderr)
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            try:
+                regressions = compare_reports(baseline, report, args.max_regression)
+            except ValueError as e:
+                print(f"Not comparing with {args.baseline}: {e}", file=sys.stderr)
+                sys.exit(2)
+            for name, metric, before, after in regressions:
+                print(f"REGRESSION {name} {metric}: {before:.3f} -> {after:.3f}", file=sys.stderr)
+            if regressions:
+                sys.exit(1)
+    elif args.benchmark == "prefork":
+        print(f"{os.cpu_count()} cores")
+        bodies = generate_traffic(args.namespaces, 1.0, 1.0, args.child_size, None, seed=0)
+        print(f"{'processes':>10} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+        for processes in args.processes:
+            result = run_prefork(processes, bodies, args.clients)
+            print(f"{result['processes']:>10} {result['requests_per_sec']:>10.1f} "
+                  f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}")
+    elif args.benchmark == "metrics":
+        results = run_metrics(args.iterations)
+        for name, usec in results.items():
+            print(f"{name:<16} {usec:>8.2f} us/request")
+
+
+if __name__ == "__main__":
+    main()
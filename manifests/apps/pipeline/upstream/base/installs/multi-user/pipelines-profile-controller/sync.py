@@ -12,26 +12,82 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing.sharedctypes import RawArray
 import json
+import logging
 import os
 import base64
+import random
+import signal
+import threading
+import time
+from types import MappingProxyType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SERVER_MODE_SINGLE = "single"
+SERVER_MODE_THREADED = "threaded"
+SERVER_MODES = (SERVER_MODE_SINGLE, SERVER_MODE_THREADED)
+
+# Seconds a pre-forked worker may go without a heartbeat before it is killed and replaced
+WORKER_HEARTBEAT_TIMEOUT = 30
+# Seconds a stopping worker gets to finish its in-flight requests
+WORKER_GRACEFUL_TIMEOUT = 30
+WORKER_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+
+# Stand-in namespace the child templates are built with, replaced on every sync
+NAMESPACE_PLACEHOLDER = "$(namespace)"
+EMPTY_SYNC_RESPONSE_BYTES = b'{"status": {}, "children": []}'
+
+BATCH_PATH = "/batch"
+# Observations handed to a batch worker at a time
+BATCH_CHUNK_SIZE = 64
+
+# Codecs decoding the observed state, orjson is used when it is installed
+JSON_CODEC_AUTO = "auto"
+JSON_DECODERS = {"json": json.loads}
+if orjson is not None:
+    JSON_DECODERS["orjson"] = orjson.loads
+
+METRICS_PREFIX = "pipelines_profile_controller"
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+log = logging.getLogger("pipelines-profile-controller")
 
 
 def main():
+    logging.basicConfig(format=LOG_FORMAT)
     settings = get_settings_from_env()
     server = server_factory(**settings)
-    server.serve_forever()
+    if server.server_processes > 1:
+        PreforkSupervisor(server, server.server_processes).serve_forever()
+    else:
+        server.serve_forever()
 
 
 def get_settings_from_env(controller_port=None,
                           visualization_server_image=None, frontend_image=None,
                           visualization_server_tag=None, frontend_tag=None, disable_istio_sidecar=None,
-                          minio_access_key=None, minio_secret_key=None, kfp_default_pipeline_root=None):
+                          minio_access_key=None, minio_secret_key=None, kfp_default_pipeline_root=None,
+                          server_mode=None, server_workers=None, log_level=None,
+                          log_payload_sample_rate=None, response_cache_size=None, json_codec=None,
+                          max_request_bytes=None, keep_alive_timeout=None, max_requests_per_connection=None,
+                          controller_variant=None, server_processes=None, minio_credentials_dir=None,
+                          credentials_reload_interval=None, convergence_check=None):
     """
-    Returns a dict of settings from environment variables relevant to the controller
+    Returns a read-only snapshot of the settings from environment variables relevant to the controller
 
-    Environment settings can be overridden by passing them here as arguments.
+    Environment settings can be overridden by passing them here as arguments. The
+    settings are validated here, and main() builds the snapshot once at startup.
 
     Settings are pulled from the all-caps version of the setting name.  The
     following defaults are used if those environment variables are not set
@@ -41,8 +97,23 @@ def get_settings_from_env(controller_port=None,
         frontend_image: gcr.io/ml-pipeline/frontend
         frontend_tag: value of KFP_VERSION environment variable
         disable_istio_sidecar: Required (no default)
-        minio_access_key: Required (no default)
-        minio_secret_key: Required (no default)
+        minio_access_key: Required unless mounted in minio_credentials_dir (no default)
+        minio_secret_key: Required unless mounted in minio_credentials_dir (no default)
+        minio_credentials_dir: None (directory the mlpipeline-minio-artifact Secret is mounted in, watched
+            for rotated credentials)
+        credentials_reload_interval: 10 (seconds between checks of minio_credentials_dir)
+        convergence_check: false (compare observed children with the desired ones and report drift in metrics)
+        server_mode: single (one request at a time) or threaded (worker pool)
+        server_workers: 16 (size of the worker pool in threaded mode)
+        log_level: INFO (one summary line per sync, full payloads are logged at DEBUG)
+        log_payload_sample_rate: 0 (fraction of syncs whose full payloads are also logged at INFO)
+        response_cache_size: 1024 (number of encoded sync responses kept, 0 disables the cache)
+        json_codec: auto (orjson when installed, json otherwise)
+        max_request_bytes: 67108864 (larger sync requests are rejected with 413)
+        keep_alive_timeout: 5 (seconds an idle HTTP/1.1 connection is kept open in threaded mode, 0 disables)
+        max_requests_per_connection: 1000 (requests served before a kept-alive connection is closed)
+        controller_variant: argo (pipelines backend whose children are reconciled, argo or tekton)
+        server_processes: 1 (worker processes sharing the listening socket, more than 1 pre-forks them)
     """
     settings = dict()
     settings["controller_port"] = \
@@ -74,12 +145,27 @@ def get_settings_from_env(controller_port=None,
         disable_istio_sidecar if disable_istio_sidecar is not None \
             else os.environ.get("DISABLE_ISTIO_SIDECAR") == "true"
 
+    # MINIO_CREDENTIALS_DIR is optional, credentials mounted there take precedence
+    # over the environment as they are the ones kept up to date
+    settings["minio_credentials_dir"] = \
+        minio_credentials_dir or \
+        os.environ.get("MINIO_CREDENTIALS_DIR")
+    mounted_access_key, mounted_secret_key = \
+        read_minio_credentials(settings["minio_credentials_dir"]) if settings["minio_credentials_dir"] \
+        else (None, None)
+
+    settings["credentials_reload_interval"] = \
+        credentials_reload_interval or \
+        os.environ.get("CREDENTIALS_RELOAD_INTERVAL", "10")
+
     settings["minio_access_key"] = \
         minio_access_key or \
+        mounted_access_key or \
         base64.b64encode(bytes(os.environ.get("MINIO_ACCESS_KEY"), 'utf-8')).decode('utf-8')
 
     settings["minio_secret_key"] = \
         minio_secret_key or \
+        mounted_secret_key or \
         base64.b64encode(bytes(os.environ.get("MINIO_SECRET_KEY"), 'utf-8')).decode('utf-8')
 
     # KFP_DEFAULT_PIPELINE_ROOT is optional
@@ -87,289 +173,1307 @@ def get_settings_from_env(controller_port=None,
         kfp_default_pipeline_root or \
         os.environ.get("KFP_DEFAULT_PIPELINE_ROOT")
 
-    return settings
+    settings["server_mode"] = \
+        server_mode or \
+        os.environ.get("SERVER_MODE", SERVER_MODE_SINGLE)
+    if settings["server_mode"] not in SERVER_MODES:
+        raise ValueError(f"SERVER_MODE must be one of {SERVER_MODES}, got {settings['server_mode']!r}")
 
+    settings["server_workers"] = \
+        server_workers or \
+        os.environ.get("SERVER_WORKERS", "16")
 
-def server_factory(visualization_server_image,
-                   visualization_server_tag, frontend_image, frontend_tag,
-                   disable_istio_sidecar, minio_access_key,
-                   minio_secret_key, kfp_default_pipeline_root=None, 
-                   url="", controller_port=8080):
+    settings["log_level"] = \
+        (log_level or os.environ.get("LOG_LEVEL", "INFO")).upper()
+    if not isinstance(logging.getLevelName(settings["log_level"]), int):
+        raise ValueError(f"LOG_LEVEL must be a logging level name, got {settings['log_level']!r}")
+
+    settings["log_payload_sample_rate"] = float(
+        log_payload_sample_rate if log_payload_sample_rate is not None
+        else os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0"))
+    if not 0 <= settings["log_payload_sample_rate"] <= 1:
+        raise ValueError(
+            f"LOG_PAYLOAD_SAMPLE_RATE must be between 0 and 1, got {settings['log_payload_sample_rate']}")
+
+    settings["response_cache_size"] = \
+        response_cache_size if response_cache_size is not None \
+            else os.environ.get("RESPONSE_CACHE_SIZE", "1024")
+
+    settings["json_codec"] = \
+        json_codec or \
+        os.environ.get("JSON_CODEC", JSON_CODEC_AUTO)
+    if settings["json_codec"] == JSON_CODEC_AUTO:
+        settings["json_codec"] = "orjson" if "orjson" in JSON_DECODERS else "json"
+    if settings["json_codec"] not in JSON_DECODERS:
+        raise ValueError(f"JSON_CODEC must be one of {tuple(JSON_DECODERS)} or {JSON_CODEC_AUTO}, "
+                         f"got {settings['json_codec']!r}")
+
+    settings["max_request_bytes"] = \
+        max_request_bytes or \
+        os.environ.get("MAX_REQUEST_BYTES", str(64 * 1024 * 1024))
+
+    settings["keep_alive_timeout"] = \
+        keep_alive_timeout if keep_alive_timeout is not None \
+            else os.environ.get("KEEP_ALIVE_TIMEOUT", "5")
+
+    settings["max_requests_per_connection"] = \
+        max_requests_per_connection or \
+        os.environ.get("MAX_REQUESTS_PER_CONNECTION", "1000")
+
+    settings["controller_variant"] = \
+        controller_variant or \
+        os.environ.get("CONTROLLER_VARIANT", DEFAULT_CONTROLLER_VARIANT)
+    if settings["controller_variant"] not in CONTROLLER_VARIANTS:
+        raise ValueError(f"CONTROLLER_VARIANT must be one of {tuple(CONTROLLER_VARIANTS)}, "
+                         f"got {settings['controller_variant']!r}")
+
+    settings["server_processes"] = \
+        server_processes or \
+        os.environ.get("SERVER_PROCESSES", "1")
+    if int(settings["server_processes"]) < 1:
+        raise ValueError(f"SERVER_PROCESSES must be at least 1, got {settings['server_processes']!r}")
+
+    settings["convergence_check"] = \
+        convergence_check if convergence_check is not None \
+            else os.environ.get("CONVERGENCE_CHECK") == "true"
+
+    return MappingProxyType(settings)
+
+
+def is_observation(observed):
     """
-    Returns an HTTPServer populated with Handler with customized settings
+    Returns whether a decoded request body is a metacontroller sync observation
     """
-    class Controller(BaseHTTPRequestHandler):
-        def sync(self, parent, children):
-            # parent is a namespace
-            namespace = parent.get("metadata", {}).get("name")
+    return isinstance(observed, dict) and "parent" in observed and "children" in observed
 
-            pipeline_enabled = parent.get("metadata", {}).get(
-                "labels", {}).get("pipelines.kubeflow.org/enabled")
 
-            if pipeline_enabled != "true":
-                return {"status": {}, "children": []}
-
-            desired_configmap_count = 1
-            desired_resources = []
-            if kfp_default_pipeline_root:
-                desired_configmap_count = 2
-                desired_resources += [{
-                    "apiVersion": "v1",
-                    "kind": "ConfigMap",
-                    "metadata": {
-                        "name": "kfp-launcher",
-                        "namespace": namespace,
-                    },
-                    "data": {
-                        "defaultPipelineRoot": kfp_default_pipeline_root,
-                    },
-                }]
+def find_observed_child(observed, name):
+    """
+    Returns the observed child named name, or None when it is not observed
 
+    metacontroller maps the names of the observed children of a kind to their objects,
+    but lists of objects are accepted too.
+    """
+    if isinstance(observed, dict):
+        return observed.get(name)
+    for child in observed or ():
+        if child.get("metadata", {}).get("name") == name:
+            return child
+    return None
 
-            # Compute status based on observed state.
-            desired_status = {
-                "kubeflow-pipelines-ready":
-                    len(children["Secret.v1"]) == 1 and
-                    len(children["ConfigMap.v1"]) == desired_configmap_count and
-                    len(children["Deployment.apps/v1"]) == 2 and
-                    len(children["Service.v1"]) == 2 and
-                    len(children["DestinationRule.networking.istio.io/v1alpha3"]) == 1 and
-                    len(children["AuthorizationPolicy.security.istio.io/v1beta1"]) == 1 and
-                    "True" or "False"
+
+def project(observed, desired):
+    """
+    Returns the parts of observed found at the paths desired sets
+
+    Fields the API server adds to the children, such as their status or defaulted spec
+    fields, are left out so the projection of an up-to-date child encodes like the desired one.
+    The API server drops empty maps and lists, so a desired empty one missing from observed
+    is projected as empty.
+    """
+    if isinstance(desired, dict) and isinstance(observed, dict):
+        return {key: project(observed[key], value) if key in observed else value
+                for key, value in desired.items()
+                if key in observed or (isinstance(value, (dict, list)) and not value)}
+    if isinstance(desired, list) and isinstance(observed, list) and len(desired) == len(observed):
+        return [project(observed_item, desired_item) for observed_item, desired_item in zip(observed, desired)]
+    return observed
+
+
+def read_minio_credentials(directory):
+    """
+    Returns the base64-encoded access and secret keys of a mounted mlpipeline-minio-artifact Secret
+    """
+    credentials = []
+    for key in ("accesskey", "secretkey"):
+        with open(os.path.join(directory, key), "rb") as f:
+            credentials.append(base64.b64encode(f.read()).decode("utf-8"))
+    return tuple(credentials)
+
+
+class CredentialsWatcher:
+    """
+    Watches the MinIO credentials mounted in directory and hands rotated ones to on_change
+
+    Kubernetes updates mounted Secrets in place, so rotating the credentials does not
+    need a pod restart. poll() is meant to run from the server loop between requests,
+    and only stats the mounted files every interval seconds.
+    """
+
+    def __init__(self, directory, interval, on_change):
+        self.directory = directory
+        self.interval = interval
+        self.on_change = on_change
+        self.signature = self.stat()
+        self.next_check = time.monotonic() + interval
+
+    def stat(self):
+        signature = []
+        for key in ("accesskey", "secretkey"):
+            try:
+                stat = os.stat(os.path.join(self.directory, key))
+            except OSError:
+                signature.append(None)
+            else:
+                signature.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def poll(self):
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        self.next_check = now + self.interval
+
+        signature = self.stat()
+        if signature == self.signature:
+            return
+        try:
+            credentials = read_minio_credentials(self.directory)
+        except OSError as e:
+            # Mid-update or removed, the current credentials are kept until the files are readable
+            log.warning("could not read the MinIO credentials in %s: %s", self.directory, e)
+            return
+        self.signature = signature
+        self.on_change(*credentials)
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+    HTTPServer that hands every accepted connection to a bounded pool of worker threads
+
+    A slow client then only occupies one worker instead of stalling every other
+    metacontroller sync call queued behind it.
+    """
+
+    def __init__(self, server_address, handler_class, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sync-worker")
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+class PreforkSupervisor:
+    """
+    Serves a bound server from processes worker processes forked from this one
+
+    JSON work holds the GIL, so a single process can not use more than one core. The
+    workers share the listening socket and the kernel spreads accepted connections
+    between them. Each worker keeps its own response cache and metrics, so /metrics
+    reports the worker that answered the scrape.
+
+    A worker that exits, or stops heartbeating for WORKER_HEARTBEAT_TIMEOUT seconds, is
+    replaced. SIGHUP replaces the workers one at a time, each old worker finishing its
+    in-flight requests first, and SIGTERM or SIGINT stop them all the same way.
+    """
+
+    def __init__(self, server, processes):
+        self.server = server
+        self.processes = processes
+        # Last heartbeat of the worker in each slot, on the monotonic clock shared by all processes
+        self.heartbeats = RawArray("d", processes)
+        self.workers = {}
+        # Pids of stopping workers and the time after which they are killed
+        self.retiring = {}
+        self.stopping = False
+        self.restart_requested = False
+
+    def serve_forever(self, poll_interval=0.5):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_restart)
+        for slot in range(self.processes):
+            self.spawn(slot)
+        log.info("serving on %s:%d with %d worker processes", *self.server.server_address[:2], self.processes)
+
+        while not self.stopping:
+            time.sleep(poll_interval)
+            self.reap()
+            if self.restart_requested:
+                self.restart_requested = False
+                self.restart()
+            self.check_workers()
+
+        for pid in self.workers.values():
+            self.retire(pid)
+        self.workers = {}
+        while self.retiring:
+            time.sleep(poll_interval)
+            self.reap()
+            self.check_workers()
+        self.server.server_close()
+
+    def request_stop(self, signum, frame):
+        self.stopping = True
+
+    def request_restart(self, signum, frame):
+        self.restart_requested = True
+
+    def spawn(self, slot):
+        self.heartbeats[slot] = time.monotonic()
+        # Signals are held until the worker has replaced the supervisor's handlers
+        signal.pthread_sigmask(signal.SIG_BLOCK, WORKER_SIGNALS)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                self.serve_worker(slot)
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, WORKER_SIGNALS)
+        self.workers[slot] = pid
+        log.debug("started worker %d in slot %d", pid, slot)
+
+    def serve_worker(self, slot):
+        """
+        Runs the server in a forked worker until it is told to stop, never returns
+        """
+        exit_code = 0
+        try:
+            stopping = threading.Event()
+
+            # shutdown() waits for serve_forever() to return, so it can not be called from the handler
+            def stop(signum, frame):
+                stopping.set()
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+            service_actions = self.server.service_actions
+
+            # A restarted slot already belongs to the replacement, whose heartbeats must not be masked
+            def heartbeat():
+                if not stopping.is_set():
+                    self.heartbeats[slot] = time.monotonic()
+                service_actions()
+
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, WORKER_SIGNALS)
+            # Called by serve_forever() between requests and at every poll interval
+            self.server.service_actions = heartbeat
+            self.server.serve_forever()
+            self.server.server_close()
+        except BaseException:
+            log.exception("worker %d failed", os.getpid())
+            exit_code = 1
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)
+
+    def retire(self, pid):
+        os.kill(pid, signal.SIGTERM)
+        self.retiring[pid] = time.monotonic() + WORKER_GRACEFUL_TIMEOUT
+
+    def restart(self):
+        log.info("restarting %d worker processes", self.processes)
+        for slot, pid in list(self.workers.items()):
+            self.spawn(slot)
+            self.retire(pid)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if self.retiring.pop(pid, None) is not None:
+                continue
+            for slot, worker_pid in list(self.workers.items()):
+                if worker_pid == pid:
+                    log.warning("worker %d exited with status %d, replacing it", pid, status)
+                    self.spawn(slot)
+
+    def check_workers(self):
+        now = time.monotonic()
+        for slot, pid in self.workers.items():
+            if now - self.heartbeats[slot] > WORKER_HEARTBEAT_TIMEOUT:
+                log.error("worker %d missed its heartbeat for %.0f seconds, killing it",
+                          pid, now - self.heartbeats[slot])
+                # Reaped and replaced on the next poll
+                self.heartbeats[slot] = now
+                os.kill(pid, signal.SIGKILL)
+        for pid, deadline in self.retiring.items():
+            if now > deadline:
+                log.error("worker %d did not stop in %d seconds, killing it", pid, WORKER_GRACEFUL_TIMEOUT)
+                os.kill(pid, signal.SIGKILL)
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of encoded sync responses
+
+    Counts hits, misses and evictions so the size can be tuned to the number of
+    profile namespaces in the cluster. A max_size of 0 disables caching.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Bumped by clear() so responses computed before it are not cached after it
+        self.generation = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, generation=None):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
             }
 
-            # Generate the desired child object(s).
-            desired_resources += [
-                {
-                    "apiVersion": "v1",
-                    "kind": "ConfigMap",
-                    "metadata": {
-                        "name": "metadata-grpc-configmap",
-                        "namespace": namespace,
-                    },
-                    "data": {
-                        "METADATA_GRPC_SERVICE_HOST":
-                            "metadata-grpc-service.kubeflow",
-                        "METADATA_GRPC_SERVICE_PORT": "8080",
-                    },
-                },
-                # Visualization server related manifests below
-                {
-                    "apiVersion": "apps/v1",
-                    "kind": "Deployment",
-                    "metadata": {
-                        "labels": {
-                            "app": "ml-pipeline-visualizationserver"
-                        },
-                        "name": "ml-pipeline-visualizationserver",
-                        "namespace": namespace,
-                    },
-                    "spec": {
-                        "selector": {
-                            "matchLabels": {
-                                "app": "ml-pipeline-visualizationserver"
-                            },
-                        },
-                        "template": {
-                            "metadata": {
-                                "labels": {
-                                    "app": "ml-pipeline-visualizationserver"
-                                },
-                                "annotations": disable_istio_sidecar and {
-                                    "sidecar.istio.io/inject": "false"
-                                } or {},
-                            },
-                            "spec": {
-                                "containers": [{
-                                    "image": f"{visualization_server_image}:{visualization_server_tag}",
-                                    "imagePullPolicy":
-                                        "IfNotPresent",
-                                    "name":
-                                        "ml-pipeline-visualizationserver",
-                                    "ports": [{
-                                        "containerPort": 8888
-                                    }],
-                                    "resources": {
-                                        "requests": {
-                                            "cpu": "50m",
-                                            "memory": "200Mi"
-                                        },
-                                        "limits": {
-                                            "cpu": "500m",
-                                            "memory": "1Gi"
-                                        },
-                                    }
-                                }],
-                                "serviceAccountName":
-                                    "default-editor",
-                            },
-                        },
-                    },
-                },
-                {
-                    "apiVersion": "networking.istio.io/v1alpha3",
-                    "kind": "DestinationRule",
-                    "metadata": {
-                        "name": "ml-pipeline-visualizationserver",
-                        "namespace": namespace,
-                    },
-                    "spec": {
-                        "host": "ml-pipeline-visualizationserver",
-                        "trafficPolicy": {
-                            "tls": {
-                                "mode": "ISTIO_MUTUAL"
-                            }
-                        }
-                    }
+
+class Counter:
+    """
+    Prometheus counter, optionally split by the values of a single label
+    """
+
+    def __init__(self, name, documentation, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_value, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+                labels = f'{{{self.label}="{label_value}"}}' if self.label else ""
+                lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    Prometheus gauge
+    """
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                f"{self.name} {self.value}"]
+
+
+class Histogram:
+    """
+    Prometheus histogram with fixed bucket upper bounds
+    """
+
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        # One count per bucket plus one for +Inf, cumulated when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+            lines.append(f"{self.name}_sum {self.sum}")
+            lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class ControllerMetrics:
+    """
+    Metrics of a controller server, rendered in the Prometheus text format on /metrics
+    """
+
+    def __init__(self, response_cache):
+        self.response_cache = response_cache
+        self.sync_duration = Histogram(
+            f"{METRICS_PREFIX}_sync_duration_seconds",
+            "Time spent computing the desired state of a namespace.", LATENCY_BUCKETS)
+        self.decode_duration = Histogram(
+            f"{METRICS_PREFIX}_decode_duration_seconds",
+            "Time spent decoding the JSON body of a sync request.", LATENCY_BUCKETS)
+        self.encode_duration = Histogram(
+            f"{METRICS_PREFIX}_encode_duration_seconds",
+            "Time spent encoding a sync response that was not cached.", LATENCY_BUCKETS)
+        self.request_size = Histogram(
+            f"{METRICS_PREFIX}_request_size_bytes",
+            "Size of sync request bodies.", SIZE_BUCKETS)
+        self.response_size = Histogram(
+            f"{METRICS_PREFIX}_response_size_bytes",
+            "Size of sync response bodies.", SIZE_BUCKETS)
+        self.syncs = Counter(
+            f"{METRICS_PREFIX}_syncs_total",
+            "Syncs by reported readiness of the namespace (disabled when pipelines are not enabled).",
+            label="ready")
+        self.in_flight = Gauge(
+            f"{METRICS_PREFIX}_in_flight_requests",
+            "Requests currently being served.")
+        self.credentials_reloads = Counter(
+            f"{METRICS_PREFIX}_credentials_reloads_total",
+            "MinIO credentials reloaded from the mounted Secret.")
+        self.namespaces_converged = Counter(
+            f"{METRICS_PREFIX}_namespaces_converged_total",
+            "Syncs of pipelines-enabled namespaces by whether every child matched its desired state.",
+            label="converged")
+        self.children_drifted = Counter(
+            f"{METRICS_PREFIX}_children_drifted_total",
+            "Desired children found missing or differing from their desired state.",
+            label="child")
+        self.fingerprint_checks = Counter(
+            f"{METRICS_PREFIX}_fingerprint_checks_total",
+            "Observed children compared with their desired state, by whether the comparison was "
+            "computed or reused for an unchanged resourceVersion.",
+            label="path")
+
+    def render(self):
+        lines = []
+        for metric in (self.sync_duration, self.decode_duration, self.encode_duration,
+                       self.request_size, self.response_size, self.syncs, self.in_flight,
+                       self.credentials_reloads, self.namespaces_converged, self.children_drifted,
+                       self.fingerprint_checks):
+            lines += metric.render()
+
+        cache_stats = self.response_cache.stats()
+        for stat in ("hits", "misses", "evictions"):
+            name = f"{METRICS_PREFIX}_response_cache_{stat}_total"
+            lines += [f"# HELP {name} Response cache {stat}.", f"# TYPE {name} counter",
+                      f"{name} {cache_stats[stat]}"]
+        for stat in ("size", "max_size"):
+            name = f"{METRICS_PREFIX}_response_cache_{stat}"
+            lines += [f"# HELP {name} Response cache {stat.replace('_', ' ')} in entries.",
+                      f"# TYPE {name} gauge", f"{name} {cache_stats[stat]}"]
+        return "\n".join(lines) + "\n"
+
+
+class ChildResource:
+    """
+    Entry of the child resource registry
+
+    name identifies the entry so controller variants can replace it, observed_key is the
+    key metacontroller lists observed children of its kind under, and build returns the
+    resource for a namespace and the controller settings. The child is only desired when
+    enabled(settings) is true, and is left out of the logs when sensitive.
+    """
+
+    def __init__(self, name, observed_key, build, enabled=None, sensitive=False):
+        self.name = name
+        self.observed_key = observed_key
+        self.build = build
+        self.enabled = enabled or (lambda settings: True)
+        self.sensitive = sensitive
+
+
+def kfp_launcher_configmap(namespace, settings):
+    """
+    Returns the kfp-launcher ConfigMap pointing pipelines at the default pipeline root
+    """
+    return {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {
+            "name": "kfp-launcher",
+            "namespace": namespace,
+        },
+        "data": {
+            "defaultPipelineRoot": settings["kfp_default_pipeline_root"],
+        },
+    }
+
+
+def metadata_grpc_configmap(namespace, settings):
+    """
+    Returns the ConfigMap locating the metadata gRPC service
+    """
+    return {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {
+            "name": "metadata-grpc-configmap",
+            "namespace": namespace,
+        },
+        "data": {
+            "METADATA_GRPC_SERVICE_HOST":
+                "metadata-grpc-service.kubeflow",
+            "METADATA_GRPC_SERVICE_PORT": "8080",
+        },
+    }
+
+
+def visualization_server_deployment(namespace, settings):
+    """
+    Returns the visualization server Deployment
+    """
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {
+            "labels": {
+                "app": "ml-pipeline-visualizationserver"
+            },
+            "name": "ml-pipeline-visualizationserver",
+            "namespace": namespace,
+        },
+        "spec": {
+            "selector": {
+                "matchLabels": {
+                    "app": "ml-pipeline-visualizationserver"
                 },
-                {
-                    "apiVersion": "security.istio.io/v1beta1",
-                    "kind": "AuthorizationPolicy",
-                    "metadata": {
-                        "name": "ml-pipeline-visualizationserver",
-                        "namespace": namespace,
+            },
+            "template": {
+                "metadata": {
+                    "labels": {
+                        "app": "ml-pipeline-visualizationserver"
                     },
-                    "spec": {
-                        "selector": {
-                            "matchLabels": {
-                                "app": "ml-pipeline-visualizationserver"
-                            }
-                        },
-                        "rules": [{
-                            "from": [{
-                                "source": {
-                                    "principals": ["cluster.local/ns/kubeflow/sa/ml-pipeline"]
-                                }
-                            }]
-                        }]
-                    }
+                    "annotations": settings["disable_istio_sidecar"] and {
+                        "sidecar.istio.io/inject": "false"
+                    } or {},
                 },
-                {
-                    "apiVersion": "v1",
-                    "kind": "Service",
-                    "metadata": {
-                        "name": "ml-pipeline-visualizationserver",
-                        "namespace": namespace,
-                    },
-                    "spec": {
+                "spec": {
+                    "containers": [{
+                        "image": f"{settings['visualization_server_image']}:{settings['visualization_server_tag']}",
+                        "imagePullPolicy":
+                            "IfNotPresent",
+                        "name":
+                            "ml-pipeline-visualizationserver",
                         "ports": [{
-                            "name": "http",
-                            "port": 8888,
-                            "protocol": "TCP",
-                            "targetPort": 8888,
+                            "containerPort": 8888
                         }],
-                        "selector": {
-                            "app": "ml-pipeline-visualizationserver",
-                        },
-                    },
-                },
-                # Artifact fetcher related resources below.
-                {
-                    "apiVersion": "apps/v1",
-                    "kind": "Deployment",
-                    "metadata": {
-                        "labels": {
-                            "app": "ml-pipeline-ui-artifact"
-                        },
-                        "name": "ml-pipeline-ui-artifact",
-                        "namespace": namespace,
-                    },
-                    "spec": {
-                        "selector": {
-                            "matchLabels": {
-                                "app": "ml-pipeline-ui-artifact"
-                            }
-                        },
-                        "template": {
-                            "metadata": {
-                                "labels": {
-                                    "app": "ml-pipeline-ui-artifact"
-                                },
-                                "annotations": disable_istio_sidecar and {
-                                    "sidecar.istio.io/inject": "false"
-                                } or {},
+                        "resources": {
+                            "requests": {
+                                "cpu": "50m",
+                                "memory": "200Mi"
+                            },
+                            "limits": {
+                                "cpu": "500m",
+                                "memory": "1Gi"
                             },
-                            "spec": {
-                                "containers": [{
-                                    "name":
-                                        "ml-pipeline-ui-artifact",
-                                    "image": f"{frontend_image}:{frontend_tag}",
-                                    "imagePullPolicy":
-                                        "IfNotPresent",
-                                    "ports": [{
-                                        "containerPort": 3000
-                                    }],
-                                    "resources": {
-                                        "requests": {
-                                            "cpu": "10m",
-                                            "memory": "70Mi"
-                                        },
-                                        "limits": {
-                                            "cpu": "100m",
-                                            "memory": "500Mi"
-                                        },
-                                    }
-                                }],
-                                "serviceAccountName":
-                                    "default-editor"
-                            }
                         }
-                    }
+                    }],
+                    "serviceAccountName":
+                        "default-editor",
                 },
-                {
-                    "apiVersion": "v1",
-                    "kind": "Service",
-                    "metadata": {
-                        "name": "ml-pipeline-ui-artifact",
-                        "namespace": namespace,
-                        "labels": {
-                            "app": "ml-pipeline-ui-artifact"
-                        }
+            },
+        },
+    }
+
+
+def visualization_server_destination_rule(namespace, settings):
+    """
+    Returns the DestinationRule enabling mutual TLS to the visualization server
+    """
+    return {
+        "apiVersion": "networking.istio.io/v1alpha3",
+        "kind": "DestinationRule",
+        "metadata": {
+            "name": "ml-pipeline-visualizationserver",
+            "namespace": namespace,
+        },
+        "spec": {
+            "host": "ml-pipeline-visualizationserver",
+            "trafficPolicy": {
+                "tls": {
+                    "mode": "ISTIO_MUTUAL"
+                }
+            }
+        }
+    }
+
+
+def visualization_server_authorization_policy(namespace, settings):
+    """
+    Returns the AuthorizationPolicy letting the pipelines API server reach the visualization server
+    """
+    return {
+        "apiVersion": "security.istio.io/v1beta1",
+        "kind": "AuthorizationPolicy",
+        "metadata": {
+            "name": "ml-pipeline-visualizationserver",
+            "namespace": namespace,
+        },
+        "spec": {
+            "selector": {
+                "matchLabels": {
+                    "app": "ml-pipeline-visualizationserver"
+                }
+            },
+            "rules": [{
+                "from": [{
+                    "source": {
+                        "principals": ["cluster.local/ns/kubeflow/sa/ml-pipeline"]
+                    }
+                }]
+            }]
+        }
+    }
+
+
+def visualization_server_service(namespace, settings):
+    """
+    Returns the visualization server Service
+    """
+    return {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {
+            "name": "ml-pipeline-visualizationserver",
+            "namespace": namespace,
+        },
+        "spec": {
+            "ports": [{
+                "name": "http",
+                "port": 8888,
+                "protocol": "TCP",
+                "targetPort": 8888,
+            }],
+            "selector": {
+                "app": "ml-pipeline-visualizationserver",
+            },
+        },
+    }
+
+
+def artifact_fetcher_deployment(namespace, settings):
+    """
+    Returns the artifact fetcher Deployment serving artifacts to the pipelines UI
+    """
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {
+            "labels": {
+                "app": "ml-pipeline-ui-artifact"
+            },
+            "name": "ml-pipeline-ui-artifact",
+            "namespace": namespace,
+        },
+        "spec": {
+            "selector": {
+                "matchLabels": {
+                    "app": "ml-pipeline-ui-artifact"
+                }
+            },
+            "template": {
+                "metadata": {
+                    "labels": {
+                        "app": "ml-pipeline-ui-artifact"
                     },
-                    "spec": {
+                    "annotations": settings["disable_istio_sidecar"] and {
+                        "sidecar.istio.io/inject": "false"
+                    } or {},
+                },
+                "spec": {
+                    "containers": [{
+                        "name":
+                            "ml-pipeline-ui-artifact",
+                        "image": f"{settings['frontend_image']}:{settings['frontend_tag']}",
+                        "imagePullPolicy":
+                            "IfNotPresent",
                         "ports": [{
-                            "name":
-                                "http",  # name is required to let istio understand request protocol
-                            "port": 80,
-                            "protocol": "TCP",
-                            "targetPort": 3000
+                            "containerPort": 3000
                         }],
-                        "selector": {
-                            "app": "ml-pipeline-ui-artifact"
+                        "resources": {
+                            "requests": {
+                                "cpu": "10m",
+                                "memory": "70Mi"
+                            },
+                            "limits": {
+                                "cpu": "100m",
+                                "memory": "500Mi"
+                            },
                         }
-                    }
-                },
-            ]
-            print('Received request:\n', json.dumps(parent, indent=2, sort_keys=True))
-            print('Desired resources except secrets:\n', json.dumps(desired_resources, indent=2, sort_keys=True))
-            # Moved after the print argument because this is sensitive data.
-            desired_resources.append({
-                "apiVersion": "v1",
-                "kind": "Secret",
-                "metadata": {
-                    "name": "mlpipeline-minio-artifact",
-                    "namespace": namespace,
-                },
-                "data": {
-                    "accesskey": minio_access_key,
-                    "secretkey": minio_secret_key,
-                },
-            })
+                    }],
+                    "serviceAccountName":
+                        "default-editor"
+                }
+            }
+        }
+    }
 
-            return {"status": desired_status, "children": desired_resources}
 
-        def do_POST(self):
-            # Serve the sync() function as a JSON webhook.
-            observed = json.loads(
-                self.rfile.read(int(self.headers.get("content-length"))))
-            desired = self.sync(observed["parent"], observed["children"])
+def artifact_fetcher_service(namespace, settings):
+    """
+    Returns the artifact fetcher Service
+    """
+    return {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {
+            "name": "ml-pipeline-ui-artifact",
+            "namespace": namespace,
+            "labels": {
+                "app": "ml-pipeline-ui-artifact"
+            }
+        },
+        "spec": {
+            "ports": [{
+                "name":
+                    "http",  # name is required to let istio understand request protocol
+                "port": 80,
+                "protocol": "TCP",
+                "targetPort": 3000
+            }],
+            "selector": {
+                "app": "ml-pipeline-ui-artifact"
+            }
+        }
+    }
+
+
+def minio_artifact_secret(namespace, settings):
+    """
+    Returns the Secret holding the MinIO credentials
+    """
+    return {
+        "apiVersion": "v1",
+        "kind": "Secret",
+        "metadata": {
+            "name": "mlpipeline-minio-artifact",
+            "namespace": namespace,
+        },
+        "data": {
+            "accesskey": settings["minio_access_key"],
+            "secretkey": settings["minio_secret_key"],
+        },
+    }
+
+
+# Children every pipelines-enabled namespace should contain, in the order they are returned
+CHILD_RESOURCES = (
+    ChildResource("ConfigMap/kfp-launcher", "ConfigMap.v1", kfp_launcher_configmap,
+                  enabled=lambda settings: bool(settings["kfp_default_pipeline_root"])),
+    ChildResource("ConfigMap/metadata-grpc-configmap", "ConfigMap.v1", metadata_grpc_configmap),
+    # Visualization server related resources below
+    ChildResource("Deployment/ml-pipeline-visualizationserver", "Deployment.apps/v1",
+                  visualization_server_deployment),
+    ChildResource("DestinationRule/ml-pipeline-visualizationserver",
+                  "DestinationRule.networking.istio.io/v1alpha3", visualization_server_destination_rule),
+    ChildResource("AuthorizationPolicy/ml-pipeline-visualizationserver",
+                  "AuthorizationPolicy.security.istio.io/v1beta1", visualization_server_authorization_policy),
+    ChildResource("Service/ml-pipeline-visualizationserver", "Service.v1", visualization_server_service),
+    # Artifact fetcher related resources below
+    ChildResource("Deployment/ml-pipeline-ui-artifact", "Deployment.apps/v1", artifact_fetcher_deployment),
+    ChildResource("Service/ml-pipeline-ui-artifact", "Service.v1", artifact_fetcher_service),
+    ChildResource("Secret/mlpipeline-minio-artifact", "Secret.v1", minio_artifact_secret, sensitive=True),
+)
+
+# Differences of each pipelines backend to CHILD_RESOURCES: an entry replaces the
+# registry entry with the same name, or is added after the registry when there is none.
+# The Argo and Tekton backends currently need the same children.
+CONTROLLER_VARIANTS = {
+    "argo": (),
+    "tekton": (),
+}
+DEFAULT_CONTROLLER_VARIANT = "argo"
+
+
+def variant_child_resources(controller_variant):
+    """
+    Returns the child resource registry of a controller variant
+    """
+    overrides = OrderedDict((child.name, child) for child in CONTROLLER_VARIANTS[controller_variant])
+    child_resources = [overrides.pop(child.name, child) for child in CHILD_RESOURCES]
+    return child_resources + list(overrides.values())
+
+
+def desired_children(namespace, visualization_server_image, visualization_server_tag,
+                     frontend_image, frontend_tag, disable_istio_sidecar,
+                     minio_access_key, minio_secret_key, kfp_default_pipeline_root=None,
+                     controller_variant=DEFAULT_CONTROLLER_VARIANT):
+    """
+    Returns the child resources every pipelines-enabled namespace should contain
+    """
+    settings = {
+        "visualization_server_image": visualization_server_image,
+        "visualization_server_tag": visualization_server_tag,
+        "frontend_image": frontend_image,
+        "frontend_tag": frontend_tag,
+        "disable_istio_sidecar": disable_istio_sidecar,
+        "minio_access_key": minio_access_key,
+        "minio_secret_key": minio_secret_key,
+        "kfp_default_pipeline_root": kfp_default_pipeline_root,
+    }
+    return [child.build(namespace, settings)
+            for child in variant_child_resources(controller_variant) if child.enabled(settings)]
+
+
+class NamespacedTemplate:
+    """
+    JSON document serialized once with a placeholder namespace
+
+    Rendering only splices the JSON-encoded namespace between the pre-serialized
+    fragments, instead of rebuilding and re-encoding the whole document.
+    """
+
+    def __init__(self, document, **dumps_kwargs):
+        self.fragments = json.dumps(document, **dumps_kwargs).split(json.dumps(NAMESPACE_PLACEHOLDER))
+        self.byte_fragments = [fragment.encode("utf-8") for fragment in self.fragments]
+
+    def render(self, namespace):
+        return json.dumps(namespace).join(self.fragments)
+
+    def render_bytes(self, namespace):
+        # json.dumps escapes non-ASCII characters, so the namespace is ASCII-only
+        return json.dumps(namespace).encode("ascii").join(self.byte_fragments)
+
+
+def server_factory(visualization_server_image,
+                   visualization_server_tag, frontend_image, frontend_tag,
+                   disable_istio_sidecar, minio_access_key,
+                   minio_secret_key, kfp_default_pipeline_root=None,
+                   url="", controller_port=8080, server_mode=SERVER_MODE_SINGLE,
+                   server_workers=16, log_level=None, log_payload_sample_rate=0,
+                   response_cache_size=1024, json_codec="json", max_request_bytes=64 * 1024 * 1024,
+                   keep_alive_timeout=5, max_requests_per_connection=1000,
+                   controller_variant=DEFAULT_CONTROLLER_VARIANT, server_processes=1,
+                   minio_credentials_dir=None, credentials_reload_interval=10, convergence_check=False):
+    """
+    Returns an HTTPServer populated with Handler with customized settings
+
+    The children reconciled, and the readiness check on the observed children, both
+    come from the child resource registry of controller_variant.
+    In threaded server_mode, requests are served by a pool of server_workers threads.
+    Each sync is logged as a single summary line; the full parent and desired children
+    are only logged at DEBUG level or for a log_payload_sample_rate fraction of syncs.
+    Up to response_cache_size encoded responses are cached; the cache is available as
+    the response_cache attribute of the returned server, and its metrics as the
+    metrics attribute. Metrics are served on GET /metrics and liveness on GET /healthz.
+    Sync requests are decoded with json_codec and rejected with 413 when their body
+    exceeds max_request_bytes.
+
+    POST /batch accepts a JSON array of {"parent": ..., "children": ...} observations and
+    returns the array of their desired states in the same order, computed on a pool of
+    server_workers threads. An observation that can not be synced gets an
+    {"error": ...} entry instead, without failing the rest of the batch.
+
+    In threaded server_mode, connections are kept alive with HTTP/1.1 until they have
+    been idle for keep_alive_timeout seconds or have served max_requests_per_connection
+    requests. The single server_mode always answers with HTTP/1.0 and closes the
+    connection, as a kept-alive connection would block its only thread.
+
+    server_processes is kept as the server_processes attribute of the returned server;
+    main() pre-forks that many workers serving it with a PreforkSupervisor.
+
+    When minio_credentials_dir is given, the server loop checks the Secret mounted there
+    every credentials_reload_interval seconds and swaps in new response templates when
+    the credentials were rotated. The reload_credentials(access_key, secret_key)
+    attribute of the returned server does the same for base64-encoded keys.
+
+    With convergence_check, every sync of a pipelines-enabled namespace also compares the
+    observed children with the desired ones and counts converged namespaces and drifted
+    children in the metrics. The response still lists every desired child, as
+    metacontroller deletes the children missing from it. A child observed with the same
+    resourceVersion as on its previous sync reuses the previous comparison.
+    """
+    if log_level:
+        log.setLevel(log_level)
+
+    child_settings = {
+        "visualization_server_image": visualization_server_image,
+        "visualization_server_tag": visualization_server_tag,
+        "frontend_image": frontend_image,
+        "frontend_tag": frontend_tag,
+        "disable_istio_sidecar": disable_istio_sidecar,
+        "minio_access_key": minio_access_key,
+        "minio_secret_key": minio_secret_key,
+        "kfp_default_pipeline_root": kfp_default_pipeline_root,
+    }
+    registry = [child for child in variant_child_resources(controller_variant) if child.enabled(child_settings)]
+
+    # A namespace is ready once as many children of each kind are observed as are desired
+    readiness_expectations = OrderedDict()
+    for child in registry:
+        readiness_expectations[child.observed_key] = readiness_expectations.get(child.observed_key, 0) + 1
+    readiness_expectations = tuple(readiness_expectations.items())
+
+    def build_response_templates(settings):
+        # One template of the whole response per readiness value, so rendering a
+        # response is a single join of pre-encoded bytes
+        resources = [child.build(NAMESPACE_PLACEHOLDER, settings) for child in registry]
+        return {
+            ready: NamespacedTemplate({"status": {"kubeflow-pipelines-ready": ready}, "children": resources})
+            for ready in ("True", "False")
+        }
+
+    def build_fingerprint_templates(settings):
+        # Canonical encodings of each desired child, compared with the observed child projected on it
+        fingerprint_templates = []
+        for child in registry:
+            resource = child.build(NAMESPACE_PLACEHOLDER, settings)
+            fingerprint_templates.append((child.name, child.observed_key, resource["metadata"]["name"], resource,
+                                          NamespacedTemplate(resource, sort_keys=True, separators=(",", ":"))))
+        return fingerprint_templates
+
+    # Children only differ by namespace between syncs, so they are serialized once here
+    child_resources = [child.build(NAMESPACE_PLACEHOLDER, child_settings) for child in registry]
+    response_templates = build_response_templates(child_settings)
+    fingerprint_templates = build_fingerprint_templates(child_settings) if convergence_check else ()
+    # Sensitive children such as the Secret are left out of the logs.
+    logged_children_template = NamespacedTemplate(
+        [resource for child, resource in zip(registry, child_resources) if not child.sensitive],
+        indent=2, sort_keys=True)
+    response_cache = ResponseCache(int(response_cache_size))
+    # Comparison of each child of each namespace with the resourceVersion it was made for
+    fingerprint_cache = ResponseCache(int(response_cache_size) * len(registry))
+    metrics = ControllerMetrics(response_cache)
+    json_loads = JSON_DECODERS[json_codec]
+    max_request_bytes = int(max_request_bytes)
+    keep_alive_timeout = float(keep_alive_timeout)
+    max_requests_per_connection = int(max_requests_per_connection)
+    keep_alive = server_mode == SERVER_MODE_THREADED and keep_alive_timeout > 0
+    batch_executor = ThreadPoolExecutor(max_workers=int(server_workers), thread_name_prefix="sync-batch")
+
+    def reload_credentials(access_key, secret_key):
+        nonlocal child_settings, response_templates, fingerprint_templates
+        child_settings = dict(child_settings, minio_access_key=access_key, minio_secret_key=secret_key)
+        # Swapped in one assignment, in-flight syncs finish with the templates they started with
+        response_templates = build_response_templates(child_settings)
+        if convergence_check:
+            fingerprint_templates = build_fingerprint_templates(child_settings)
+            fingerprint_cache.clear()
+        response_cache.clear()
+        metrics.credentials_reloads.inc()
+        log.info("reloaded the MinIO credentials")
+
+    class Controller(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" if keep_alive else "HTTP/1.0"
+        # Idle time before a kept-alive connection is dropped
+        timeout = keep_alive_timeout if keep_alive else None
+        # Headers and body are written separately, which Nagle's algorithm would delay
+        # on kept-alive connections until the client's delayed ACK
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            self.requests_served = 0
+
+        def end_headers(self):
+            self.requests_served += 1
+            if not self.close_connection and self.requests_served >= max_requests_per_connection:
+                self.send_header("Connection", "close")
+            super().end_headers()
+
+        def sync(self, parent, children):
+            """
+            Returns the desired state for the observed parent namespace and children
+            """
+            return json_loads(self.sync_bytes(parent, children))
+
+        def sync_json(self, parent, children):
+            """
+            Returns the JSON-encoded desired state for the observed parent namespace and children
+            """
+            return self.sync_bytes(parent, children).decode("utf-8")
+
+        def sync_bytes(self, parent, children):
+            """
+            Returns the UTF-8 JSON-encoded desired state for the observed parent namespace and children
+            """
+            # parent is a namespace
+            namespace = parent.get("metadata", {}).get("name")
+
+            pipeline_enabled = parent.get("metadata", {}).get(
+                "labels", {}).get("pipelines.kubeflow.org/enabled")
+
+            if pipeline_enabled != "true":
+                return EMPTY_SYNC_RESPONSE_BYTES
+
+            # Compute status based on observed state.
+            return response_templates[self.pipelines_ready(children)].render_bytes(namespace)
+
+        def pipelines_ready(self, children):
+            """
+            Returns "True" when every desired child is observed, "False" otherwise
+            """
+            for observed_key, count in readiness_expectations:
+                if len(children[observed_key]) != count:
+                    return "False"
+            return "True"
+
+        def drifted_children(self, namespace, children):
+            """
+            Returns the registry names of the desired children that are missing or differ
+            from their desired state
+            """
+            drifted = []
+            generation = fingerprint_cache.generation
+            for name, observed_key, child_name, resource, template in fingerprint_templates:
+                observed = find_observed_child(children.get(observed_key), child_name)
+                if observed is None:
+                    drifted.append(name)
+                    continue
+
+                resource_version = observed.get("metadata", {}).get("resourceVersion")
+                key = (namespace, name)
+                verdict = fingerprint_cache.get(key) if resource_version is not None else None
+                if verdict is not None and verdict[0] == resource_version:
+                    metrics.fingerprint_checks.inc("cached")
+                    matches = verdict[1]
+                else:
+                    metrics.fingerprint_checks.inc("computed")
+                    fingerprint = json.dumps(project(observed, resource), sort_keys=True, separators=(",", ":"))
+                    matches = fingerprint == template.render(namespace)
+                    if resource_version is not None:
+                        fingerprint_cache.put(key, (resource_version, matches), generation)
+                if not matches:
+                    drifted.append(name)
+            return drifted
+
+        def sync_response(self, parent, children):
+            """
+            Returns the UTF-8 encoded desired state for the observed parent namespace and children
+
+            For pipelines-enabled namespaces the response only depends on the namespace and
+            the number of observed children of each kind, so it is cached under those.
+            """
+            start = time.perf_counter()
+            metadata = parent.get("metadata", {})
+            namespace = metadata.get("name")
+            pipeline_enabled = metadata.get("labels", {}).get("pipelines.kubeflow.org/enabled")
+
+            if pipeline_enabled != "true":
+                metrics.syncs.inc("disabled")
+                metrics.sync_duration.observe(time.perf_counter() - start)
+                return EMPTY_SYNC_RESPONSE_BYTES
+
+            key = (namespace, tuple(sorted((kind, len(observed)) for kind, observed in children.items())))
+            generation = response_cache.generation
+            response = response_cache.get(key)
+            cache_result = "hit"
+            if response is None:
+                cache_result = "miss"
+                encode_start = time.perf_counter()
+                response = self.sync_bytes(parent, children)
+                metrics.encode_duration.observe(time.perf_counter() - encode_start)
+                response_cache.put(key, response, generation)
+
+            if log.isEnabledFor(logging.DEBUG):
+                payload_level = logging.DEBUG
+            elif log_payload_sample_rate and random.random() < log_payload_sample_rate:
+                payload_level = logging.INFO
+            else:
+                payload_level = None
+            if payload_level is not None:
+                log.log(payload_level, "Received request:\n%s", json.dumps(parent, indent=2, sort_keys=True))
+                log.log(payload_level, "Desired resources except secrets:\n%s",
+                        logged_children_template.render(namespace))
+
+            ready = self.pipelines_ready(children)
+            if convergence_check:
+                drifted = self.drifted_children(namespace, children)
+                metrics.namespaces_converged.inc("false" if drifted else "true")
+                for name in drifted:
+                    metrics.children_drifted.inc(name)
+                if drifted:
+                    log.debug("namespace=%s drifted children: %s", namespace, ", ".join(drifted))
+            duration = time.perf_counter() - start
+            metrics.syncs.inc(ready)
+            metrics.sync_duration.observe(duration)
+            log.info("sync namespace=%s ready=%s observed_children=%d desired_children=%d cache=%s "
+                     "latency_ms=%.3f",
+                     namespace, ready, sum(len(observed) for observed in children.values()),
+                     len(child_resources), cache_result, duration * 1000)
+
+            return response
+
+        def log_message(self, format, *args):
+            # Access logs duplicate the per-sync summary, so they are only kept at DEBUG level
+            log.debug("%s - " + format, self.address_string(), *args)
+
+        def log_error(self, format, *args):
+            # Idle kept-alive connections timing out is expected
+            level = logging.DEBUG if format.startswith("Request timed out") else logging.ERROR
+            log.log(level, "%s - " + format, self.address_string(), *args)
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/metrics":
+                body = metrics.render().encode("utf-8")
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif path == "/healthz":
+                body = b"ok"
+                content_type = "text/plain; charset=utf-8"
+            else:
+                self.send_error(404)
+                return
 
             self.send_response(200)
-            self.send_header("Content-type", "application/json")
+            self.send_header("Content-type", content_type)
+            self.send_header("Content-Length", str(len(body)))
             self.end_headers()
-            self.wfile.write(bytes(json.dumps(desired), 'utf-8'))
+            self.wfile.write(body)
+
+        def sync_batch(self, observations):
+            """
+            Returns the UTF-8 encoded JSON array of desired states for the observations
+
+            Chunks of observations are synced on the batch worker pool and their results
+            are joined back in the order of the observations.
+            """
+            chunks = [observations[i:i + BATCH_CHUNK_SIZE]
+                      for i in range(0, len(observations), BATCH_CHUNK_SIZE)]
+            responses = []
+            for chunk_responses in batch_executor.map(self.sync_batch_chunk, chunks):
+                responses += chunk_responses
+            return b"[" + b", ".join(responses) + b"]"
+
+        def sync_batch_chunk(self, observations):
+            responses = []
+            for observed in observations:
+                if not is_observation(observed):
+                    responses.append(json.dumps({"error": "Observation must have parent and children"})
+                                     .encode("utf-8"))
+                    continue
+                try:
+                    responses.append(self.sync_response(observed["parent"], observed["children"]))
+                except Exception as e:
+                    log.warning("batch sync failed: %r", e)
+                    responses.append(json.dumps({"error": f"{type(e).__name__}: {e}"}).encode("utf-8"))
+            return responses
+
+        def read_json(self):
+            """
+            Returns the decoded request body, or None after replying with an error status
+            """
+            try:
+                content_length = int(self.headers["content-length"])
+            except (TypeError, ValueError):
+                self.send_error(411, "A valid Content-Length is required")
+                return None
+            if content_length < 0:
+                # rfile.read(-1) would read until the client closes the connection
+                self.close_connection = True
+                self.send_error(400, f"Invalid Content-Length {content_length}")
+                return None
+            if content_length > max_request_bytes:
+                # The body is left unread, so the connection can not be reused
+                self.close_connection = True
+                self.send_error(413, f"Request body of {content_length} bytes exceeds "
+                                     f"the {max_request_bytes} bytes limit")
+                return None
+
+            body = self.rfile.read(content_length)
+            metrics.request_size.observe(len(body))
+            decode_start = time.perf_counter()
+            try:
+                observed = json_loads(body)
+            except ValueError as e:
+                self.send_error(400, f"Invalid JSON in request: {e}")
+                return None
+            metrics.decode_duration.observe(time.perf_counter() - decode_start)
+            return observed
+
+        def do_POST(self):
+            # Serve the sync() function as a JSON webhook.
+            metrics.in_flight.inc()
+            try:
+                observed = self.read_json()
+                if observed is None:
+                    return
+
+                if self.path.split("?", 1)[0] == BATCH_PATH:
+                    if not isinstance(observed, list):
+                        self.send_error(400, "Batch request must be an array of observations")
+                        return
+                    desired = self.sync_batch(observed)
+                else:
+                    if not is_observation(observed):
+                        self.send_error(400, "Sync request must have parent and children")
+                        return
+                    desired = self.sync_response(observed["parent"], observed["children"])
+                metrics.response_size.observe(len(desired))
+
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.send_header("Content-Length", str(len(desired)))
+                self.end_headers()
+                self.wfile.write(desired)
+            finally:
+                metrics.in_flight.dec()
 
-    return HTTPServer((url, int(controller_port)), Controller)
+    if server_mode == SERVER_MODE_THREADED:
+        server = ThreadPoolHTTPServer((url, int(controller_port)), Controller, int(server_workers))
+    else:
+        server = HTTPServer((url, int(controller_port)), Controller)
+    server.response_cache = response_cache
+    server.metrics = metrics
+    server.batch_executor = batch_executor
+    server.server_processes = int(server_processes)
+    server.reload_credentials = reload_credentials
+    if minio_credentials_dir:
+        # Called by serve_forever() between requests and at every poll interval
+        server.service_actions = CredentialsWatcher(
+            minio_credentials_dir, float(credentials_reload_interval), reload_credentials).poll
+    return server
 
 
 if __name__ == "__main__":
@@ -1,12 +1,26 @@
+import base64
+import http.client
+import logging
 import os
+import signal
+import socket
+import subprocess
+import sys
+import time
 from unittest import mock
 import threading
-from sync import get_settings_from_env, server_factory
+import sync
+from sync import ResponseCache, desired_children, get_settings_from_env, server_factory
 import json
 
 import pytest
 import requests
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Data sets passed to server
 DATA_INCORRECT_CHILDREN = {
     "parent": {
@@ -99,6 +113,13 @@ ENV_IMAGES_WITH_TAGS_AND_ISTIO = dict(ENV_IMAGES_WITH_TAGS,
                                       }
                                       )
 
+ENV_THREADED = dict(ENV_IMAGES_WITH_TAGS,
+                    **{
+                        "SERVER_MODE": "threaded",
+                        "SERVER_WORKERS": "4",
+                    }
+                    )
+
 
 def generate_image_name(imagename, tag):
     return f"{str(imagename)}:{str(tag)}"
@@ -271,7 +292,7 @@ def test_sync_server_without_pipeline_enabled(sync_server, data, expected_status
     """
     Nearly end-to-end test of how Controller serves .sync as a POST
 
-    Tests case where metadata.labels.pipelines.kubeflow.org/enabled does not 
+    Tests case where metadata.labels.pipelines.kubeflow.org/enabled does not
     exist and thus server returns an empty reply
     """
     server, environ = sync_server
@@ -284,3 +305,650 @@ def test_sync_server_without_pipeline_enabled(sync_server, data, expected_status
     # Test overall status of whether children are ok
     assert results['status'] == expected_status
     assert results['children'] == expected_children
+
+
+@pytest.mark.parametrize(
+    "sync_server, data, expected_status",
+    [
+        (ENV_THREADED, DATA_CORRECT_CHILDREN, {"kubeflow-pipelines-ready": "True"}),
+    ],
+    indirect=["sync_server"]
+)
+def test_sync_server_threaded_not_stalled_by_slow_client(sync_server, data, expected_status):
+    """
+    Nearly end-to-end test of the threaded server mode
+
+    Tests that a client which connects but never sends its request does not block
+    other sync calls from being served
+    """
+    server, environ = sync_server
+
+    # server.server_address = (url, port_as_integer)
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}"
+    with socket.create_connection(server.server_address[:2]):
+        x = requests.post(url, data=json.dumps(data), timeout=5)
+    results = json.loads(x.text)
+
+    assert results['status'] == expected_status
+    assert len(results['children']) == 8
+
+
+@pytest.mark.parametrize(
+    "environ, expected_mode, expected_workers",
+    [
+        (ENV_KFP_VERSION_ONLY, "single", "16"),
+        (ENV_THREADED, "threaded", "4"),
+    ]
+)
+def test_get_settings_from_env_server_mode(environ, expected_mode, expected_workers):
+    with mock.patch.dict(os.environ, environ):
+        settings = get_settings_from_env()
+
+    assert settings["server_mode"] == expected_mode
+    assert settings["server_workers"] == expected_workers
+
+
+def test_get_settings_from_env_rejects_unknown_server_mode():
+    with mock.patch.dict(os.environ, dict(ENV_KFP_VERSION_ONLY, SERVER_MODE="forking")):
+        with pytest.raises(ValueError):
+            get_settings_from_env()
+
+
+@pytest.mark.parametrize(
+    "sync_server, namespace",
+    [
+        (ENV_IMAGES_WITH_TAGS, "myName"),
+        (dict(ENV_IMAGES_WITH_TAGS, KFP_DEFAULT_PIPELINE_ROOT="minio://mlpipeline"), "my\"quoted\\Name"),
+    ],
+    indirect=["sync_server"]
+)
+def test_sync_server_children_match_desired_children(sync_server, namespace):
+    """
+    Tests that the children rendered from the precompiled templates are exactly
+    the ones desired_children builds for the namespace
+    """
+    server, environ = sync_server
+    data = dict(DATA_CORRECT_CHILDREN,
+                parent={"metadata": dict(DATA_CORRECT_CHILDREN["parent"]["metadata"], name=namespace)})
+
+    with mock.patch.dict(os.environ, environ):
+        settings = get_settings_from_env()
+    expected_children = desired_children(
+        namespace, settings["visualization_server_image"], settings["visualization_server_tag"],
+        settings["frontend_image"], settings["frontend_tag"], settings["disable_istio_sidecar"],
+        settings["minio_access_key"], settings["minio_secret_key"], settings["kfp_default_pipeline_root"])
+
+    # server.server_address = (url, port_as_integer)
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}"
+    x = requests.post(url, data=json.dumps(data))
+    results = json.loads(x.text)
+
+    assert results['children'] == expected_children
+    assert all(child["metadata"]["namespace"] == namespace for child in results['children'])
+
+
+@pytest.mark.parametrize(
+    "sync_server, log_level, expect_payloads",
+    [
+        (ENV_IMAGES_WITH_TAGS, logging.INFO, False),
+        (ENV_IMAGES_WITH_TAGS, logging.DEBUG, True),
+        (dict(ENV_IMAGES_WITH_TAGS, LOG_PAYLOAD_SAMPLE_RATE="1"), logging.INFO, True),
+    ],
+    indirect=["sync_server"]
+)
+def test_sync_server_logging(sync_server, log_level, expect_payloads, caplog):
+    """
+    Tests that every sync is logged as a one-line summary and that full payloads are
+    only logged at DEBUG level or when sampled, never including the MinIO secret
+    """
+    server, environ = sync_server
+    caplog.set_level(log_level, logger="pipelines-profile-controller")
+
+    # server.server_address = (url, port_as_integer)
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}"
+    requests.post(url, data=json.dumps(DATA_CORRECT_CHILDREN))
+
+    messages = [record.getMessage() for record in caplog.records]
+    summaries = [m for m in messages if m.startswith("sync ")]
+    assert len(summaries) == 1
+    assert "namespace=myName ready=True observed_children=8 desired_children=8" in summaries[0]
+    assert any(m.startswith("Received request") for m in messages) == expect_payloads
+    encoded_secret_key = base64.b64encode(environ["MINIO_SECRET_KEY"].encode("utf-8")).decode("utf-8")
+    assert not any(encoded_secret_key in m for m in messages)
+
+
+@pytest.mark.parametrize(
+    "sync_server",
+    [
+        ENV_IMAGES_WITH_TAGS,
+    ],
+    indirect=["sync_server"]
+)
+def test_sync_server_response_cache(sync_server):
+    """
+    Tests that identical syncs are served from the response cache while a change in
+    observed children is recomputed
+    """
+    server, environ = sync_server
+
+    # server.server_address = (url, port_as_integer)
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}"
+    first = requests.post(url, data=json.dumps(DATA_INCORRECT_CHILDREN))
+    second = requests.post(url, data=json.dumps(DATA_INCORRECT_CHILDREN))
+    third = requests.post(url, data=json.dumps(DATA_CORRECT_CHILDREN))
+
+    assert first.content == second.content
+    assert json.loads(third.text)['status'] == {"kubeflow-pipelines-ready": "True"}
+    assert server.response_cache.stats() == {
+        "size": 2, "max_size": 1024, "hits": 1, "misses": 2, "evictions": 0,
+    }
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = ResponseCache(2)
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    assert cache.get("a") == b"1"
+    cache.put("c", b"3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1"
+    assert cache.get("c") == b"3"
+    assert cache.stats() == {"size": 2, "max_size": 2, "hits": 3, "misses": 1, "evictions": 1}
+
+
+def test_response_cache_disabled():
+    cache = ResponseCache(0)
+    cache.put("a", b"1")
+
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+@pytest.mark.parametrize(
+    "sync_server",
+    [
+        ENV_IMAGES_WITH_TAGS,
+    ],
+    indirect=["sync_server"]
+)
+def test_sync_server_metrics_and_healthz(sync_server):
+    """
+    Tests that /metrics reports the syncs served so far and /healthz reports liveness
+    """
+    server, environ = sync_server
+
+    # server.server_address = (url, port_as_integer)
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}"
+    requests.post(url, data=json.dumps(DATA_INCORRECT_CHILDREN))
+    requests.post(url, data=json.dumps(DATA_CORRECT_CHILDREN))
+    requests.post(url, data=json.dumps(DATA_MISSING_PIPELINE_ENABLED))
+
+    healthz = requests.get(f"{url}/healthz")
+    assert healthz.status_code == 200
+    assert healthz.text == "ok"
+
+    metrics = requests.get(f"{url}/metrics")
+    assert metrics.status_code == 200
+    lines = metrics.text.splitlines()
+    assert 'pipelines_profile_controller_syncs_total{ready="False"} 1' in lines
+    assert 'pipelines_profile_controller_syncs_total{ready="True"} 1' in lines
+    assert 'pipelines_profile_controller_syncs_total{ready="disabled"} 1' in lines
+    assert "pipelines_profile_controller_sync_duration_seconds_count 3" in lines
+    assert 'pipelines_profile_controller_decode_duration_seconds_bucket{le="+Inf"} 3' in lines
+    assert "pipelines_profile_controller_encode_duration_seconds_count 2" in lines
+    assert "pipelines_profile_controller_request_size_bytes_count 3" in lines
+    assert "pipelines_profile_controller_in_flight_requests 0" in lines
+    assert "pipelines_profile_controller_response_cache_misses_total 2" in lines
+
+    assert requests.get(f"{url}/unknown").status_code == 404
+
+
+@pytest.mark.parametrize(
+    "sync_server",
+    [
+        dict(ENV_IMAGES_WITH_TAGS, JSON_CODEC="json"),
+        pytest.param(dict(ENV_IMAGES_WITH_TAGS, JSON_CODEC="orjson"),
+                     marks=pytest.mark.skipif(orjson is None, reason="orjson is not installed")),
+    ],
+    indirect=["sync_server"]
+)
+def test_sync_server_json_codecs(sync_server):
+    """
+    Tests that every JSON codec decodes the observed state into the same response
+    """
+    server, environ = sync_server
+
+    # server.server_address = (url, port_as_integer)
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}"
+    x = requests.post(url, data=json.dumps(DATA_CORRECT_CHILDREN))
+    results = json.loads(x.text)
+
+    assert x.headers["Content-Length"] == str(len(x.content))
+    assert results['status'] == {"kubeflow-pipelines-ready": "True"}
+    assert len(results['children']) == 8
+
+
+@pytest.mark.parametrize(
+    "sync_server, data, content_length, expected_status_code",
+    [
+        (dict(ENV_IMAGES_WITH_TAGS, MAX_REQUEST_BYTES="64"), json.dumps(DATA_CORRECT_CHILDREN), None, 413),
+        (ENV_IMAGES_WITH_TAGS, "{not json", None, 400),
+        (ENV_IMAGES_WITH_TAGS, json.dumps({"parent": {}}), None, 400),
+        (ENV_IMAGES_WITH_TAGS, json.dumps(DATA_CORRECT_CHILDREN), "-1", 400),
+        (ENV_IMAGES_WITH_TAGS, json.dumps(DATA_CORRECT_CHILDREN), "many", 411),
+    ],
+    indirect=["sync_server"]
+)
+def test_sync_server_rejects_invalid_requests(sync_server, data, content_length, expected_status_code):
+    """
+    Tests that oversize and malformed sync requests get an error status instead of
+    a dropped connection or a server waiting for the client to close it
+    """
+    server, environ = sync_server
+
+    # The connection is left open, a server reading until EOF would time out
+    connection = http.client.HTTPConnection(*server.server_address[:2], timeout=5)
+    connection.putrequest("POST", "/")
+    connection.putheader("Content-Length", content_length or str(len(data)))
+    connection.endheaders(data.encode())
+    response = connection.getresponse()
+
+    assert response.status == expected_status_code
+    connection.close()
+
+
+def test_get_settings_from_env_rejects_unknown_json_codec():
+    with mock.patch.dict(os.environ, dict(ENV_KFP_VERSION_ONLY, JSON_CODEC="simplejson")):
+        with pytest.raises(ValueError):
+            get_settings_from_env()
+
+
+@pytest.mark.parametrize(
+    "sync_server, expected_versions, expected_connection_headers",
+    [
+        (ENV_THREADED, [11, 11, 11], [None, None, None]),
+        (dict(ENV_THREADED, MAX_REQUESTS_PER_CONNECTION="2"), [11, 11], [None, "close"]),
+        (ENV_IMAGES_WITH_TAGS, [10], [None]),
+    ],
+    indirect=["sync_server"]
+)
+def test_sync_server_keep_alive(sync_server, expected_versions, expected_connection_headers):
+    """
+    Tests that the threaded server keeps HTTP/1.1 connections open until the
+    per-connection request cap, while the single server closes after each request
+    """
+    server, environ = sync_server
+    connection = http.client.HTTPConnection(*server.server_address[:2], timeout=5)
+    body = json.dumps(DATA_CORRECT_CHILDREN)
+
+    sockets = []
+    for expected_version, expected_connection_header in zip(expected_versions, expected_connection_headers):
+        connection.request("POST", "/sync", body=body)
+        sockets.append(connection.sock)
+        response = connection.getresponse()
+        results = json.loads(response.read())
+
+        assert response.version == expected_version
+        assert response.getheader("Connection") == expected_connection_header
+        assert results['status'] == {"kubeflow-pipelines-ready": "True"}
+
+    # All requests went over the same connection, which stays open unless the server closed it
+    assert all(sock is sockets[0] for sock in sockets)
+    kept_alive = expected_versions[-1] == 11 and expected_connection_headers[-1] is None
+    assert (connection.sock is not None) == kept_alive
+    connection.close()
+
+
+@pytest.mark.parametrize(
+    "sync_server",
+    [
+        ENV_IMAGES_WITH_TAGS,
+        ENV_THREADED,
+    ],
+    indirect=["sync_server"]
+)
+def test_sync_server_batch(sync_server):
+    """
+    Tests that /batch returns one desired state per observation in request order,
+    with errors isolated to the observations that caused them
+    """
+    server, environ = sync_server
+
+    observations = []
+    for i in range(150):
+        observation = dict(DATA_CORRECT_CHILDREN if i % 2 else DATA_INCORRECT_CHILDREN)
+        observation["parent"] = {"metadata": dict(observation["parent"]["metadata"], name=f"profile-{i}")}
+        observations.append(observation)
+    observations[3] = {"parent": {}}
+    observations[4] = dict(observations[4], children={})
+    observations[5] = DATA_MISSING_PIPELINE_ENABLED
+
+    # server.server_address = (url, port_as_integer)
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}/batch"
+    x = requests.post(url, data=json.dumps(observations))
+    results = json.loads(x.text)
+
+    assert x.status_code == 200
+    assert len(results) == len(observations)
+    assert "error" in results[3]
+    assert "error" in results[4]
+    assert results[5] == {"status": {}, "children": []}
+    for i, result in enumerate(results):
+        if i in (3, 4, 5):
+            continue
+        expected_ready = "True" if i % 2 else "False"
+        assert result["status"] == {"kubeflow-pipelines-ready": expected_ready}
+        assert result["children"][0]["metadata"]["namespace"] == f"profile-{i}"
+
+
+@pytest.mark.parametrize(
+    "sync_server",
+    [
+        ENV_IMAGES_WITH_TAGS,
+    ],
+    indirect=["sync_server"]
+)
+def test_sync_server_batch_rejects_non_array(sync_server):
+    server, environ = sync_server
+
+    # server.server_address = (url, port_as_integer)
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}/batch"
+    x = requests.post(url, data=json.dumps(DATA_CORRECT_CHILDREN))
+
+    assert x.status_code == 400
+
+
+DATA_CORRECT_CHILDREN_WITH_LAUNCHER = dict(DATA_CORRECT_CHILDREN,
+                                           children=dict(DATA_CORRECT_CHILDREN["children"],
+                                                         **{"ConfigMap.v1": [1, 1]}))
+
+
+@pytest.mark.parametrize(
+    "sync_server, data, expected_status",
+    [
+        (dict(ENV_IMAGES_WITH_TAGS, KFP_DEFAULT_PIPELINE_ROOT="minio://mlpipeline"),
+         DATA_CORRECT_CHILDREN, {"kubeflow-pipelines-ready": "False"}),
+        (dict(ENV_IMAGES_WITH_TAGS, KFP_DEFAULT_PIPELINE_ROOT="minio://mlpipeline"),
+         DATA_CORRECT_CHILDREN_WITH_LAUNCHER, {"kubeflow-pipelines-ready": "True"}),
+        (dict(ENV_IMAGES_WITH_TAGS, CONTROLLER_VARIANT="tekton"),
+         DATA_CORRECT_CHILDREN, {"kubeflow-pipelines-ready": "True"}),
+    ],
+    indirect=["sync_server"]
+)
+def test_sync_server_readiness_from_registry(sync_server, data, expected_status):
+    """
+    Tests that readiness expects as many observed children of each kind as the
+    registry of the controller variant desires
+    """
+    server, environ = sync_server
+
+    # server.server_address = (url, port_as_integer)
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}"
+    x = requests.post(url, data=json.dumps(data))
+    results = json.loads(x.text)
+
+    assert results['status'] == expected_status
+
+
+def test_controller_variant_overrides_registry():
+    """
+    Tests that a variant entry replaces the registry entry of the same name and that
+    new entries are added after the registry
+    """
+    replacement = sync.ChildResource(
+        "ConfigMap/metadata-grpc-configmap", "ConfigMap.v1",
+        lambda namespace, settings: {"kind": "ConfigMap", "metadata": {"name": "replaced", "namespace": namespace}})
+    addition = sync.ChildResource(
+        "ConfigMap/extra", "ConfigMap.v1",
+        lambda namespace, settings: {"kind": "ConfigMap", "metadata": {"name": "extra", "namespace": namespace}})
+
+    with mock.patch.dict(sync.CONTROLLER_VARIANTS, {"test": (replacement, addition)}):
+        children = desired_children("myName", "vis", "1", "frontend", "1", False, "a", "s",
+                                    controller_variant="test")
+
+    names = [child["metadata"]["name"] for child in children]
+    assert names[0] == "replaced"
+    assert names[-2:] == ["mlpipeline-minio-artifact", "extra"]
+    assert len(names) == 9
+
+
+def test_get_settings_from_env_rejects_unknown_controller_variant():
+    with mock.patch.dict(os.environ, dict(ENV_KFP_VERSION_ONLY, CONTROLLER_VARIANT="airflow")):
+        with pytest.raises(ValueError):
+            get_settings_from_env()
+
+
+def test_get_settings_from_env_rejects_invalid_server_processes():
+    with mock.patch.dict(os.environ, dict(ENV_KFP_VERSION_ONLY, SERVER_PROCESSES="0")):
+        with pytest.raises(ValueError):
+            get_settings_from_env()
+
+
+def test_prefork_server_restarts_and_stops_gracefully():
+    """
+    Tests that pre-forked workers keep serving across a SIGHUP restart and that
+    SIGTERM stops the supervisor and its workers cleanly
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    environ = dict(os.environ, **dict(ENV_THREADED, CONTROLLER_PORT=str(port), SERVER_PROCESSES="2"))
+    supervisor = subprocess.Popen([sys.executable, sync.__file__], env=environ,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(50):
+            try:
+                requests.get(f"{url}/healthz", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+
+        for sig in (None, signal.SIGHUP):
+            if sig is not None:
+                supervisor.send_signal(sig)
+            for _ in range(4):
+                results = requests.post(url, data=json.dumps(DATA_CORRECT_CHILDREN), timeout=5).json()
+                assert results['status'] == {"kubeflow-pipelines-ready": "True"}
+
+        supervisor.send_signal(signal.SIGTERM)
+        assert supervisor.wait(timeout=10) == 0
+    finally:
+        if supervisor.poll() is None:
+            supervisor.kill()
+
+
+def test_prefork_worker_stops_heartbeating_when_retired():
+    """
+    Tests that a retiring worker no longer heartbeats for its slot, which already belongs
+    to its replacement after a restart, while it finishes its in-flight requests
+    """
+    class DrainingServer:
+        server_address = ("127.0.0.1", 0)
+
+        def service_actions(self):
+            pass
+
+        def serve_forever(self):
+            # Keeps draining until killed, as a worker stuck on its last requests
+            while True:
+                self.service_actions()
+                time.sleep(0.01)
+
+        def shutdown(self):
+            pass
+
+    supervisor = sync.PreforkSupervisor(DrainingServer(), 1)
+    supervisor.spawn(0)
+    pid = supervisor.workers[0]
+    try:
+        started = supervisor.heartbeats[0]
+        for _ in range(100):
+            if supervisor.heartbeats[0] > started:
+                break
+            time.sleep(0.01)
+        assert supervisor.heartbeats[0] > started
+
+        os.kill(pid, signal.SIGTERM)
+        time.sleep(0.2)
+        retired = supervisor.heartbeats[0]
+        time.sleep(0.2)
+        assert supervisor.heartbeats[0] == retired
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+def test_get_settings_from_env_is_read_only():
+    with mock.patch.dict(os.environ, ENV_KFP_VERSION_ONLY):
+        settings = get_settings_from_env()
+
+    with pytest.raises(TypeError):
+        settings["minio_secret_key"] = "changed"
+
+
+def test_sync_server_reloads_mounted_credentials(tmp_path):
+    """
+    Tests that credentials mounted from the Secret take precedence over the environment
+    and that rotating them updates the desired Secret without a restart
+    """
+    (tmp_path / "accesskey").write_bytes(b"mounted-access")
+    (tmp_path / "secretkey").write_bytes(b"mounted-secret")
+    environ = dict(ENV_THREADED, MINIO_CREDENTIALS_DIR=str(tmp_path), CREDENTIALS_RELOAD_INTERVAL="0.01")
+    with mock.patch.dict(os.environ, environ):
+        settings = get_settings_from_env()
+    server = server_factory(**settings)
+    server_thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+    server_thread.daemon = True
+    server_thread.start()
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}"
+
+    def desired_secret():
+        results = requests.post(url, data=json.dumps(DATA_CORRECT_CHILDREN)).json()
+        return results["children"][-1]["data"]
+
+    assert desired_secret() == {
+        "accesskey": base64.b64encode(b"mounted-access").decode("utf-8"),
+        "secretkey": base64.b64encode(b"mounted-secret").decode("utf-8"),
+    }
+
+    (tmp_path / "secretkey").write_bytes(b"rotated-secret-key")
+    for _ in range(100):
+        if server.metrics.credentials_reloads.values:
+            break
+        time.sleep(0.02)
+
+    assert desired_secret()["secretkey"] == base64.b64encode(b"rotated-secret-key").decode("utf-8")
+    assert server.response_cache.stats()["size"] == 1
+    server.shutdown()
+
+
+def test_sync_server_convergence_check():
+    """
+    Tests that observed children matching the desired ones count as converged, that a
+    changed child is reported as drifted, and that unchanged resourceVersions reuse the
+    previous comparison
+    """
+    environ = dict(ENV_THREADED, CONVERGENCE_CHECK="true")
+    with mock.patch.dict(os.environ, environ):
+        settings = get_settings_from_env()
+    server = server_factory(**settings)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}"
+
+    namespace = "myName"
+    children = {}
+    for resource in desired_children(namespace, **{key: settings[key] for key in (
+            "visualization_server_image", "visualization_server_tag", "frontend_image", "frontend_tag",
+            "disable_istio_sidecar", "minio_access_key", "minio_secret_key")}):
+        # Fields the API server adds must not count as drift
+        resource["metadata"].update(resourceVersion="1", uid="uid-" + resource["metadata"]["name"])
+        resource["status"] = {"observedGeneration": 1}
+        children.setdefault(f"{resource['kind']}.{resource['apiVersion']}", {})[
+            resource["metadata"]["name"]] = resource
+    observation = {"parent": DATA_CORRECT_CHILDREN["parent"], "children": children}
+
+    for _ in range(2):
+        results = requests.post(url, data=json.dumps(observation)).json()
+        assert results["status"] == {"kubeflow-pipelines-ready": "True"}
+        assert len(results["children"]) == 8
+
+    deployment = children["Deployment.apps/v1"]["ml-pipeline-ui-artifact"]
+    deployment["spec"]["template"]["spec"]["containers"][0]["image"] = "someone/else:latest"
+    deployment["metadata"]["resourceVersion"] = "2"
+    results = requests.post(url, data=json.dumps(observation)).json()
+    assert len(results["children"]) == 8
+
+    metrics = server.metrics
+    assert metrics.namespaces_converged.values == {"true": 2, "false": 1}
+    assert metrics.children_drifted.values == {"Deployment/ml-pipeline-ui-artifact": 1}
+    assert metrics.fingerprint_checks.values == {"computed": 9, "cached": 15}
+    server.shutdown()
+
+
+def test_sync_server_convergence_check_ignores_dropped_empty_maps():
+    """
+    Tests that children converge when the API server dropped the empty annotations of
+    their desired state, as it does for the default DISABLE_ISTIO_SIDECAR=false
+    """
+    environ = dict(ENV_THREADED, CONVERGENCE_CHECK="true", DISABLE_ISTIO_SIDECAR="false")
+    with mock.patch.dict(os.environ, environ):
+        settings = get_settings_from_env()
+    server = server_factory(**settings)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    url = f"http://{server.server_address[0]}:{str(server.server_address[1])}"
+
+    children = {}
+    dropped = 0
+    for resource in desired_children("myName", **{key: settings[key] for key in (
+            "visualization_server_image", "visualization_server_tag", "frontend_image", "frontend_tag",
+            "disable_istio_sidecar", "minio_access_key", "minio_secret_key")}):
+        template_metadata = resource.get("spec", {}).get("template", {}).get("metadata", {})
+        if template_metadata.get("annotations") == {}:
+            del template_metadata["annotations"]
+            dropped += 1
+        children.setdefault(f"{resource['kind']}.{resource['apiVersion']}", {})[
+            resource["metadata"]["name"]] = resource
+    assert dropped == 2
+
+    results = requests.post(url, data=json.dumps(
+        {"parent": DATA_CORRECT_CHILDREN["parent"], "children": children})).json()
+    assert len(results["children"]) == 8
+
+    assert server.metrics.namespaces_converged.values == {"true": 1}
+    assert server.metrics.children_drifted.values == {}
+    server.shutdown()
+
+
+@pytest.mark.parametrize(
+    "params, expected_regressions",
+    [
+        ({}, [("namespaces=100,pipeline_root=off", "requests_per_sec", 1000.0, 700.0)]),
+        ({"namespaces": [100, 1000], "pipeline_root": "both"},
+         [("namespaces=100,pipeline_root=off", "requests_per_sec", 1000.0, 700.0)]),
+        ({"child_size": 8192}, None),
+        ({"seed": 1, "rounds": 5}, None),
+    ]
+)
+def test_bench_compare_reports(params, expected_regressions):
+    """
+    Tests that replay reports are only compared when they replayed the same traffic
+    """
+    import bench_sync
+    baseline_params = {"namespaces": [100], "enabled_fraction": 0.8, "ready_fraction": 0.9,
+                       "child_size": 2048, "pipeline_root": "off", "rounds": 3, "clients": 8, "seed": 0}
+    scenario = {"name": "namespaces=100,pipeline_root=off", "requests_per_sec": 1000.0, "p99_ms": 2.0}
+    baseline = {"params": baseline_params, "scenarios": [scenario]}
+    report = {"params": dict(baseline_params, **params),
+              "scenarios": [dict(scenario, requests_per_sec=700.0)]}
+
+    if expected_regressions is None:
+        with pytest.raises(ValueError, match="different parameters"):
+            bench_sync.compare_reports(baseline, report, 0.2)
+    else:
+        assert bench_sync.compare_reports(baseline, report, 0.2) == expected_regressions
@@ -0,0 +1,131 @@
+"""Benchmark of the images list merging of extract_images.py
+
+Collects the container images of every kustomization of a manifests tree,
+then times adding them to the images list of their kustomization:
+
+  linear: every image string is parsed and merged with a scan of the list,
+    as extract_images.py did before the ImageRegistry.
+  indexed: every unique image string is parsed once and merged through an
+    ImageRegistry, as scan_kustomization_for_images does.
+
+The tree is only read, kustomization.yaml files are not rewritten. As the
+kustomizations of manifests/ only have a few images each, --synthetic adds
+one kustomization with that many distinct images, each found three times,
+to show how both merges scale.
+
+Example:
+  $ python bench_extract_images.py ../.. --repeat 5
+  $ python bench_extract_images.py --synthetic 2000
+"""
+
+import argparse
+import copy
+import time
+
+from os import path
+from ruamel.yaml import YAML
+
+import extract_images
+
+
+def image_from_string_uncached(img_str):
+    return dict(zip(("name", "tag", "digest"),
+                    extract_images._parse_image.__wrapped__(img_str)))
+
+
+def append_or_update_linear(img_list, new_img):
+    for img in img_list:
+        if img["name"] == new_img["name"]:
+            img["newName"] = img.get("newName", new_img["name"])
+            if img.get("newTag", new_img["tag"]):
+                img["newTag"] = img.get("newTag", new_img["tag"])
+            if img.get("digest", new_img["digest"]):
+                img["digest"] = img.get("digest", new_img["digest"])
+            return
+    kust_img = {"name": new_img["name"], "newName": new_img["name"]}
+    if new_img["tag"]:
+        kust_img["newTag"] = new_img["tag"]
+    if new_img["digest"]:
+        kust_img["digest"] = new_img["digest"]
+    img_list.append(kust_img)
+
+
+def merge_linear(img_list, img_strs):
+    for img_str in img_strs:
+        append_or_update_linear(img_list, image_from_string_uncached(img_str))
+
+
+def merge_indexed(img_list, img_strs):
+    registry = extract_images.ImageRegistry(img_list)
+    for img_str in dict.fromkeys(img_strs):
+        registry.add(extract_images.image_from_string(img_str))
+
+
+def collect_images(root_dir):
+    """Images list and container image strings of every kustomization"""
+    yaml = YAML()
+    kustomizations = []
+    for kust_dir in extract_images.get_kustomization_dirs(root_dir):
+        with open(path.join(kust_dir, "kustomization.yaml")) as f:
+            img_list = yaml.load(f).get("images", [])
+        img_strs = []
+        for filename in extract_images.resource_filenames(kust_dir):
+            with open(path.join(kust_dir, filename)) as f:
+                for r in yaml.load_all(f):
+                    img_strs.extend(extract_images.container_images(r))
+        kustomizations.append((img_list, img_strs))
+    return kustomizations
+
+
+def measure(merge, kustomizations, repeat):
+    """Best time of merging the images of every kustomization"""
+    best = None
+    for _ in range(repeat):
+        extract_images._parse_image.cache_clear()
+        img_lists = [copy.deepcopy(img_list)
+                     for (img_list, _) in kustomizations]
+        start = time.perf_counter()
+        for img_list, (_, img_strs) in zip(img_lists, kustomizations):
+            merge(img_list, img_strs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, img_lists
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the images list merging of "
+        "extract_images.py")
+    parser.add_argument("root_dir", nargs="?",
+                        default=path.join(path.dirname(__file__), "..", ".."),
+                        help="manifests tree (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of timed runs, the best one is "
+                        "reported (default: %(default)s)")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="number of distinct images of an additional "
+                        "synthetic kustomization (default: %(default)s)")
+    args = parser.parse_args()
+
+    kustomizations = collect_images(args.root_dir)
+    if args.synthetic:
+        img_strs = ["registry.example.com/team/image-{}:v{}".format(i, i % 7)
+                    for i in range(args.synthetic)]
+        kustomizations.append(([], img_strs * 3))
+    found = sum(len(img_strs) for (_, img_strs) in kustomizations)
+    unique = sum(len(set(img_strs)) for (_, img_strs) in kustomizations)
+    print("{} kustomizations, {} container images, {} unique per "
+          "kustomization".format(len(kustomizations), found, unique))
+
+    results = {}
+    for method, merge in (("linear", merge_linear),
+                          ("indexed", merge_indexed)):
+        seconds, img_lists = measure(merge, kustomizations, args.repeat)
+        results[method] = img_lists
+        print("{:<10} {:>9.3f} ms".format(method, seconds * 1000))
+    assert results["linear"] == results["indexed"], \
+        "the merged images lists differ"
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,15 @@
+import argparse
+import json
 import logging as log
+import re
+import sqlite3
+import time
 
-from sys import argv
+from collections.abc import Mapping
+from functools import lru_cache
+from multiprocessing import Pool
+from os import cpu_count, path, remove, walk, getcwd
 from ruamel.yaml import YAML
-from collections import Mapping
-from os import path, walk, getcwd
 
 exclude_dirs = [
     ".github",
@@ -18,10 +24,42 @@ accepted_kinds = [
     "statefulset", "deployment", "daemonSet", "replicaset", "job", "cronjob"
 ]
 
+# Trees the inventory mode walks by default, from the root of the repository
+repo_root = path.abspath(path.join(path.dirname(__file__), "..", "..", ".."))
+inventory_dirs = [
+    path.join(repo_root, "manifests"),
+    path.join(repo_root, "carvel", "bundle", "config"),
+]
+
+# Fields of a pod spec listing containers
+container_fields = ("containers", "initContainers", "ephemeralContainers")
+# Names kustomize reads a kustomization from, which may leave out its kind
+kustomization_filenames = ("kustomization.yaml", "kustomization.yml",
+                           "Kustomization")
+# Kinds whose image keys are schemas, not references: CRDs embedding PodSpec
+schema_kinds = ["customresourcedefinition"]
+
+# Start of a YAML document, the top level kind of a document, and image keys
+# anywhere in a document, matched on the raw bytes of resource files
+document_start_re = re.compile(rb"^---(?=[ \t\r\n]|$)", re.M)
+kind_re = re.compile(rb"^kind:[ \t]*[\"']?([A-Za-z]+)", re.M)
+image_key_re = re.compile(rb"\bimage[\"']?[ \t]*:")
+images_key_re = re.compile(rb"^images[\"']?[ \t]*:", re.M)
+content_re = re.compile(rb"^[ \t]*[^#\s]", re.M)
+
 
 def image_from_string(img_str):
     """Parse a string into an image map"""
 
+    (name, tag, digest) = _parse_image(img_str)
+    img = {"name": name, "tag": tag, "digest": digest}
+    return img
+
+
+@lru_cache(maxsize=None)
+def _parse_image(img_str):
+    """Parse a string into an image (name, tag, digest), once per string"""
+
     tag = ""
     digest = ""
 
@@ -33,26 +71,66 @@ def image_from_string(img_str):
     else:
         name, tag = img_str.rsplit(":", 1)
 
-    img = {"name": name, "tag": tag, "digest": digest}
-    return img
+    return name, tag, digest
 
 
-def append_or_update(img_list, new_img):
-    for img in img_list:
-        if img["name"] == new_img["name"]:
+class ImageRegistry(object):
+    """Images list of a kustomization, indexed by image name
+
+    Entries are updated in place in the list, and new ones appended to it,
+    so a ruamel list loaded from kustomization.yaml keeps its order and
+    comments when it is dumped back.
+    """
+
+    def __init__(self, img_list):
+        self.img_list = img_list
+        self.index = {}
+        for img in img_list:
+            # The first entry of a name is the one updated, like a scan would
+            self.index.setdefault(img["name"], img)
+
+    def add(self, new_img):
+        img = self.index.get(new_img["name"])
+        if img is not None:
             img["newName"] = img.get("newName", new_img["name"])
             if img.get("newTag", new_img["tag"]):
                 img["newTag"] = img.get("newTag", new_img["tag"])
             if img.get("digest", new_img["digest"]):
                 img["digest"] = img.get("digest", new_img["digest"])
             return
-    # Image doesn't exist in transformation list
-    kust_img = {"name": new_img["name"], "newName": new_img["name"]}
-    if new_img["tag"]:
-        kust_img["newTag"] = new_img["tag"]
-    if new_img["digest"]:
-        kust_img["digest"] = new_img["digest"]
-    img_list.append(kust_img)
+        # Image doesn't exist in transformation list
+        kust_img = {"name": new_img["name"], "newName": new_img["name"]}
+        if new_img["tag"]:
+            kust_img["newTag"] = new_img["tag"]
+        if new_img["digest"]:
+            kust_img["digest"] = new_img["digest"]
+        self.img_list.append(kust_img)
+        self.index[new_img["name"]] = kust_img
+
+
+def append_or_update(img_list, new_img):
+    ImageRegistry(img_list).add(new_img)
+
+
+def container_images(resource):
+    """Image strings of the containers of a workload resource
+
+    Args:
+      resource: A resource loaded from YAML.
+
+    Returns:
+      list: The images of the containers, empty if the resource is not a
+        workload of accepted_kinds.
+    """
+    if not isinstance(resource, Mapping):
+        return []
+    if resource.get("kind", "").lower() not in accepted_kinds:
+        return []
+    try:
+        containers = resource["spec"]["template"]["spec"]["containers"]
+    except KeyError:
+        return []
+    return [c["image"] for c in containers if "image" in c]
 
 
 def scan_kustomization_for_images(kust_dir):
@@ -60,10 +138,17 @@ def scan_kustomization_for_images(kust_dir):
 
     Args:
       kust_dir (str): Path where the kustomize application resides.
+
+    Returns:
+      dict: The kustomization directory, the number of images in the
+        kustomization, and the number of resource files and documents
+        scanned and skipped without parsing them.
     """
 
+    # Round trip loader for the kustomization rewrite, keeping its comments
     yaml = YAML()
     yaml.block_seq_indent = 0
+    safe_yaml = YAML(typ="safe")
 
     # Load kustomization
     with open(path.join(kust_dir, "kustomization.yaml")) as f:
@@ -77,37 +162,131 @@ def scan_kustomization_for_images(kust_dir):
     img_list = kustomization.get("images", [])
 
     # Get local resource files
-    (_, _, filenames) = next(walk(kust_dir))
-    filenames = [
-        filename for filename in filenames
-        if filename != "kustomization.yaml" and filename != "params.yaml" and
-        filename.endswith(".yaml")
-    ]
+    filenames = resource_filenames(kust_dir)
 
+    # Unique image strings, in the order they are first found. Adding the
+    # same image string again does not change the images list.
+    img_strs = {}
+    stats = dict.fromkeys(
+        ("files", "files_skipped", "documents", "documents_skipped"), 0)
     for filename in filenames:
-        with open(path.join(kust_dir, filename)) as f:
-            resources = list(yaml.load_all(f))
+        resources = load_candidate_resources(
+            path.join(kust_dir, filename), safe_yaml, stats)
         for r in resources:
-            if not isinstance(r, Mapping):
-                continue
-            if r.get("kind", "").lower() in accepted_kinds:
-                try:
-                    containers = r["spec"]["template"]["spec"]["containers"]
-                except KeyError:
-                    continue
-                for c in containers:
-                    try:
-                        img_str = c["image"]
-                    except KeyError:
-                        continue
-                    new_img = image_from_string(img_str)
-                    append_or_update(img_list, new_img)
+            img_strs.update(dict.fromkeys(container_images(r)))
+
+    registry = ImageRegistry(img_list)
+    for img_str in img_strs:
+        registry.add(image_from_string(img_str))
 
     if img_list:
         kustomization["images"] = img_list
         with open(path.join(kust_dir, "kustomization.yaml"), "w") as f:
             yaml.dump(kustomization, f)
 
+    return dict(stats, dir=kust_dir, images=len(img_list))
+
+
+def split_documents(data):
+    """Split the raw bytes of a YAML stream before each document start"""
+    starts = [m.start() for m in document_start_re.finditer(data)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    documents = [data[a:b] for a, b in zip(starts, starts[1:] + [len(data)])]
+    # Leave out comments and blank lines between documents
+    return [d for d in documents if content_re.search(d)]
+
+
+def is_candidate(document):
+    """Whether the raw bytes of a YAML document may hold workload images
+
+    Only documents with an image key, and a top level kind of
+    accepted_kinds or none found, can give images to container_images.
+    """
+    if not image_key_re.search(document):
+        return False
+    match = kind_re.search(document)
+    return match is None or match.group(1).decode().lower() in accepted_kinds
+
+
+def load_candidate_resources(filename, safe_yaml, stats):
+    """Load the documents of a resource file that may hold workload images
+
+    The file is pre-scanned as bytes, and only the candidate documents are
+    parsed. If one of them can not be parsed on its own, the whole file is.
+
+    Args:
+      filename (str): Path of the resource file.
+      safe_yaml (YAML): Loader to parse documents with.
+      stats (dict): Counts of files and documents, updated with the
+        ones of this file.
+
+    Returns:
+      list: The loaded candidate resources.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    documents = split_documents(data)
+    candidates = [d for d in documents if is_candidate(d)]
+    stats["files"] += 1
+    stats["documents"] += len(documents)
+    stats["documents_skipped"] += len(documents) - len(candidates)
+    if not candidates:
+        stats["files_skipped"] += 1
+        return []
+    try:
+        return [r for d in candidates
+                for r in safe_yaml.load_all(d.decode("utf-8"))]
+    except Exception as e:
+        log.debug("Loading the whole of %s: %s", filename, e)
+        stats["documents_skipped"] -= len(documents) - len(candidates)
+        return list(safe_yaml.load_all(data.decode("utf-8")))
+
+
+def resource_filenames(kust_dir):
+    """Names of the resource YAML files of a kustomization folder"""
+    (_, _, filenames) = next(walk(kust_dir))
+    return [
+        filename for filename in filenames
+        if filename != "kustomization.yaml" and filename != "params.yaml" and
+        filename.endswith(".yaml")
+    ]
+
+
+def scan_kustomizations(kust_dirs, jobs=1):
+    """Scan kustomization folders, in a pool of processes if jobs > 1
+
+    Every folder only rewrites its own kustomization.yaml, so they can be
+    scanned in any order: the largest ones are scanned first, so that a big
+    folder does not end up alone in the last job. Results are returned in
+    the order of kust_dirs, whatever the number of jobs.
+
+    Args:
+      kust_dirs (list): Paths where the kustomize applications reside.
+      jobs (int): Number of processes scanning folders at the same time.
+
+    Returns:
+      list: The result of scan_kustomization_for_images for every folder.
+    """
+    if jobs <= 1 or len(kust_dirs) <= 1:
+        return [scan_kustomization_for_images(d) for d in kust_dirs]
+    order = sorted(range(len(kust_dirs)),
+                   key=lambda i: yaml_size(kust_dirs[i]), reverse=True)
+    results = [None] * len(kust_dirs)
+    with Pool(min(jobs, len(kust_dirs))) as pool:
+        scanned = pool.imap(scan_kustomization_for_images,
+                            [kust_dirs[i] for i in order])
+        for i, result in zip(order, scanned):
+            results[i] = result
+    return results
+
+
+def yaml_size(kust_dir):
+    """Total size of the YAML files of a kustomization folder"""
+    (curr, _, filenames) = next(walk(kust_dir))
+    return sum(path.getsize(path.join(curr, filename))
+               for filename in filenames if filename.endswith(".yaml"))
+
 
 def check_kustomize_dir(d):
     (curr, folders, _) = next(walk(d))
@@ -137,6 +316,288 @@ def get_kustomization_dirs(root):
     return res
 
 
+def unique_kustomization_dirs(root_dirs):
+    """Kustomization folders under root_dirs, each once, in the order found
+
+    Overlapping root dirs would otherwise give the same folder to two jobs,
+    both rewriting its kustomization.yaml at the same time.
+
+    Args:
+      root_dirs (list): Directories to look for kustomizations in.
+
+    Returns:
+      list: The paths of the kustomization folders.
+    """
+    kust_dirs = {}
+    for root_dir in root_dirs:
+        for d in get_kustomization_dirs(root_dir):
+            kust_dirs.setdefault(path.realpath(d), d)
+    return list(kust_dirs.values())
+
+
+def parse_image_reference(img_str):
+    """Parse an image reference into its name, tag and digest
+
+    Unlike image_from_string, the tag of a reference with a digest is kept,
+    and a registry port is not taken for a tag. A reference with neither a
+    tag nor a digest has the latest tag.
+    """
+    (rest, _, digest) = img_str.partition("@")
+    (name, tag) = (rest, "")
+    if ":" in rest.rsplit("/", 1)[-1]:
+        (name, tag) = rest.rsplit(":", 1)
+    if not tag and not digest:
+        tag = "latest"
+    return {"name": name, "tag": tag, "digest": digest}
+
+
+def image_references(resource, kustomization=False):
+    """Images referenced by a resource, whatever its kind
+
+    Containers are looked for in every pod spec nested in the resource, so
+    custom resources embedding pod templates are covered too. The images
+    transformations of a Kustomization are references as well.
+
+    Args:
+      resource: A resource loaded from YAML.
+      kustomization (bool): Whether the resource was read from a
+        kustomization file, a Kustomization even without a kind.
+
+    Returns:
+      list: The (container name, image string) of every reference, with
+        the images field for Kustomization images.
+    """
+    refs = []
+
+    def find_containers(node):
+        if isinstance(node, Mapping):
+            for key, value in node.items():
+                if key in container_fields and isinstance(value, list):
+                    refs.extend(
+                        (str(c.get("name", "")), c["image"]) for c in value
+                        if isinstance(c, Mapping) and
+                        isinstance(c.get("image"), str))
+                else:
+                    find_containers(value)
+        elif isinstance(node, list):
+            for item in node:
+                find_containers(item)
+
+    if not isinstance(resource, Mapping):
+        return refs
+    if resource.get("kind", "Kustomization" if kustomization else None) \
+            == "Kustomization":
+        for img in resource.get("images") or []:
+            if not isinstance(img, Mapping) or "name" not in img:
+                continue
+            img_str = str(img.get("newName", img["name"]))
+            if img.get("newTag"):
+                img_str += ":" + str(img["newTag"])
+            if img.get("digest"):
+                img_str += "@" + str(img["digest"])
+            refs.append(("images", img_str))
+        return refs
+    find_containers(resource)
+    return refs
+
+
+def is_schema(document):
+    """Whether the raw bytes of a YAML document are of a kind of schema_kinds"""
+    match = kind_re.search(document)
+    return match is not None and \
+        match.group(1).decode().lower() in schema_kinds
+
+
+def inventory_file(filename):
+    """Image references of a YAML file, read only
+
+    Args:
+      filename (str): Path of the YAML file.
+
+    Returns:
+      dict: The usages of the file, as (image string, kind, resource name,
+        container) tuples, and its counts of documents parsed and skipped
+        and of errors.
+    """
+    result = {"file": filename, "usages": [], "documents": 0,
+              "documents_skipped": 0, "errors": 0}
+    with open(filename, "rb") as f:
+        data = f.read()
+    documents = split_documents(data)
+    kustomization = path.basename(filename) in kustomization_filenames
+    candidates = [d for d in documents
+                  if (image_key_re.search(d) or images_key_re.search(d))
+                  and not is_schema(d)]
+    result["documents"] = len(documents)
+    result["documents_skipped"] = len(documents) - len(candidates)
+    safe_yaml = YAML(typ="safe")
+    for document in candidates:
+        try:
+            resources = list(safe_yaml.load_all(document.decode("utf-8")))
+        except Exception as e:
+            # Templated files, such as Helm charts, are not valid YAML
+            log.debug("Skipping a document of %s: %s", filename, e)
+            result["errors"] += 1
+            continue
+        for r in resources:
+            if not isinstance(r, Mapping):
+                continue
+            metadata = r.get("metadata")
+            name = metadata.get("name", "") \
+                if isinstance(metadata, Mapping) else ""
+            kind = str(r.get("kind",
+                             "Kustomization" if kustomization else ""))
+            for (container, img_str) in image_references(r, kustomization):
+                result["usages"].append((img_str, kind, str(name), container))
+    return result
+
+
+def yaml_filenames(root_dirs):
+    """Paths of every YAML file under root_dirs, sorted"""
+    return sorted(
+        path.join(curr, filename)
+        for root_dir in root_dirs
+        for (curr, _, filenames) in walk(root_dir)
+        for filename in filenames
+        if filename.endswith((".yaml", ".yml")))
+
+
+def build_inventory(root_dirs, jobs=1):
+    """Deduplicated index of the images referenced under root_dirs
+
+    Args:
+      root_dirs (list): Directories to walk, no file is modified.
+      jobs (int): Number of processes reading files at the same time.
+
+    Returns:
+      (list, dict): The images, sorted by reference, each with its name,
+        tag, digest and usages, and the counts of files and documents.
+    """
+    filenames = yaml_filenames(root_dirs)
+    if jobs <= 1 or len(filenames) <= 1:
+        results = [inventory_file(filename) for filename in filenames]
+    else:
+        with Pool(min(jobs, len(filenames))) as pool:
+            results = pool.map(inventory_file, filenames, chunksize=32)
+
+    images = {}
+    for result in results:
+        relpath = path.relpath(result["file"], repo_root)
+        for (img_str, kind, name, container) in result["usages"]:
+            if img_str not in images:
+                images[img_str] = dict(parse_image_reference(img_str),
+                                       image=img_str, usages=[])
+            images[img_str]["usages"].append(
+                {"file": relpath, "kind": kind, "resource": name,
+                 "container": container})
+    totals = {key: sum(r[key] for r in results)
+              for key in ("documents", "documents_skipped", "errors")}
+    totals["files"] = len(results)
+    return [images[img_str] for img_str in sorted(images)], totals
+
+
+def write_inventory_jsonl(images, output):
+    """Write one JSON object per image, with its usages"""
+    with open(output, "w") as f:
+        for img in images:
+            f.write(json.dumps(img, sort_keys=True,
+                               separators=(",", ":")) + "\n")
+
+
+def write_inventory_sqlite(images, output):
+    """Write the images and their usages to two tables of a SQLite file
+
+    Example:
+      SELECT image, count(*) FROM images JOIN usages ON id = image_id
+      GROUP BY image ORDER BY 2 DESC;
+    """
+    if path.exists(output):
+        remove(output)
+    db = sqlite3.connect(output)
+    try:
+        db.executescript("""
+            CREATE TABLE images (
+                id INTEGER PRIMARY KEY, image TEXT UNIQUE NOT NULL,
+                name TEXT NOT NULL, tag TEXT NOT NULL, digest TEXT NOT NULL);
+            CREATE TABLE usages (
+                image_id INTEGER NOT NULL REFERENCES images(id),
+                file TEXT NOT NULL, kind TEXT NOT NULL,
+                resource TEXT NOT NULL, container TEXT NOT NULL);
+            CREATE INDEX images_name ON images(name);
+            CREATE INDEX usages_image_id ON usages(image_id);
+        """)
+        for (image_id, img) in enumerate(images, 1):
+            db.execute("INSERT INTO images VALUES (?, ?, ?, ?, ?)",
+                       (image_id, img["image"], img["name"], img["tag"],
+                        img["digest"]))
+            db.executemany(
+                "INSERT INTO usages VALUES (?, ?, ?, ?, ?)",
+                [(image_id, u["file"], u["kind"], u["resource"],
+                  u["container"]) for u in img["usages"]])
+        db.commit()
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add the images of the workloads of every kustomization "
+        "to its images list, or with --inventory write an index of every "
+        "image referenced, without modifying any file")
+    parser.add_argument("root_dirs", nargs="*",
+                        help="directories to look for kustomizations in "
+                        "(default: the current directory), or to walk with "
+                        "--inventory (default: manifests/ and "
+                        "carvel/bundle/config/)")
+    parser.add_argument("-j", "--jobs", type=int, default=cpu_count() or 1,
+                        help="number of kustomizations, or files with "
+                        "--inventory, read at the same time (default: the "
+                        "number of CPUs)")
+    parser.add_argument("--inventory", metavar="OUTPUT",
+                        help="write the deduplicated index of every image "
+                        "referenced to OUTPUT instead of updating the "
+                        "kustomizations")
+    parser.add_argument("--format", choices=("jsonl", "sqlite"),
+                        default="jsonl",
+                        help="format of the inventory: one JSON object per "
+                        "image, or images and usages tables of a SQLite "
+                        "file (default: %(default)s)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.inventory:
+        (images, totals) = build_inventory(args.root_dirs or inventory_dirs,
+                                           args.jobs)
+        if args.format == "sqlite":
+            write_inventory_sqlite(images, args.inventory)
+        else:
+            write_inventory_jsonl(images, args.inventory)
+        elapsed = time.perf_counter() - start
+        log.info("Indexed %d images used %d times in %d files into %s "
+                 "in %.2fs (%.1f files/sec, %d jobs)", len(images),
+                 sum(len(img["usages"]) for img in images), totals["files"],
+                 args.inventory, elapsed,
+                 totals["files"] / elapsed if elapsed else 0, args.jobs)
+        log.info("Skipped %d of %d documents without image keys or of "
+                 "schema kinds, %d could not be parsed", totals["documents_skipped"],
+                 totals["documents"], totals["errors"])
+        return
+
+    kust_dirs = unique_kustomization_dirs(args.root_dirs or [getcwd()])
+    results = scan_kustomizations(kust_dirs, args.jobs)
+    elapsed = time.perf_counter() - start
+    totals = {key: sum(r[key] for r in results)
+              for key in ("files", "files_skipped",
+                          "documents", "documents_skipped")}
+    log.info("Scanned %d files of %d kustomizations in %.2fs "
+             "(%.1f files/sec, %d jobs)", totals["files"], len(results),
+             elapsed, totals["files"] / elapsed if elapsed else 0, args.jobs)
+    log.info("Skipped %d of %d files and %d of %d documents without "
+             "workload images before parsing them", totals["files_skipped"],
+             totals["files"], totals["documents_skipped"],
+             totals["documents"])
+
+
 if __name__ == "__main__":
     log.basicConfig(
         level=log.INFO,
@@ -146,6 +607,4 @@ if __name__ == "__main__":
     )
     log.getLogger().setLevel(log.INFO)
 
-    root_dir = getcwd() if len(argv) < 2 else argv[1]
-    for d in get_kustomization_dirs(root_dir):
-        scan_kustomization_for_images(d)
\ No newline at end of file
+    main()
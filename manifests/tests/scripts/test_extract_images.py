@@ -0,0 +1,337 @@
+import json
+from os import path
+
+import pytest
+
+import extract_images
+
+KUSTOMIZATION = """\
+apiVersion: kustomize.config.k8s.io/v1beta1
+{kind}resources:
+- deployment.yaml
+images:
+- name: gcr.io/foo/bar
+  newName: registry.local/foo/bar
+  newTag: v1.2.3
+"""
+
+DEPLOYMENT = """\
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: bar
+spec:
+  template:
+    spec:
+      initContainers:
+      - name: init
+        image: gcr.io/foo/init@sha256:0123
+      containers:
+      - name: bar
+        image: gcr.io/foo/bar:v1
+---
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: bar-config
+"""
+
+
+@pytest.mark.parametrize("kind", ["", "kind: Kustomization\n"])
+def test_inventory_indexes_kustomization_images(tmp_path, kind):
+    """
+    Tests that the images a kustomization rewrites to are indexed next to the
+    images of the workloads, with and without a kind in the kustomization
+    """
+    (tmp_path / "kustomization.yaml").write_text(KUSTOMIZATION.format(kind=kind))
+    (tmp_path / "deployment.yaml").write_text(DEPLOYMENT)
+
+    (images, totals) = extract_images.build_inventory([str(tmp_path)])
+
+    by_image = {img["image"]: img for img in images}
+    assert sorted(by_image) == ["gcr.io/foo/bar:v1", "gcr.io/foo/init@sha256:0123",
+                                "registry.local/foo/bar:v1.2.3"]
+    rewritten = by_image["registry.local/foo/bar:v1.2.3"]
+    assert (rewritten["name"], rewritten["tag"], rewritten["digest"]) == ("registry.local/foo/bar", "v1.2.3", "")
+    assert [(u["kind"], u["container"]) for u in rewritten["usages"]] == [("Kustomization", "images")]
+    assert [(u["kind"], u["resource"], u["container"]) for u in by_image["gcr.io/foo/bar:v1"]["usages"]] == [
+        ("Deployment", "bar", "bar")]
+    assert totals == {"files": 2, "documents": 3, "documents_skipped": 1, "errors": 0}
+
+
+def test_inventory_output_formats(tmp_path):
+    (tmp_path / "kustomization.yaml").write_text(KUSTOMIZATION.format(kind=""))
+    (tmp_path / "deployment.yaml").write_text(DEPLOYMENT)
+    (images, _) = extract_images.build_inventory([str(tmp_path)])
+
+    extract_images.write_inventory_jsonl(images, str(tmp_path / "images.jsonl"))
+    with open(str(tmp_path / "images.jsonl")) as f:
+        assert [json.loads(line) for line in f] == images
+
+    extract_images.write_inventory_sqlite(images, str(tmp_path / "images.db"))
+    db = extract_images.sqlite3.connect(str(tmp_path / "images.db"))
+    assert db.execute("SELECT image, kind FROM images JOIN usages ON id = image_id "
+                      "ORDER BY image").fetchall() == [
+        ("gcr.io/foo/bar:v1", "Deployment"), ("gcr.io/foo/init@sha256:0123", "Deployment"),
+        ("registry.local/foo/bar:v1.2.3", "Kustomization")]
+    db.close()
+
+
+@pytest.mark.parametrize(
+    "img_str, expected",
+    [
+        ("nginx", ("nginx", "latest", "")),
+        ("localhost:5000/nginx", ("localhost:5000/nginx", "latest", "")),
+        ("localhost:5000/nginx:1.21", ("localhost:5000/nginx", "1.21", "")),
+        ("gcr.io/a/b:v1@sha256:00", ("gcr.io/a/b", "v1", "sha256:00")),
+        ("gcr.io/a/b@sha256:00", ("gcr.io/a/b", "", "sha256:00")),
+    ]
+)
+def test_parse_image_reference(img_str, expected):
+    img = extract_images.parse_image_reference(img_str)
+    assert (img["name"], img["tag"], img["digest"]) == expected
+
+
+def write_files(root, files):
+    for (relpath, content) in files.items():
+        filename = root / relpath
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        filename.write_text(content)
+
+
+def deployment(name, *images):
+    containers = "".join("      - name: c{}\n        image: {}\n".format(i, img) for (i, img) in enumerate(images))
+    return ("apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: {}\n"
+            "spec:\n  template:\n    spec:\n      containers:\n{}").format(name, containers)
+
+
+SCAN_TREE = {
+    "apps/first/base/kustomization.yaml": "resources:\n- deployment.yaml\n",
+    "apps/first/base/deployment.yaml": deployment("first", "gcr.io/a/first:v1", "gcr.io/a/sidecar:v2"),
+    "apps/second/base/kustomization.yaml": "resources:\n- deployment.yaml\n",
+    "apps/second/base/deployment.yaml": deployment("second", "gcr.io/a/second@sha256:00"),
+    "apps/second/overlays/prod/kustomization.yaml": "resources:\n- ../../base\n- deployment.yaml\n",
+    "apps/second/overlays/prod/deployment.yaml": deployment("extra", "gcr.io/a/extra"),
+    "third/base/kustomization.yaml": "resources:\n- deployment.yaml\n",
+    "third/base/deployment.yaml": deployment("third", "gcr.io/a/third:v3", "gcr.io/a/first:v1"),
+}
+
+
+def test_unique_kustomization_dirs(tmp_path):
+    """
+    Tests that overlapping root dirs give every kustomization folder once, in the order found
+    """
+    write_files(tmp_path, SCAN_TREE)
+    root = str(tmp_path)
+    kust_dirs = extract_images.unique_kustomization_dirs(
+        [root + "/apps", root, root + "/apps/../apps/second", root])
+    assert [path.relpath(d, root) for d in kust_dirs] == [
+        "apps/first/base", "apps/second/base", "apps/second/overlays/prod", "third/base"]
+
+
+def test_scan_kustomizations_in_parallel(tmp_path):
+    """
+    Tests that scanning with several jobs gives the results and rewrites of a serial scan
+    """
+    results = {}
+    kustomizations = {}
+    for jobs in (1, 4):
+        root = tmp_path / "jobs-{}".format(jobs)
+        write_files(root, SCAN_TREE)
+        kust_dirs = extract_images.unique_kustomization_dirs([str(root / "apps"), str(root)])
+        results[jobs] = [dict(r, dir=path.relpath(r["dir"], str(root)))
+                         for r in extract_images.scan_kustomizations(kust_dirs, jobs)]
+        kustomizations[jobs] = {relpath: (root / relpath).read_text()
+                                for relpath in SCAN_TREE if relpath.endswith("kustomization.yaml")}
+
+    assert results[4] == results[1]
+    assert [(r["dir"], r["images"]) for r in results[1]] == [
+        ("apps/first/base", 2), ("apps/second/base", 1), ("apps/second/overlays/prod", 1), ("third/base", 2)]
+    assert kustomizations[4] == kustomizations[1]
+
+
+def test_image_registry_updates_the_first_entry_of_a_name():
+    img_list = [{"name": "gcr.io/a/b", "newName": "mirror/b"}, {"name": "gcr.io/a/b", "newTag": "v0"}]
+    registry = extract_images.ImageRegistry(img_list)
+    registry.add(extract_images.image_from_string("gcr.io/a/b:v1"))
+    registry.add(extract_images.image_from_string("gcr.io/a/b@sha256:00"))
+
+    assert img_list == [{"name": "gcr.io/a/b", "newName": "mirror/b", "newTag": "v1", "digest": "sha256:00"},
+                        {"name": "gcr.io/a/b", "newTag": "v0"}]
+
+
+def test_image_registry_appends_new_images_in_order():
+    img_list = [{"name": "gcr.io/a/kept", "newTag": "v0"}]
+    registry = extract_images.ImageRegistry(img_list)
+    for img_str in ("gcr.io/a/z:v1", "gcr.io/a/kept:v9", "gcr.io/a/a", "gcr.io/a/z:v2", "gcr.io/a/m@sha256:00"):
+        registry.add(extract_images.image_from_string(img_str))
+
+    assert img_list == [
+        {"name": "gcr.io/a/kept", "newName": "gcr.io/a/kept", "newTag": "v0"},
+        {"name": "gcr.io/a/z", "newName": "gcr.io/a/z", "newTag": "v1"},
+        {"name": "gcr.io/a/a", "newName": "gcr.io/a/a", "newTag": "latest"},
+        {"name": "gcr.io/a/m", "newName": "gcr.io/a/m", "digest": "sha256:00"},
+    ]
+
+
+def test_scan_kustomization_keeps_comments_and_order(tmp_path):
+    """
+    Tests that the images list of a kustomization is updated in place, keeping its comments
+    and order, with the new images appended in the order they were found
+    """
+    write_files(tmp_path, {
+        "kustomization.yaml": (
+            "# Sample application\n"
+            "resources:\n"
+            "- deployment.yaml\n"
+            "images:\n"
+            "# Mirrored\n"
+            "- name: gcr.io/a/second\n"
+            "  newName: mirror.local/a/second  # pinned by the release\n"
+            "- name: gcr.io/a/first\n"
+            "  newTag: v0\n"),
+        "deployment.yaml": deployment("sample", "gcr.io/a/new:v1", "gcr.io/a/first:v1", "gcr.io/a/second:v2",
+                                      "gcr.io/a/other@sha256:00", "gcr.io/a/new:v1"),
+    })
+
+    result = extract_images.scan_kustomization_for_images(str(tmp_path))
+
+    assert result["images"] == 4
+    assert (tmp_path / "kustomization.yaml").read_text() == (
+        "# Sample application\n"
+        "resources:\n"
+        "- deployment.yaml\n"
+        "images:\n"
+        "# Mirrored\n"
+        "- name: gcr.io/a/second\n"
+        "  newName: mirror.local/a/second  # pinned by the release\n"
+        "  newTag: v2\n"
+        "- name: gcr.io/a/first\n"
+        "  newTag: v0\n"
+        "  newName: gcr.io/a/first\n"
+        "- name: gcr.io/a/new\n"
+        "  newName: gcr.io/a/new\n"
+        "  newTag: v1\n"
+        "- name: gcr.io/a/other\n"
+        "  newName: gcr.io/a/other\n"
+        "  digest: sha256:00\n")
+
+
+@pytest.mark.parametrize(
+    "document, expected",
+    [
+        (b"apiVersion: v1\nkind: ConfigMap\ndata:\n  image: gcr.io/a/b\n", False),
+        (b"apiVersion: apiextensions.k8s.io/v1\nkind: CustomResourceDefinition\nspec:\n"
+         b"  properties:\n    image:\n      type: string\n", False),
+        (b"apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: a\n", False),
+        (b"kind: \"Deployment\"\nspec:\n  image: x\n", True),
+        (b"kind: 'StatefulSet'\nspec:\n  image: x\n", True),
+        (b"{kind: Deployment, spec: {template: {spec: {containers: [{image: x}]}}}}\n", True),
+        (b"{\"kind\": \"ConfigMap\", \"spec\": {\"image\": \"x\"}}\n", True),
+        (b"kind: Job\nspec:\n  template:\n    spec:\n      initContainers:\n      - image : x\n", True),
+    ]
+)
+def test_is_candidate(document, expected):
+    assert extract_images.is_candidate(document) == expected
+
+
+@pytest.mark.parametrize(
+    "data, expected",
+    [
+        (b"a: 1\n", [b"a: 1\n"]),
+        (b"# leading comment\n---\na: 1\n--- \nb: 2\n", [b"---\na: 1\n", b"--- \nb: 2\n"]),
+        (b"---\n# only a comment\n---\n\n--- {a: 1}\n---a: 1\n", [b"---\n# only a comment\n", b"---\n\n",
+                                                                  b"--- {a: 1}\n---a: 1\n"]),
+        (b"data: |\n  ---\n  text\n---\r\nb: 2\n", [b"data: |\n  ---\n  text\n", b"---\r\nb: 2\n"]),
+    ]
+)
+def test_split_documents(data, expected):
+    assert extract_images.split_documents(data) == expected
+
+
+TRICKY_RESOURCES = """\
+# Comments before the first document
+---
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: config
+data:
+  image: gcr.io/a/not-a-container
+---
+apiVersion: apiextensions.k8s.io/v1
+kind: CustomResourceDefinition
+metadata:
+  name: samples.example.com
+spec:
+  versions:
+  - schema:
+      openAPIV3Schema:
+        properties:
+          image: {type: string}
+--- {apiVersion: apps/v1, kind: Deployment, metadata: {name: flow}, spec: {template: {spec: {containers: [{name: c, image: gcr.io/a/flow:v1}]}}}}
+---
+apiVersion: batch/v1
+kind: "Job"
+metadata:
+  name: quoted
+spec:
+  template:
+    spec:
+      initContainers:
+      - name: init
+        image: gcr.io/a/init:v1
+      containers:
+      - name: c
+        "image": gcr.io/a/quoted:v1
+---
+"""
+
+
+def test_load_candidate_resources_matches_a_full_parse(tmp_path):
+    """
+    Tests that the documents skipped before parsing give no container images
+    """
+    (tmp_path / "resources.yaml").write_text(TRICKY_RESOURCES)
+    stats = dict.fromkeys(("files", "files_skipped", "documents", "documents_skipped"), 0)
+    safe_yaml = extract_images.YAML(typ="safe")
+
+    resources = extract_images.load_candidate_resources(str(tmp_path / "resources.yaml"), safe_yaml, stats)
+
+    assert [img for r in resources for img in extract_images.container_images(r)] == [
+        img for r in safe_yaml.load_all(TRICKY_RESOURCES) for img in extract_images.container_images(r)] == [
+        "gcr.io/a/flow:v1", "gcr.io/a/quoted:v1"]
+    assert stats == {"files": 1, "files_skipped": 0, "documents": 5, "documents_skipped": 3}
+
+
+def test_load_candidate_resources_falls_back_to_the_whole_file(tmp_path):
+    """
+    Tests that a candidate which can not be parsed on its own, as it uses a tag handle
+    declared before its document start, is loaded with the rest of its file
+    """
+    (tmp_path / "resources.yaml").write_text(
+        "%TAG !e! tag:yaml.org,2002:\n---\n" + deployment("tagged", "gcr.io/a/tagged:v1").replace(
+            "name: tagged", "name: !e!str tagged") + "---\napiVersion: v1\nkind: ConfigMap\n")
+    stats = dict.fromkeys(("files", "files_skipped", "documents", "documents_skipped"), 0)
+
+    resources = extract_images.load_candidate_resources(
+        str(tmp_path / "resources.yaml"), extract_images.YAML(typ="safe"), stats)
+
+    assert [r["kind"] for r in resources] == ["Deployment", "ConfigMap"]
+    assert extract_images.container_images(resources[0]) == ["gcr.io/a/tagged:v1"]
+    assert stats["documents_skipped"] == 0
+
+
+def test_scan_kustomization_counts_skipped_files_and_documents(tmp_path):
+    write_files(tmp_path, {
+        "kustomization.yaml": "resources:\n- resources.yaml\n- deployment.yaml\n- config.yaml\n",
+        "resources.yaml": TRICKY_RESOURCES,
+        "deployment.yaml": deployment("sample", "gcr.io/a/sample:v1"),
+        "config.yaml": "apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: a\n---\nkind: Secret\n",
+        "params.yaml": deployment("ignored", "gcr.io/a/ignored:v1"),
+    })
+
+    result = extract_images.scan_kustomization_for_images(str(tmp_path))
+
+    assert {key: result[key] for key in ("files", "files_skipped", "documents", "documents_skipped", "images")} == {
+        "files": 3, "files_skipped": 1, "documents": 8, "documents_skipped": 5, "images": 3}
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+#
+# Benchmarks for create-vsphere-app.py, run on the operator YAML of the carvel bundle.
+#
+# update-yaml: times the namespace rewrite of update_yaml on the largest install_order.yaml
+#     files, against loading every document and dumping them all at once with the pure
+#     Python loader and dumper, and reports the peak memory allocated by each.
+# gzip: times content_gzip at every level tried by the auto gzip level on the same files,
+#     against compressing and base64 encoding them in memory, with the size and peak memory
+#     of each.
+#
+# Example:
+# $ bench_create_vsphere_app.py update-yaml --files 3 --repeat 3
+# $ bench_create_vsphere_app.py gzip --files 3
+#
+
+__author__ = "VMware, Inc."
+__copyright__ = """\
+Copyright 2021 VMware, Inc.  All rights reserved. -- VMware Confidential\
+"""
+
+import argparse
+import base64
+import functools
+import glob
+import gzip
+import importlib.util
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+import yaml
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CARVEL_BUNDLE_DIR = os.path.join(SCRIPT_DIR, '..', 'carvel', 'bundle')
+
+
+def load_create_vsphere_app():
+    """
+    Import create-vsphere-app.py, whose name is not a valid module name.
+    """
+    spec = importlib.util.spec_from_file_location(
+        'create_vsphere_app', os.path.join(SCRIPT_DIR, 'create-vsphere-app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def largest_install_order_files(count):
+    """
+    :return: The paths of the count largest install_order.yaml files of the carvel bundle
+    """
+    paths = glob.glob(os.path.join(CARVEL_BUNDLE_DIR, '**', 'install_order.yaml'), recursive=True)
+    return sorted(paths, key=os.path.getsize, reverse=True)[:count]
+
+
+def update_yaml_all_at_once(operator_content):
+    """
+    The namespace rewrite of update_yaml as it was before it streamed documents: every
+    document is loaded, then all are dumped at once, with the pure Python loader and dumper.
+    """
+    updated_operator = []
+    for obj in yaml.safe_load_all(operator_content):
+        if not isinstance(obj, dict) or 'apiVersion' not in obj:
+            continue
+        updated_operator.append(obj)
+        if 'namespace' in obj['metadata']:
+            continue
+        if obj['kind'] in ['CustomResourceDefinition', 'ClusterRole', 'ClusterRoleBinding', 'Namespace']:
+            continue
+        obj['metadata']['namespace'] = "{{ .service.namespace }}"
+    return yaml.safe_dump_all(updated_operator)
+
+
+def content_gzip_in_memory(content):
+    """
+    content_gzip as it was before it streamed: the whole content is encoded, compressed
+    and base64 encoded at once.
+    """
+    return base64.b64encode(gzip.compress(bytes(content, 'utf-8'))).decode('utf-8')
+
+
+def measure(function, content, repeat):
+    """
+    :return: The tuple (best time in seconds, peak traced memory in bytes) of function(content)
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # Tracing slows allocations down, so the peak is measured on a run of its own
+    tracemalloc.start()
+    function(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def bench_update_yaml(files, repeat):
+    app = load_create_vsphere_app()
+    print("libyaml bindings: {}".format(app.SafeLoader.__name__.startswith('C')))
+    print("{:<40} {:>9} {:<16} {:>9} {:>11}".format('file', 'size KB', 'method', 'seconds', 'peak MB'))
+    for path in files:
+        with open(path) as f:
+            content = f.read()
+        name = os.path.relpath(os.path.dirname(path), CARVEL_BUNDLE_DIR)
+        for method, function in (('all-at-once', update_yaml_all_at_once), ('streaming', app.update_yaml)):
+            seconds, peak = measure(function, content, repeat)
+            print("{:<40} {:>9.1f} {:<16} {:>9.3f} {:>11.1f}".format(
+                name[-40:], len(content) / 1024.0, method, seconds, peak / 1024.0 / 1024.0))
+
+
+def bench_gzip(files, repeat):
+    app = load_create_vsphere_app()
+    print("{:<40} {:>9} {:<16} {:>9} {:>9} {:>11}".format(
+        'file', 'size KB', 'method', 'ratio', 'seconds', 'peak MB'))
+    methods = [('in-memory', content_gzip_in_memory)]
+    methods += [('streaming-{}'.format(level), functools.partial(app.content_gzip, level=level))
+                for level in app.GZIP_AUTO_LEVELS]
+    for path in files:
+        with open(path) as f:
+            content = f.read()
+        name = os.path.relpath(os.path.dirname(path), CARVEL_BUNDLE_DIR)
+        for method, function in methods:
+            ratio = len(function(content)) / float(len(content))
+            seconds, peak = measure(function, content, repeat)
+            print("{:<40} {:>9.1f} {:<16} {:>9.1%} {:>9.3f} {:>11.1f}".format(
+                name[-40:], len(content) / 1024.0, method, ratio, seconds, peak / 1024.0 / 1024.0))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks for create-vsphere-app.py')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    update = subparsers.add_parser('update-yaml', help='time the namespace rewrite of update_yaml')
+    update.add_argument('--files', type=int, default=3,
+                        help='number of the largest install_order.yaml files to run on. Default: %(default)s')
+    update.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs, the best one is reported. Default: %(default)s')
+
+    gzip_parser = subparsers.add_parser('gzip', help='time content_gzip at several levels')
+    gzip_parser.add_argument('--files', type=int, default=3,
+                             help='number of the largest install_order.yaml files to run on. '
+                                  'Default: %(default)s')
+    gzip_parser.add_argument('--repeat', type=int, default=3,
+                             help='number of timed runs, the best one is reported. Default: %(default)s')
+    args = parser.parse_args(argv)
+
+    # update_yaml logs every object it updates
+    logging.disable(logging.CRITICAL)
+
+    if args.benchmark == 'update-yaml':
+        bench_update_yaml(largest_install_order_files(args.files), args.repeat)
+    elif args.benchmark == 'gzip':
+        bench_gzip(largest_install_order_files(args.files), args.repeat)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -9,6 +9,12 @@
 #      -p https://raw.githubusercontent.com/jenkinsci/kubernetes-operator/master/deploy/all-in-one-v1alpha2.yaml jenkins -o jenkins-vsphere-app.yaml
 #
 # $ create-vsphere-app.py service-id -c ~/sample-crd.yaml -p ~/sample-operator.yaml -e ~/sample-eula.txt -o ~/sample-def.yaml --display-name Sample --description "Sample description" -v "1.2.3"
+#
+# Many services can be generated in one run from a batch manifest (see load_batch_manifest):
+# $ create-vsphere-app.py --batch release-services.yaml -j 4
+#
+# The generated services can also be created in vCenter directly, through one API session:
+# $ VC_PASSWORD=... create-vsphere-app.py --batch release-services.yaml --submit vc.example.com --vc-user administrator@vsphere.local
 
 __author__ = "VMware, Inc."
 __copyright__ = """\
@@ -18,47 +24,149 @@ Copyright 2021 VMware, Inc.  All rights reserved. -- VMware Confidential\
 import argparse
 import base64
 import datetime
-import gzip
+import functools
+import getpass
+import hashlib
+import json
 import logging
 import os
+import re
 import sys
-from sys import getsizeof
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # libyaml bindings, much faster on multi-megabyte operator YAML
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
 
 FORMAT_GZIP = 'gzip'
 FORMAT_PLAIN = 'plain'
 YAML_MAX_PLAIN_SIZE_IN_KB = 500
 
+GZIP_LEVEL_AUTO = 'auto'
+DEFAULT_GZIP_LEVEL = 9
+# Levels tried by the auto gzip level, from the fastest to the smallest output
+GZIP_AUTO_LEVELS = (1, 6, 9)
+GZIP_AUTO_TIME_BUDGET_IN_SECONDS = 2.0
+# Characters of content encoded and compressed at a time
+GZIP_CHUNK_SIZE = 64 * 1024
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'create-vsphere-app')
+HTTP_TIMEOUT_IN_SECONDS = 30
+HTTP_RETRIES = 3
+FETCH_WORKERS = 8
+
+VC_SESSION_PATH = '/api/session'
+VC_SUPERVISOR_SERVICES_PATH = '/api/vcenter/namespace-management/supervisor-services'
+SUBMIT_WORKERS = 4
+
+# Kinds update_yaml does not set the namespace of
+CLUSTER_SCOPED_KINDS = ['CustomResourceDefinition', 'ClusterRole', 'ClusterRoleBinding', 'Namespace']
+# Cluster-scoped kinds checked by validate_yaml, including those update_yaml does not know of
+KNOWN_CLUSTER_SCOPED_KINDS = frozenset(CLUSTER_SCOPED_KINDS + [
+    'APIService', 'CSIDriver', 'ClusterIssuer', 'ClusterServingRuntime', 'IngressClass',
+    'MutatingWebhookConfiguration', 'PersistentVolume', 'PriorityClass', 'RuntimeClass', 'StorageClass',
+    'ValidatingWebhookConfiguration'])
+
+# {{ }} templating, rendered by the Supervisor when the service is installed
+TEMPLATE_RE = re.compile(r'\{\{.*?\}\}')
+TEMPLATE_PLACEHOLDER = 'TEMPLATE'
+
+
+class ArtifactWriter(object):
+    """
+    Write a generated artifact piece by piece, to a file or to standard output when no
+    path is given, and compute the SHA-256 digest of what was written.
+
+    Writing to standard output ends with a newline, like print(). When a digests list is
+    given, the (path, hex digest) of the artifact is appended to it once written.
+    """
+
+    def __init__(self, path, digests=None):
+        self.path = path
+        self.digests = digests
+        self.sha256 = hashlib.sha256()
+        self.file = None
+
+    def __enter__(self):
+        if self.path:
+            self.file = open(self.path, 'wb')
+        else:
+            sys.stdout.flush()
+            self.file = sys.stdout.buffer
+        return self
+
+    def write(self, data):
+        """
+        :param data the piece to write, as bytes or as a string written in UTF-8
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('UTF-8')
+        self.sha256.update(data)
+        self.file.write(data)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.path:
+            self.file.close()
+        else:
+            self.file.write(b'\n')
+            self.file.flush()
+        if self.digests is not None and exc_type is None:
+            self.digests.append((self.path, self.sha256.hexdigest()))
+
+
+def _split_template(template, **kwargs):
+    """
+    Format template around its {content} field and return the text before and after it,
+    so the content can be written in between without building the whole text.
+    """
+    return template.format(content='\0', **kwargs).split('\0')
+
 
-def generate_dcli_command(ssd, output_file, accept_eula):
+def generate_dcli_command(encoded_ssd, output_file, accept_eula, digests=None):
     """
     Generate the corresponding dcli command to create the service in VC.
+
+    :param encoded_ssd the base64 encoded SSD YAML, as bytes
+    :param digests the list to append the (path, SHA-256 digest) of the script to, if any
     """
-    dcli_cmd = "dcli +show-unreleased " \
-               "com vmware vcenter namespacemanagement supervisorservices create " \
-               "--vsphere-spec-version-spec-content=\"{}\" --vsphere-spec-version-spec-accept-eula={}".format(
-        base64.b64encode(ssd.encode('UTF-8')).decode('UTF-8'), accept_eula)
+    (head, tail) = _split_template(
+        "dcli +show-unreleased "
+        "com vmware vcenter namespacemanagement supervisorservices create "
+        "--vsphere-spec-version-spec-content=\"{content}\" --vsphere-spec-version-spec-accept-eula={accept_eula}",
+        accept_eula=accept_eula)
 
-    if output_file:
-        # dcli command can be big, so output to a file based on the input one.
-        dcli_cmd_file = os.path.splitext(output_file)[0] + "-dcli.sh"
-        with open(dcli_cmd_file, 'w') as output:
-            output.write(dcli_cmd)
+    # dcli command can be big, so output to a file based on the input one.
+    dcli_cmd_file = os.path.splitext(output_file)[0] + "-dcli.sh" if output_file else None
+    with ArtifactWriter(dcli_cmd_file, digests) as output:
+        output.write(head)
+        output.write(encoded_ssd)
+        output.write(tail)
+    if dcli_cmd_file:
         logging.info("dcli command generated in file {}".format(dcli_cmd_file))
-    else:
-        print(dcli_cmd)
 
     logging.info(
         "You can now use the above dcli command to create the vSphere application in your VC.")
 
 
-def generate_govc_command(ssd, output_file, accept_eula):
+def generate_govc_command(encoded_ssd, output_file, accept_eula, digests=None):
     """
     Generate the corresponding govc command to create the service in VC from the user's computer.
+
+    :param encoded_ssd the base64 encoded SSD YAML, as bytes
+    :param digests the list to append the (path, SHA-256 digest) of the script to, if any
     """
-    govc_cmd = """#!/bin/bash
+    (head, tail) = _split_template("""#!/bin/bash
 set -x
 
 # First argument of this script is the VC IP
@@ -82,23 +190,129 @@ fi
 
 GOVC_URL="$VC_USER:$VC_PASSWORD@$VC_IP"
 
-govc session.login -u ${{GOVC_URL}} -k -r -X POST /api/vcenter/namespace-management/supervisor-services <<< '{{\"vsphere_spec\": {{ \"version_spec\" : {{ \"content\" : \"{}\", \"accept_EULA\" : {}, \"trusted_provider\": false }}}}}}'
-""".format(base64.b64encode(ssd.encode('UTF-8')).decode('UTF-8'), accept_eula)
+govc session.login -u ${{GOVC_URL}} -k -r -X POST /api/vcenter/namespace-management/supervisor-services <<< '{{\"vsphere_spec\": {{ \"version_spec\" : {{ \"content\" : \"{content}\", \"accept_EULA\" : {accept_eula}, \"trusted_provider\": false }}}}}}'
+""", accept_eula=accept_eula)
 
-    if output_file:
-        cmd_file = os.path.splitext(output_file)[0] + "-govc.sh"
-        with open(cmd_file, 'w') as output:
-            output.write(govc_cmd)
+    cmd_file = os.path.splitext(output_file)[0] + "-govc.sh" if output_file else None
+    with ArtifactWriter(cmd_file, digests) as output:
+        output.write(head)
+        output.write(encoded_ssd)
+        output.write(tail)
+    if cmd_file:
         os.chmod(cmd_file, 0o755)
         logging.info("govc command generated in file {}".format(cmd_file))
-    else:
-        print(govc_cmd)
 
     logging.info(
         "You can now use the above govc >= 1.23 (https://github.com/vmware/govmomi/tree/master/govc) "
         "command to create the vSphere application in your VC.")
 
 
+def generate_json_body(encoded_ssd, output_file, accept_eula, digests=None):
+    """
+    Generate the JSON body of the VC API request creating the service, as sent by the govc command.
+
+    :param encoded_ssd the base64 encoded SSD YAML, as bytes
+    :param digests the list to append the (path, SHA-256 digest) of the body to, if any
+    """
+    (head, tail) = _split_template(
+        '{{"vsphere_spec": {{"version_spec": {{"content": "{content}", "accept_EULA": {accept_eula}, '
+        '"trusted_provider": false}}}}}}', accept_eula=accept_eula)
+
+    body_file = json_body_path(output_file) if output_file else None
+    with ArtifactWriter(body_file, digests) as output:
+        output.write(head)
+        output.write(encoded_ssd)
+        output.write(tail)
+    if body_file:
+        logging.info("VC API request body generated in file {}".format(body_file))
+
+
+def json_body_path(output_file):
+    return os.path.splitext(output_file)[0] + "-body.json"
+
+
+def write_digests(output_file, digests):
+    """
+    Write the SHA-256 digests of the generated artifacts next to them, in the format of sha256sum.
+    """
+    digests_file = os.path.splitext(output_file)[0] + ".sha256"
+    with open(digests_file, 'w') as output:
+        for (path, digest) in digests:
+            output.write("{}  {}\n".format(digest, os.path.basename(path)))
+    logging.info("Artifact digests generated in file {}".format(digests_file))
+    return digests_file
+
+
+@functools.lru_cache(maxsize=None)
+def generator_digest():
+    """
+    :return: The SHA-256 digest of this script, so that changes to it invalidate the build cache
+    """
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def build_cache_path(output_file):
+    return os.path.splitext(output_file)[0] + ".build.json"
+
+
+def build_key(inputs, options):
+    """
+    Compute the key of a build from the digests of its inputs and the generator options.
+    :param inputs: the dict of the SHA-256 digest of each input, None for missing ones
+    :param options: the dict of the generator options, JSON serializable
+    :return: The hex SHA-256 digest identifying the build
+    """
+    build = {'generator': generator_digest(), 'inputs': inputs, 'options': options}
+    return hashlib.sha256(json.dumps(build, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _content_digest(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest() if content is not None else None
+
+
+def is_up_to_date(output_file, key):
+    """
+    Check the build cache manifest next to output_file: the build is up to date when the
+    manifest was written for the same key and every artifact it lists still has the size
+    it was written with. The artifacts are not read, so the check does not depend on their size.
+    """
+    try:
+        with open(build_cache_path(output_file)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if manifest.get('key') != key:
+        return False
+    base_dir = os.path.dirname(os.path.abspath(output_file))
+    for artifact in manifest.get('artifacts', []):
+        try:
+            if os.path.getsize(os.path.join(base_dir, artifact['path'])) != artifact['size']:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def write_build_cache(output_file, key, inputs, options, artifacts):
+    """
+    Write the build cache manifest next to output_file, recording the key of the build, its
+    inputs and options, and the path, size and SHA-256 digest of the artifacts it generated.
+    :param artifacts: the list of (path, SHA-256 digest) of the generated artifacts
+    """
+    manifest = {
+        'key': key,
+        'generator': generator_digest(),
+        'inputs': inputs,
+        'options': options,
+        'artifacts': [{'path': os.path.basename(path), 'size': os.path.getsize(path), 'sha256': digest}
+                      for (path, digest) in artifacts],
+    }
+    _write_atomically(os.path.abspath(build_cache_path(output_file)),
+                      json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    logging.debug("Build cache manifest generated in file {}".format(build_cache_path(output_file)))
+
+
 def update_yaml(operator_content):
     """
     Update the given YAML to add things like the namespace if it does not exist
@@ -113,33 +327,49 @@ def update_yaml(operator_content):
     This will fail if the YAML already contains templated statements.
     :return The updated content or the original one on error.
     """
-    updated_operator = []
     try:
-        operator = yaml.safe_load_all(operator_content)
-        for obj in operator:
-            # Remove any null document
-            if 'apiVersion' not in obj:
-                continue
-            updated_operator.append(obj)
-            if 'namespace' in obj['metadata']:
-                logging.warning(
-                    "The object {}/{} already specifies a namespace, not overriding.".format(
-                        obj['kind'], obj['metadata']['name']))
-                continue
-            # Skip cluster-wide resources
-            if obj['kind'] in ['CustomResourceDefinition', 'ClusterRole', 'ClusterRoleBinding',
-                               'Namespace']:
-                continue
+        return ''.join(iter_update_yaml(operator_content))
+    except yaml.YAMLError as e:
+        logging.error("Could not update the operator YAML, will ignore: {}".format(e))
+        return operator_content
+
+
+def iter_update_yaml(operator_content):
+    """
+    Update the given YAML document by document, see update_yaml.
 
+    Only one document is loaded at a time, and its updated YAML is yielded before the
+    next one is read, so memory stays close to the size of the largest document.
+    :param operator_content the YAML content, as a string or a file
+    :return A generator of the updated YAML documents, the output of yaml.safe_dump_all once joined
+    :raise yaml.YAMLError when the YAML can not be read
+    """
+    return iter_update_documents(yaml.load_all(operator_content, Loader=SafeLoader))
+
+
+def iter_update_documents(documents):
+    """
+    Update loaded YAML documents one at a time, see update_yaml.
+    :param documents an iterable of the loaded documents
+    :return A generator of the updated YAML documents, the output of yaml.safe_dump_all once joined
+    """
+    first = True
+    for obj in documents:
+        # Remove any null document
+        if not isinstance(obj, dict) or 'apiVersion' not in obj:
+            continue
+        if 'namespace' in obj['metadata']:
+            logging.warning(
+                "The object {}/{} already specifies a namespace, not overriding.".format(
+                    obj['kind'], obj['metadata']['name']))
+        # Skip cluster-wide resources
+        elif obj['kind'] not in CLUSTER_SCOPED_KINDS:
             logging.info(
                 "   Updating namespace for {}/{}".format(obj['kind'], obj['metadata']['name']))
             obj['metadata']['namespace'] = "{{ .service.namespace }}"
 
-    except yaml.YAMLError as e:
-        logging.error("Could not update the operator YAML, will ignore: {}".format(e))
-        return operator_content
-
-    return yaml.safe_dump_all(updated_operator)
+        yield yaml.dump(obj, Dumper=SafeDumper, explicit_start=not first)
+        first = False
 
 def update_yaml_with_psp(operator_content, service_id):
     pspContent = '''
@@ -156,43 +386,262 @@ spec:
     return operator_content
 
 
-def content_gzip(content):
+class ValidationResult(object):
+    """
+    The findings of validate_yaml on one input YAML, with the time spent on each document.
+    """
+
+    def __init__(self, spec_entry):
+        self.spec_entry = spec_entry
+        self.errors = []
+        self.warnings = []
+        # (document label, seconds spent parsing and checking it)
+        self.timings = []
+
+    def add(self, findings, label, message):
+        findings.append("{} {}: {}".format(self.spec_entry, label, message))
+
+    def log(self):
+        for warning in self.warnings:
+            logging.warning(warning)
+        for error in self.errors:
+            logging.error(error)
+        for (label, seconds) in self.timings:
+            logging.debug("{} {} validated in {:.2f}ms".format(self.spec_entry, label, seconds * 1000))
+        if self.timings:
+            (label, seconds) = max(self.timings, key=lambda timing: timing[1])
+            logging.info("{}: {} documents validated in {:.3f}s, slowest {} in {:.2f}ms".format(
+                self.spec_entry, len(self.timings), sum(timing[1] for timing in self.timings), label,
+                seconds * 1000))
+
+
+# Results of validate_yaml by (content digest, spec entry, update). A module global lives as long as
+# the process, so the services a batch worker process generates share it.
+_validation_cache = {}
+
+
+def validate_yaml(yaml_content, spec_entry, update=False, digest=None):
+    """
+    Validate a CRD or operator YAML offline, before it is written in the SSD.
+
+    The content is parsed once with the fastest loader available. Every document must be a
+    mapping with an apiVersion, a kind and a metadata.name. When {{ }} templating makes the
+    content invalid YAML, it is parsed again with the templates replaced, and it is an error
+    to ask update_yaml to rewrite it, as update_yaml leaves such content unchanged. Namespaces
+    on cluster-scoped kinds and cluster-scoped kinds update_yaml would set a namespace on are
+    reported as warnings.
+    :param spec_entry the SSD spec entry of the content, crdYaml or operatorYaml
+    :param update set to True if the content will be rewritten by update_yaml
+    :param digest the SHA-256 digest of the content, to reuse the result of an earlier validation
+    :return The ValidationResult
+    """
+    key = (digest or _content_digest(yaml_content), spec_entry, bool(update))
+    if key in _validation_cache:
+        return _validation_cache[key]
+
+    result = ValidationResult(spec_entry)
+    try:
+        for _ in iter_validated_documents(yaml_content, result, update):
+            pass
+    except yaml.YAMLError as e:
+        result = _validate_unparsable_yaml(yaml_content, spec_entry, update, e)
+    _validation_cache[key] = result
+    return result
+
+
+def validate_and_update_yaml(operator_content):
+    """
+    Validate the operator YAML like validate_yaml and update it like update_yaml, in a single
+    pass: every document is parsed once, validated, then updated.
+    :return The tuple (ValidationResult, updated content, the original one when it can not be parsed)
+    """
+    result = ValidationResult('operatorYaml')
+    try:
+        updated = ''.join(iter_update_documents(iter_validated_documents(operator_content, result, True)))
+    except yaml.YAMLError as e:
+        return _validate_unparsable_yaml(operator_content, 'operatorYaml', True, e), operator_content
+    return result, updated
+
+
+def _validate_unparsable_yaml(yaml_content, spec_entry, update, error):
+    result = ValidationResult(spec_entry)
+    if not TEMPLATE_RE.search(yaml_content):
+        result.add(result.errors, 'YAML', "invalid YAML, {}: {}".format(
+            getattr(error, 'problem', None) or 'parse error', _yaml_error_location(error)))
+        return result
+
+    findings = result.errors if update else result.warnings
+    result.add(findings, 'YAML', "{{{{ }}}} templating makes it invalid YAML{}: {}".format(
+        ", update_yaml can not add the service namespace" if update else '', _yaml_error_location(error)))
+    try:
+        for _ in iter_validated_documents(TEMPLATE_RE.sub(TEMPLATE_PLACEHOLDER, yaml_content), result, update):
+            pass
+    except yaml.YAMLError as e:
+        result.add(result.warnings, 'YAML', "not validated, {{{{ }}}} templating wraps YAML structure: {}".format(
+            _yaml_error_location(e)))
+    return result
+
+
+def _yaml_error_location(error):
+    mark = getattr(error, 'problem_mark', None)
+    return "line {}, column {}".format(mark.line + 1, mark.column + 1) if mark else str(error)
+
+
+def iter_validated_documents(yaml_content, result, update):
+    """
+    Load and validate YAML documents one at a time, adding the findings to result.
+    :return A generator of the loaded documents without errors
+    :raise yaml.YAMLError when the YAML can not be read
+    """
+    documents = yaml.load_all(yaml_content, Loader=SafeLoader)
+    index = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            obj = next(documents)
+        except StopIteration:
+            return
+        index += 1
+        if obj is None:
+            continue
+        errors = len(result.errors)
+        label = _validate_document(obj, index, result, update)
+        result.timings.append((label, time.perf_counter() - start))
+        if len(result.errors) == errors:
+            yield obj
+
+
+def _validate_document(obj, index, result, update):
+    """
+    Check one document of validate_yaml.
+    :return The label of the document in the findings, its kind and name when it has them
+    """
+    label = "document {}".format(index)
+    if not isinstance(obj, dict):
+        result.add(result.errors, label, "not a mapping")
+        return label
+
+    kind = obj.get('kind')
+    metadata = obj.get('metadata')
+    name = metadata.get('name') or metadata.get('generateName') if isinstance(metadata, dict) else None
+    if isinstance(kind, str) and isinstance(name, str):
+        label = "document {} ({}/{})".format(index, kind, name)
+
+    for field in ('apiVersion', 'kind'):
+        if not isinstance(obj.get(field), str) or not obj[field]:
+            result.add(result.errors, label, "missing {}".format(field))
+    if not isinstance(metadata, dict):
+        result.add(result.errors, label, "missing metadata")
+        return label
+    if not name:
+        result.add(result.errors, label, "missing metadata.name")
+    if not isinstance(kind, str):
+        return label
+
+    if result.spec_entry == 'crdYaml' and kind != 'CustomResourceDefinition':
+        result.add(result.warnings, label, "{} in the CRD YAML".format(kind))
+    if kind in KNOWN_CLUSTER_SCOPED_KINDS:
+        if metadata.get('namespace'):
+            result.add(result.warnings, label, "cluster-scoped {} has a namespace".format(kind))
+        elif update and kind not in CLUSTER_SCOPED_KINDS:
+            result.add(result.warnings, label, "update_yaml sets a namespace on cluster-scoped {}".format(kind))
+    return label
+
+
+def utf8_size(content):
+    """
+    Return the size in bytes of the UTF-8 encoding of a content string, without holding
+    the whole encoding in memory.
+    """
+    if content.isascii():
+        return len(content)
+    return sum(len(content[start:start + GZIP_CHUNK_SIZE].encode('utf-8'))
+               for start in range(0, len(content), GZIP_CHUNK_SIZE))
+
+
+def content_gzip(content, level=DEFAULT_GZIP_LEVEL):
     """
     Converts a content string into a raw content string(gzipped and base64 encoded)
+
+    The content is encoded, compressed and base64 encoded one chunk at a time, so neither
+    its UTF-8 encoding nor the compressed data are ever held in full.
+    :param content the content string
+    :param level the gzip compression level, from 1 (fastest) to 9 (smallest)
     """
-    content_bytes = gzip.compress(bytes(content, 'utf-8'))
+    # A gzip header without timestamp, so the same content always gives the same output
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    encoded = []
+    pending = b''
+    for start in range(0, len(content), GZIP_CHUNK_SIZE):
+        pending += compressor.compress(content[start:start + GZIP_CHUNK_SIZE].encode('utf-8'))
+        # base64 encodes groups of 3 bytes, the rest waits for the next chunk
+        cut = len(pending) - len(pending) % 3
+        encoded.append(base64.b64encode(pending[:cut]).decode('ascii'))
+        pending = pending[cut:]
+    pending += compressor.flush()
     # we expect base64 encoded gzip data
-    content_bytes_encoded = base64.b64encode(content_bytes)
-    content = content_bytes_encoded.decode('utf-8')
-    return content
+    encoded.append(base64.b64encode(pending).decode('ascii'))
+    return ''.join(encoded)
+
 
+def auto_content_gzip(content, time_budget=GZIP_AUTO_TIME_BUDGET_IN_SECONDS, size_budget=None):
+    """
+    Converts a content string into a raw content string with a gzip level tuned to the content.
 
-def dump_yaml(content, fmt):
+    The levels of GZIP_AUTO_LEVELS are tried in order, stopping at the first whose output
+    fits in size_budget KB, or once time_budget seconds were spent compressing.
+    :return The tuple (gzip level, raw content) of the smallest output
+    """
+    start = time.perf_counter()
+    best = None
+    for level in GZIP_AUTO_LEVELS:
+        raw_content = content_gzip(content, level)
+        if best is None or len(raw_content) < len(best[1]):
+            best = (level, raw_content)
+        if size_budget is not None and len(raw_content) / 1000 <= size_budget:
+            break
+        if time.perf_counter() - start >= time_budget:
+            break
+    return best
+
+
+def dump_yaml(content, fmt, gzip_level=DEFAULT_GZIP_LEVEL, gzip_time_budget=GZIP_AUTO_TIME_BUDGET_IN_SECONDS,
+              gzip_size_budget=None):
     """
     Return the YAML content in either plain or gzip format, depending on the size and
     the specified format
-    We guess if this is likely to be too big or not and gzip it if yes.
+    We gzip it if its UTF-8 encoding is too big.
 
+    :param gzip_level the gzip compression level, or 'auto' to tune it within the gzip time
+    and size budgets (see auto_content_gzip)
     @return The tuple (format, YAML content)
     """
-    if fmt == FORMAT_GZIP:
-        return fmt, content_gzip(content)
-
-    # let's gzip if too big ( >= 500 KB)
-    size = getsizeof(content) / 1000
-    if size >= YAML_MAX_PLAIN_SIZE_IN_KB:
+    if fmt != FORMAT_GZIP:
+        # let's gzip if too big ( >= 500 KB)
+        size = utf8_size(content) / 1000
+        if size < YAML_MAX_PLAIN_SIZE_IN_KB:
+            return fmt, content
         logging.info(
             "gzipping the YAML as size ({} KB) >= {} KB".format(size, YAML_MAX_PLAIN_SIZE_IN_KB))
-        return FORMAT_GZIP, content_gzip(content)
 
-    return fmt, content
+    if gzip_level == GZIP_LEVEL_AUTO:
+        (level, raw_content) = auto_content_gzip(content, gzip_time_budget, gzip_size_budget)
+        logging.info("   Using gzip level {}".format(level))
+        return FORMAT_GZIP, raw_content
+    return FORMAT_GZIP, content_gzip(content, int(gzip_level))
 
 
 def generate_vsphere_app(service_id, service_version, crd_url, operator_url, output, update, psp, fmt,
-                         eula=None, display_name=None, description=None):
+                         eula=None, display_name=None, description=None, fetcher=None,
+                         gzip_level=DEFAULT_GZIP_LEVEL, gzip_time_budget=GZIP_AUTO_TIME_BUDGET_IN_SECONDS,
+                         gzip_size_budget=None, json_body=False, digests=False, force=False, validate=True):
     """
     Generate the vsphere app YAML.
 
+    When writing to an output file, a build cache manifest <output>.build.json records the
+    digests of the inputs and the generator options. The next run with the same inputs and
+    options skips the generation, as long as the artifacts are still there.
+
     :param service_id the ID of the service
     :param service_version the version of the service, defaults to "1.0.0"
     :param crd_url the path to the CRD YAML file
@@ -207,6 +656,17 @@ def generate_vsphere_app(service_id, service_version, crd_url, operator_url, out
     :param eula the EULA if specified. Default is empty
     :param display_name the display name of the service version, defaulted to the service ID
     :param description the description of the service version. Will create one if none provided
+    :param fetcher the YamlFetcher used to fetch the CRD and operator YAML, a new one without
+    cache if none given
+    :param gzip_level the gzip compression level from 1 to 9, or 'auto' to pick one within
+    gzip_time_budget seconds and, when given, gzip_size_budget KB
+    :param json_body set to True to also generate the JSON body of the VC API request creating the service
+    :param digests set to True to write the SHA-256 digest of every generated file to <output>.sha256,
+    or log them when writing to standard output
+    :param force set to True to generate the service even if the build cache says it is up to date
+    :param validate set to False to generate the service without validating the CRD and operator YAML first,
+    see validate_yaml
+    :return 1 on error, 0 when the generation was skipped as up to date, None otherwise
     """
     version = service_version if service_version else "1.0.0"
     label = display_name if display_name else service_id.capitalize()
@@ -231,48 +691,123 @@ def generate_vsphere_app(service_id, service_version, crd_url, operator_url, out
     if eula:
         ssd_dict['spec']['eula'] = eula
 
+    # Fetch all the inputs at once, they do not depend on each other
+    fetcher = fetcher or YamlFetcher()
+    contents = fetcher.fetch_all([url for url in (crd_url, operator_url) if url])
+    for url in (crd_url, operator_url):
+        if url and contents.get(url) is None:
+            logging.error("Can not fetch YAML from {}, see the logs".format(url))
+            return 1
+
+    # The default description holds the date of the build, key on the given one instead
+    build_inputs = {
+        'crd': _content_digest(contents.get(crd_url)),
+        'operator': _content_digest(contents.get(operator_url)),
+        'eula': _content_digest(eula),
+    }
+    build_options = {
+        'service_id': service_id, 'version': version, 'display_name': display_name,
+        'description': description, 'update': bool(update), 'psp': bool(psp), 'format': fmt,
+        'gzip_level': str(gzip_level), 'gzip_time_budget': gzip_time_budget,
+        'gzip_size_budget': gzip_size_budget, 'json_body': bool(json_body), 'digests': bool(digests),
+        # A build made without validation does not stand for a validated one
+        'validate': bool(validate),
+    }
+    key = build_key(build_inputs, build_options)
+    if output and not force and is_up_to_date(output, key):
+        logging.info("{} is up to date with its inputs, skipping it. Use --force to generate it anyway".format(
+            output))
+        return 0
+
+    operator = contents.get(operator_url)
+    operator_updated = False
+    if validate:
+        results = []
+        if crd_url:
+            results.append(validate_yaml(contents[crd_url], 'crdYaml', digest=build_inputs['crd']))
+        if operator_url and update:
+            # The operator YAML is validated while it is updated, so it is only parsed once
+            logging.debug("Updating the original YAML")
+            (result, operator) = validate_and_update_yaml(operator)
+            results.append(result)
+            operator_updated = True
+        elif operator_url:
+            results.append(validate_yaml(operator, 'operatorYaml', digest=build_inputs['operator']))
+        for result in results:
+            result.log()
+        if any(result.errors for result in results):
+            logging.error("Invalid YAML for service {}, use --no-validate to generate it anyway".format(service_id))
+            return 1
+
     if crd_url:
-        crd = fetch_yaml(crd_url)
+        crd = contents[crd_url]
         try:
-            fill_ssd_spec('crdYaml', crd, ssd_dict, fmt)
+            fill_ssd_spec('crdYaml', crd, ssd_dict, fmt, gzip_level, gzip_time_budget, gzip_size_budget)
         except yaml.YAMLError as e:
             logging.error("Can not write CRD YAML from {}".format(crd_url), e)
             return 1
 
     if operator_url:
-        operator = fetch_yaml(operator_url)
-        if update:
+        if update and not operator_updated:
             logging.debug("Updating the original YAML")
             operator = update_yaml(operator)
         if psp:
             logging.debug("Updating the original YAML with PersistenceServiceConfiguration")
             operator = update_yaml_with_psp(operator, service_id)
         try:
-            fill_ssd_spec('operatorYaml', operator, ssd_dict, fmt)
+            fill_ssd_spec('operatorYaml', operator, ssd_dict, fmt, gzip_level, gzip_time_budget,
+                          gzip_size_budget)
         except yaml.YAMLError as e:
             logging.error("Can not write operator YAML from {}".format(operator_url), e)
             return 1
 
     # Use default_style='|' to have all fields using "|" to show content
     ssd = yaml.safe_dump(ssd_dict, default_style=None)
+    artifact_digests = [] if digests or output else None
+    with ArtifactWriter(output, artifact_digests) as output_file:
+        output_file.write(ssd)
     if output:
-        with open(output, 'w') as output_file:
-            output_file.write(ssd)
         logging.info("Generated in file {}".format(output))
-    else:
-        print(ssd)
 
     accept_eula = str('eula' in ssd_dict['spec']).lower()
 
-    generate_dcli_command(ssd, output, accept_eula)
-    generate_govc_command(ssd, output, accept_eula)
+    # All the commands carry the same base64 encoded SSD, encode it once for all of them
+    encoded_ssd = base64.b64encode(ssd.encode('UTF-8'))
+    generate_dcli_command(encoded_ssd, output, accept_eula, artifact_digests)
+    generate_govc_command(encoded_ssd, output, accept_eula, artifact_digests)
+    if json_body:
+        generate_json_body(encoded_ssd, output, accept_eula, artifact_digests)
 
+    if digests:
+        if output:
+            digests_file = write_digests(output, artifact_digests)
+        else:
+            for (_, digest) in artifact_digests:
+                logging.info("sha256:{}".format(digest))
 
-def fill_ssd_spec(spec_entry, yaml_content, ssd_dict, fmt):
+    if output:
+        artifacts = list(artifact_digests)
+        if digests:
+            with open(digests_file, 'rb') as f:
+                artifacts.append((digests_file, hashlib.sha256(f.read()).hexdigest()))
+        write_build_cache(output, key, build_inputs, build_options, artifacts)
+
+
+def fill_ssd_spec(spec_entry, yaml_content, ssd_dict, fmt, gzip_level=DEFAULT_GZIP_LEVEL,
+                  gzip_time_budget=GZIP_AUTO_TIME_BUDGET_IN_SECONDS, gzip_size_budget=None):
     """
-    Fill in the spec for the given CRD or operator YAML entry.
+    Fill in the spec for the given CRD or operator YAML entry, and log the size it takes
+    in the spec and the time spent encoding it.
     """
-    (content_format, content) = dump_yaml(yaml_content, fmt)
+    start = time.perf_counter()
+    (content_format, content) = dump_yaml(yaml_content, fmt, gzip_level, gzip_time_budget, gzip_size_budget)
+    if content_format == FORMAT_GZIP:
+        plain_size = utf8_size(yaml_content)
+        logging.info("{}: {:.1f} KB gzipped to {:.1f} KB ({:.1%}) in {:.3f}s".format(
+            spec_entry, plain_size / 1000, len(content) / 1000, len(content) / max(plain_size, 1),
+            time.perf_counter() - start))
+    else:
+        logging.info("{}: {:.1f} KB in plain format".format(spec_entry, utf8_size(content) / 1000))
     ssd_dict['spec'][spec_entry] = {}
     ssd_dict['spec'][spec_entry]['format'] = content_format
 
@@ -281,26 +816,315 @@ def fill_ssd_spec(spec_entry, yaml_content, ssd_dict, fmt):
     ssd_dict['spec'][spec_entry][content_key] = content
 
 
-def fetch_yaml(url):
+class YamlFetcher(object):
     """
-    Fetch the YAML from a given URL.
-    @return The YAML content, not the object/dict as the YAML can contain templated info ( {{ if ...}})
+    Fetch YAML from local files and http(s) URLs.
+
+    Requests go through one pooled session with a timeout and retries on connection
+    errors and 5xx responses. When a cache directory is given, downloaded content is
+    stored there under its SHA-256 digest, together with an index of the ETag and
+    Last-Modified headers of each URL. Later fetches of the same URL are revalidated
+    with If-None-Match/If-Modified-Since and read back from the cache on 304, so
+    unchanged upstream YAML is not downloaded again.
     """
-    content = None
-    if not url.startswith('http'):
-        # treat this as a file
-        with open(url) as f:
-            content = f.read()
-    else:
-        # URL
-        r = requests.get(url)
-        if r.status_code == requests.codes.ok:
-            content = r.text
+
+    def __init__(self, cache_dir=None, timeout=HTTP_TIMEOUT_IN_SECONDS, retries=HTTP_RETRIES,
+                 max_workers=FETCH_WORKERS, contents=None):
+        self.cache_dir = cache_dir
+        # Content already fetched, by URL, returned without fetching again
+        self.contents = dict(contents or {})
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers,
+                              max_retries=Retry(total=retries, backoff_factor=0.5,
+                                                status_forcelist=(500, 502, 503, 504), raise_on_status=False))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch_all(self, urls, skip_errors=False):
+        """
+        Fetch the given URLs concurrently.
+        :param urls the URLs to fetch
+        :param skip_errors set to True to leave out the URLs that raised an error instead of raising it
+        :return A dict of the YAML content of each URL, None for those that could not be fetched
+        """
+        urls = list(dict.fromkeys(urls))
+        fetch = self._fetch_or_log if skip_errors else self.fetch
+        if len(urls) <= 1:
+            results = [fetch(url) for url in urls]
         else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+                results = list(executor.map(fetch, urls))
+        return {url: content for url, content in zip(urls, results) if content is not _FETCH_ERROR}
+
+    def _fetch_or_log(self, url):
+        try:
+            return self.fetch(url)
+        except (IOError, requests.RequestException) as e:
+            logging.warning("Error fetching YAML from {}: {}".format(url, e))
+            return _FETCH_ERROR
+
+    def fetch(self, url):
+        """
+        Fetch the YAML from a given URL.
+        @return The YAML content, not the object/dict as the YAML can contain templated info ( {{ if ...}})
+        """
+        if url in self.contents:
+            return self.contents[url]
+        if not url.startswith('http'):
+            # treat this as a file
+            with open(url) as f:
+                return f.read()
+
+        entry = self._read_index(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            if not entry:
+                raise
+            logging.warning("Error fetching YAML from {}, using the cached copy: {}".format(url, e))
+            return self._read_object(entry)
+
+        if r.status_code == requests.codes.not_modified and entry:
+            logging.debug("Using the cached YAML of {}".format(url))
+            return self._read_object(entry)
+        if r.status_code != requests.codes.ok:
             logging.error(
                 "Error fetching YAML from {}: {} ({})".format(url, r.status_code, r.text))
+            return None
+
+        content = r.text
+        self._write_cache(url, r, content)
+        return content
+
+    def _index_path(self, url):
+        return os.path.join(self.cache_dir, 'index', hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    def _read_index(self, url):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._index_path(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # An index entry is only usable as long as its content is still there
+        return entry if os.path.exists(self._object_path(entry['sha256'])) else None
+
+    def _read_object(self, entry):
+        with open(self._object_path(entry['sha256']), 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != entry['sha256']:
+            raise IOError("Corrupted cache entry for {}".format(entry['url']))
+        return data.decode(entry['encoding'])
+
+    def _write_cache(self, url, response, content):
+        if not self.cache_dir or not (response.headers.get('ETag') or response.headers.get('Last-Modified')):
+            return
+        encoding = response.encoding or 'utf-8'
+        data = content.encode(encoding)
+        digest = hashlib.sha256(data).hexdigest()
+        entry = {
+            'url': url,
+            'sha256': digest,
+            'encoding': encoding,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            _write_atomically(object_path, data)
+        _write_atomically(self._index_path(url), json.dumps(entry).encode('utf-8'))
+
+
+# Marks the URLs YamlFetcher.fetch_all could not fetch
+_FETCH_ERROR = object()
+
+
+def _write_atomically(path, data):
+    """
+    Write data to path through a temporary file, so concurrent runs never read a partial file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def fetch_yaml(url, fetcher=None):
+    """
+    Fetch the YAML from a given URL.
+    @return The YAML content, not the object/dict as the YAML can contain templated info ( {{ if ...}})
+    """
+    return (fetcher or YamlFetcher()).fetch(url)
+
+
+class SupervisorServiceClient(object):
+    """
+    Create supervisor services through the vCenter REST API, like the generated govc command.
+
+    Every request goes through one pooled session, logged in once and shared by all the
+    services submitted, instead of one login per service. Requests are retried on connection
+    errors and 502/503/504 responses, except for the 504 and read errors of a service creation,
+    and the session is logged in again if vCenter expires it.
+    The client is a context manager logging in on enter and out on exit.
+    """
+
+    def __init__(self, url, username, password, verify=True, timeout=HTTP_TIMEOUT_IN_SECONDS,
+                 retries=HTTP_RETRIES, max_workers=SUBMIT_WORKERS):
+        """
+        :param url the vCenter host, or its base URL, https://<host> when no scheme is given
+        :param verify set to False to skip the verification of the vCenter certificate
+        :param max_workers the maximum number of services submitted at the same time
+        """
+        self.url = (url if '://' in url else 'https://' + url).rstrip('/')
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.token = None
+        self._login_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.verify = verify
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers,
+                              max_retries=Retry(total=retries, backoff_factor=0.5, allowed_methods=None,
+                                                status_forcelist=(502, 503, 504), raise_on_status=False))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Creating a service is only retried when vCenter did not create it: the connection failed or it
+        # answered 502/503. A read error or a 504 of the gateway may come after the service was created.
+        create_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers,
+                                     max_retries=Retry(total=retries, read=0, backoff_factor=0.5,
+                                                       allowed_methods=None, status_forcelist=(502, 503),
+                                                       raise_on_status=False))
+        self.session.mount(self.url + VC_SUPERVISOR_SERVICES_PATH, create_adapter)
+
+    def __enter__(self):
+        self.login()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.logout()
+        self.session.close()
+
+    def login(self, expired_token=None):
+        """
+        Create a vCenter API session, unless another thread already replaced expired_token.
+        """
+        with self._login_lock:
+            if self.token is not None and self.token != expired_token:
+                return
+            r = self.session.post(self.url + VC_SESSION_PATH, auth=(self.username, self.password),
+                                  timeout=self.timeout)
+            r.raise_for_status()
+            self.token = r.json()
+            logging.debug("Logged in to {} as {}".format(self.url, self.username))
+
+    def logout(self):
+        if self.token is None:
+            return
+        try:
+            self.session.delete(self.url + VC_SESSION_PATH, headers={'vmware-api-session-id': self.token},
+                                timeout=self.timeout)
+        except requests.RequestException as e:
+            logging.warning("Error logging out of {}: {}".format(self.url, e))
+        self.token = None
+
+    def create_service(self, body):
+        """
+        Create a supervisor service.
+        :param body the JSON body of the request, as bytes, see submission_body
+        :return The response of vCenter
+        """
+        for attempt in range(2):
+            token = self.token
+            r = self.session.post(self.url + VC_SUPERVISOR_SERVICES_PATH, data=body, timeout=self.timeout,
+                                  headers={'vmware-api-session-id': token, 'Content-Type': 'application/json'})
+            if r.status_code != requests.codes.unauthorized or attempt:
+                return r
+            logging.debug("vCenter session expired, logging in again")
+            self.login(expired_token=token)
+
+    def submit(self, service_id, ssd_file):
+        """
+        Create the supervisor service of a generated SSD file, from the JSON body generated with it.
+        :return: The dict summarizing the submission of the service
+        """
+        start = time.perf_counter()
+        error = None
+        try:
+            r = self.create_service(submission_body(ssd_file))
+            if not 200 <= r.status_code < 300:
+                error = "{} {}".format(r.status_code, r.text.strip()[:200])
+        except (IOError, requests.RequestException) as e:
+            error = "{}: {}".format(type(e).__name__, e)
+        return {
+            'service_id': service_id,
+            'error': error,
+            'seconds': time.perf_counter() - start,
+        }
+
+    def submit_all(self, services):
+        """
+        Create the supervisor services of generated SSD files, max_workers at a time.
+        :param services the list of (service ID, SSD file) to submit
+        :return: The list of the dicts summarizing the submission of each service, in order
+        """
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(services)))) as executor:
+            return list(executor.map(lambda service: self.submit(*service), services))
 
-    return content
+
+def submission_body(ssd_file):
+    """
+    Read the JSON body of the VC API request creating the service of the given SSD file,
+    written next to it by generate_json_body, so the SSD is not encoded again.
+    :return: The body as bytes
+    """
+    with open(json_body_path(ssd_file), 'rb') as f:
+        return f.read()
+
+
+def submit_services(client, services):
+    """
+    Create the supervisor services of generated SSD files in vCenter and log a summary.
+    :param client: the SupervisorServiceClient to submit with, logged in on first use
+    :param services: the list of (service ID, SSD file) to submit
+    :return: 0 if every service was created, 1 otherwise
+    """
+    start = time.perf_counter()
+    try:
+        with client:
+            results = client.submit_all(services)
+    except (IOError, requests.RequestException) as e:
+        logging.error("Can not log in to {}: {}".format(client.url, e))
+        return 1
+
+    logging.info("{:<30} {:>8}  {}".format('service', 'seconds', 'submission'))
+    for result in results:
+        if result['error']:
+            logging.error("{:<30} {:>8.2f}  {}".format(result['service_id'], result['seconds'], result['error']))
+        else:
+            logging.info("{:<30} {:>8.2f}  created".format(result['service_id'], result['seconds']))
+    failed = sum(1 for result in results if result['error'])
+    logging.info("Created {} of {} services in {} in {:.2f}s".format(
+        len(results) - failed, len(results), client.url, time.perf_counter() - start))
+    return 1 if failed else 0
 
 
 def extract_info_from_alpha1(v1alpha1_service):
@@ -315,10 +1139,172 @@ def extract_info_from_alpha1(v1alpha1_service):
             spec['eula']]
 
 
+BATCH_ENTRY_KEYS = ('service_id', 'crd_url', 'operator_url', 'version', 'output', 'update', 'psp', 'format',
+                    'eula', 'display_name', 'description', 'gzip_level', 'gzip_time_budget', 'gzip_size_budget',
+                    'json_body', 'digests', 'force', 'validate')
+
+
+def load_batch_manifest(manifest_path):
+    """
+    Load the services to generate from a batch manifest YAML file, in the form:
+
+    defaults:             # optional, applied to every service
+      update: true
+    services:
+    - service_id: kubeflow
+      crd_url: kubeflow-operator/config/crd/bases/peach.vmware.com_kubeflows.yaml
+      operator_url: kubeflow_operator.yaml
+      version: 1.2.3
+      output: kubeflow-service-def.yaml     # defaults to <service_id>-service-def.yaml
+      psp: false
+      format: plain
+      eula: eula.txt                        # path to the EULA text file
+      display_name: Kubeflow
+      description: Kubeflow on vSphere
+      gzip_level: auto                      # or 1 to 9, with gzip_time_budget and gzip_size_budget
+      json_body: true                       # also write <output>-body.json
+      digests: true                         # also write <output>.sha256
+      force: true                           # generate even if <output>.build.json is up to date
+      validate: false                       # skip the validation of the CRD and operator YAML
+
+    Relative paths are resolved from the directory of the manifest.
+    :param manifest_path: the path to the batch manifest
+    :return: The list of service entries, as dicts with every key of BATCH_ENTRY_KEYS
+    """
+    with open(manifest_path) as f:
+        manifest = yaml.safe_load(f)
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    defaults = manifest.get('defaults') or {}
+
+    entries = []
+    for service in manifest['services']:
+        entry = dict.fromkeys(BATCH_ENTRY_KEYS)
+        entry.update(update=False, psp=False, format=FORMAT_PLAIN, gzip_level=DEFAULT_GZIP_LEVEL,
+                     gzip_time_budget=GZIP_AUTO_TIME_BUDGET_IN_SECONDS, json_body=False, digests=False,
+                     force=False, validate=True)
+        entry.update(defaults)
+        entry.update(service)
+        unknown = set(entry) - set(BATCH_ENTRY_KEYS)
+        if unknown:
+            raise ValueError("Unknown keys for service {} in {}: {}".format(
+                entry['service_id'], manifest_path, ', '.join(sorted(unknown))))
+        if not entry['service_id']:
+            raise ValueError("Every service in {} needs a service_id".format(manifest_path))
+
+        entry['output'] = entry['output'] or "{}-service-def.yaml".format(entry['service_id'])
+        for key in ('crd_url', 'operator_url', 'eula', 'output'):
+            if entry[key] and not entry[key].startswith('http'):
+                entry[key] = os.path.join(base_dir, entry[key])
+        if entry['version'] is not None:
+            entry['version'] = str(entry['version'])
+        entries.append(entry)
+    return entries
+
+
+# YamlFetcher of a batch worker process, set up by _init_batch_worker
+_batch_fetcher = None
+
+
+def _init_batch_worker(cache_dir, contents, debug):
+    global _batch_fetcher
+    _batch_fetcher = YamlFetcher(cache_dir=cache_dir, contents=contents)
+    logging.getLogger().setLevel('DEBUG' if debug else 'WARNING')
+
+
+def _generate_batch_entry(entry):
+    """
+    Generate the service of one batch entry in a worker process.
+    :return: The dict summarizing the generation of the service
+    """
+    start = time.perf_counter()
+    error = None
+    skipped = False
+    try:
+        eula = None
+        if entry['eula']:
+            with open(entry['eula']) as f:
+                eula = f.read()
+        status = generate_vsphere_app(entry['service_id'], entry['version'], entry['crd_url'],
+                                      entry['operator_url'], entry['output'], entry['update'], entry['psp'],
+                                      entry['format'], eula, entry['display_name'], entry['description'],
+                                      _batch_fetcher, entry['gzip_level'], entry['gzip_time_budget'],
+                                      entry['gzip_size_budget'], entry['json_body'], entry['digests'],
+                                      entry['force'], entry['validate'])
+        if status:
+            error = "generation failed, see the logs"
+        skipped = status == 0
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+
+    ssd_size = os.path.getsize(entry['output']) if error is None else 0
+    return {
+        'service_id': entry['service_id'],
+        'output': entry['output'],
+        'error': error,
+        'seconds': time.perf_counter() - start,
+        'ssd_size': ssd_size,
+        'skipped': skipped,
+    }
+
+
+def generate_batch(manifest_path, jobs=None, fetcher=None, debug=False, force=False, client=None, validate=True):
+    """
+    Generate every service of a batch manifest in a pool of processes and log a summary.
+
+    The YAML of all the services is fetched once up front and handed to the worker
+    processes, so inputs shared by several services are only fetched once.
+    :param manifest_path: the path to the batch manifest, see load_batch_manifest
+    :param jobs: the number of worker processes, defaults to the number of CPUs
+    :param fetcher: the YamlFetcher used to fetch the inputs
+    :param debug: set to True to keep the debug logs of the workers
+    :param force: set to True to generate every service, even those whose build cache is up to date
+    :param client: the SupervisorServiceClient to create the generated services in vCenter with, if any
+    :param validate: set to False to validate the YAML of no service, see validate_yaml
+    :return: 0 if every service was generated, and created when a client is given, 1 otherwise
+    """
+    start = time.perf_counter()
+    entries = load_batch_manifest(manifest_path)
+    for entry in entries:
+        entry['force'] = entry['force'] or force
+        entry['validate'] = entry['validate'] and validate
+        # Services are submitted with the JSON body generated along with them
+        entry['json_body'] = entry['json_body'] or client is not None
+    fetcher = fetcher or YamlFetcher()
+    urls = [entry[key] for entry in entries for key in ('crd_url', 'operator_url') if entry[key]]
+    # The services whose inputs can not be fetched fail on their own in the workers
+    contents = fetcher.fetch_all(urls, skip_errors=True)
+    logging.info("Fetched {} inputs of {} services in {:.2f}s".format(
+        len(contents), len(entries), time.perf_counter() - start))
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_batch_worker,
+                             initargs=(fetcher.cache_dir, contents, debug)) as executor:
+        results = list(executor.map(_generate_batch_entry, entries))
+
+    logging.info("{:<30} {:>8} {:>12}  {}".format('service', 'seconds', 'SSD KB', 'output'))
+    for result in results:
+        if result['error']:
+            logging.error("{:<30} {:>8.2f} {:>12}  {}".format(
+                result['service_id'], result['seconds'], '-', result['error']))
+        else:
+            logging.info("{:<30} {:>8.2f} {:>12.1f}  {}{}".format(
+                result['service_id'], result['seconds'], result['ssd_size'] / 1024.0, result['output'],
+                ' (up to date)' if result['skipped'] else ''))
+    failed = sum(1 for result in results if result['error'])
+    skipped = sum(1 for result in results if result['skipped'])
+    logging.info("Generated {} of {} services ({} up to date) in {:.2f}s".format(
+        len(results) - failed - skipped, len(results), skipped, time.perf_counter() - start))
+
+    if client:
+        services = [(result['service_id'], result['output']) for result in results if not result['error']]
+        if services and submit_services(client, services):
+            return 1
+    return 1 if failed else 0
+
+
 def main(argv):
     parser = argparse.ArgumentParser(
         description='Generate a vSphere Application YAML from a given set of YAML files')
-    parser.add_argument('service_id', help='the unique service identifier')
+    parser.add_argument('service_id', nargs='?', help='the unique service identifier')
     parser.add_argument('-c', '--crd-url', dest='crd_url',
                         help='URL to the YAML holding the operator\'s CRDs YAML. '
                              'Can be a local file or a http(s) resource.')
@@ -349,16 +1335,88 @@ def main(argv):
                         help='The format that will be used in the resulting supervisor service file.'
                             ' If the file is bigger than 500kb it gzip will be used regardless of this flag. '
                             'Default: %(default)s')
+    parser.add_argument('--gzip-level', dest='gzip_level', default=DEFAULT_GZIP_LEVEL,
+                        choices=[str(level) for level in range(1, 10)] + [GZIP_LEVEL_AUTO],
+                        help='gzip compression level, from 1 (fastest) to 9 (smallest), or auto to try '
+                             'levels {} within the gzip time and size budgets. Default: %(default)s'.format(
+                            ', '.join(str(level) for level in GZIP_AUTO_LEVELS)))
+    parser.add_argument('--gzip-time-budget', dest='gzip_time_budget', type=float,
+                        default=GZIP_AUTO_TIME_BUDGET_IN_SECONDS,
+                        help='seconds the auto gzip level may spend trying levels. Default: %(default)s')
+    parser.add_argument('--gzip-size-budget', dest='gzip_size_budget', type=float,
+                        help='size in KB under which the auto gzip level stops trying higher levels')
+    parser.add_argument('--json-body', dest='json_body', action='store_true',
+                        help='also generate the JSON body of the VC API request creating the service')
+    parser.add_argument('--digests', dest='digests', action='store_true',
+                        help='write the SHA-256 digest of every generated file to a .sha256 file '
+                             'next to them, in the format of sha256sum')
     parser.add_argument('--description', dest='description',
                         help='A human readable description of the supervisor service'
                              ' that will be visible in the vCenter UI. Overriden by ALPHA1_SERVICE, if specified.')
+    parser.add_argument('--cache-dir', dest='cache_dir', default=DEFAULT_CACHE_DIR,
+                        help='directory caching the YAML fetched over http(s), revalidated with the '
+                             'server on every run. Default: %(default)s')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='always download the YAML fetched over http(s)')
+    parser.add_argument('-b', '--batch', dest='batch',
+                        help='generate all the services listed in the given batch manifest YAML file '
+                             'instead of a single one')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+                        help='number of services generated in parallel in batch mode. '
+                             'Default: the number of CPUs')
+    parser.add_argument('--submit', dest='submit', metavar='VC',
+                        help='also create the generated services in the given vCenter, a host or https URL, '
+                             'through its REST API, posting the --json-body generated with them. The password '
+                             'is read from VC_PASSWORD or prompted')
+    parser.add_argument('--vc-user', dest='vc_user', default=os.environ.get('VC_USER'),
+                        help='the vCenter username to submit with. Default: VC_USER')
+    parser.add_argument('--insecure', dest='insecure', action='store_true',
+                        help='do not verify the certificate of the vCenter submitted to')
+    parser.add_argument('--submit-jobs', dest='submit_jobs', type=int, default=SUBMIT_WORKERS,
+                        help='number of services submitted to vCenter at the same time. Default: %(default)s')
+    parser.add_argument('--no-validate', dest='validate', action='store_false',
+                        help='do not validate the CRD and operator YAML before generating the service')
+    parser.add_argument('-f', '--force', dest='force', action='store_true',
+                        help='generate the service even if the build cache manifest next to the output '
+                             'says its inputs and options did not change since the last run')
     parser.add_argument('-d', '--debug', dest='debug', action='store_true',
                         help='enable debug mode')
     args = parser.parse_args(argv)
+    if not args.service_id and not args.batch:
+        parser.error('a service_id or a --batch manifest is required')
+    if args.batch:
+        # The options of a single service are set for each service in the manifest
+        single_service_options = [
+            ('service_id', 'service_id'), ('crd_url', '--crd-url'), ('operator_url', '--operator-url'),
+            ('eula', '--eula'), ('version', '--version'), ('output', '--output'), ('update', '--update'),
+            ('psp', '--persistentservice'), ('alpha1_service', '-s'), ('display_name', '--display-name'),
+            ('fmt', '--format'), ('gzip_level', '--gzip-level'), ('gzip_time_budget', '--gzip-time-budget'),
+            ('gzip_size_budget', '--gzip-size-budget'), ('json_body', '--json-body'), ('digests', '--digests'),
+            ('description', '--description')]
+        given = [option for (dest, option) in single_service_options
+                 if getattr(args, dest) != parser.get_default(dest)]
+        if given:
+            parser.error('{} can not be used with --batch, set them in the batch manifest instead'.format(
+                ', '.join(given)))
+    if args.submit and not (args.output or args.batch):
+        parser.error('--submit needs the service to be generated in an --output file')
+    if args.submit and not args.vc_user:
+        parser.error('--submit needs a --vc-user')
 
     logging.basicConfig(format='[%(levelname)s] %(message)s',
                         level='DEBUG' if args.debug else 'INFO')
 
+    fetcher = YamlFetcher(cache_dir=None if args.no_cache else args.cache_dir)
+    client = None
+    if args.submit:
+        password = os.environ.get('VC_PASSWORD') or getpass.getpass(
+            "Password of {} on {}: ".format(args.vc_user, args.submit))
+        client = SupervisorServiceClient(args.submit, args.vc_user, password, verify=not args.insecure,
+                                         max_workers=args.submit_jobs)
+    if args.batch:
+        return generate_batch(args.batch, args.jobs, fetcher, args.debug, args.force, client,
+                              args.validate)
+
     eula = None
     version = None
     description = None
@@ -376,10 +1434,15 @@ def main(argv):
     version = args.version if args.version else version
     display_name = args.display_name if display_name is None else display_name
     description = args.description if description is None else description
-    generate_vsphere_app(args.service_id, version, args.crd_url, args.operator_url,
-                         args.output, args.update, args.psp, args.fmt, eula, display_name, description)
+    status = generate_vsphere_app(args.service_id, version, args.crd_url, args.operator_url,
+                                  args.output, args.update, args.psp, args.fmt, eula, display_name, description,
+                                  fetcher, args.gzip_level, args.gzip_time_budget, args.gzip_size_budget,
+                                  args.json_body or client is not None, args.digests, args.force, args.validate)
+    if status or not client:
+        return status
+    return submit_services(client, [(args.service_id, args.output)])
 
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,715 @@
+import base64
+import gzip
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import string
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# create-vsphere-app.py is not a valid module name
+spec = importlib.util.spec_from_file_location(
+    "create_vsphere_app", os.path.join(os.path.dirname(os.path.abspath(__file__)), "create-vsphere-app.py"))
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+OPERATOR_YAML = """\
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: sample-operator
+spec:
+  template:
+    spec:
+      containers:
+      - name: manager
+        image: registry.local/sample-operator:v1
+"""
+
+
+CRD_YAML = """\
+apiVersion: apiextensions.k8s.io/v1
+kind: CustomResourceDefinition
+metadata:
+  name: samples.example.com
+spec:
+  group: example.com
+  names:
+    kind: Sample
+    plural: samples
+  scope: Namespaced
+"""
+
+class YamlHandler(BaseHTTPRequestHandler):
+    """
+    Serves the YAML files of server.files with an ETag, answering 304 to a matching If-None-Match
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        etag = '"{}"'.format(hashlib.sha256(content.encode("utf-8")).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        body = content.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def yaml_server():
+    """
+    Starts an HTTP server standing in for the hosts of the CRD and operator YAML
+
+    Yields the server, whose files maps paths to the YAML served
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), YamlHandler)
+    server.files = {"/operator.yaml": OPERATOR_YAML}
+    server.requests = []
+    server.not_modified = 0
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def server_url(server, path):
+    return "http://{}:{}{}".format(server.server_address[0], server.server_address[1], path)
+
+
+def test_fetcher_caches_and_revalidates(yaml_server, tmp_path):
+    """
+    Tests that the first fetch stores the YAML in the cache, and that later fetches are
+    revalidated and read back from the cache on 304
+    """
+    url = server_url(yaml_server, "/operator.yaml")
+    fetcher = app.YamlFetcher(cache_dir=str(tmp_path))
+
+    assert fetcher.fetch(url) == OPERATOR_YAML
+    assert yaml_server.not_modified == 0
+    assert len(list((tmp_path / "objects").glob("*/*"))) == 1
+
+    for _ in range(2):
+        assert app.YamlFetcher(cache_dir=str(tmp_path)).fetch(url) == OPERATOR_YAML
+    assert yaml_server.not_modified == 2
+    assert len(yaml_server.requests) == 3
+
+
+def test_fetcher_falls_back_to_the_cache_when_the_network_is_down(yaml_server, tmp_path):
+    url = server_url(yaml_server, "/operator.yaml")
+    assert app.YamlFetcher(cache_dir=str(tmp_path)).fetch(url) == OPERATOR_YAML
+
+    yaml_server.shutdown()
+    yaml_server.server_close()
+    assert app.YamlFetcher(cache_dir=str(tmp_path), retries=0).fetch(url) == OPERATOR_YAML
+    with pytest.raises(app.requests.RequestException):
+        app.YamlFetcher(retries=0).fetch(url)
+
+
+def test_fetcher_rejects_a_corrupted_cache_entry(yaml_server, tmp_path):
+    url = server_url(yaml_server, "/operator.yaml")
+    assert app.YamlFetcher(cache_dir=str(tmp_path)).fetch(url) == OPERATOR_YAML
+
+    (cached_object,) = (tmp_path / "objects").glob("*/*")
+    cached_object.write_text(OPERATOR_YAML.replace("v1", "v2"))
+    with pytest.raises(IOError):
+        app.YamlFetcher(cache_dir=str(tmp_path)).fetch(url)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["-u"],
+        ["--format", "gzip"],
+        ["--gzip-level", "auto"],
+        ["--json-body", "--digests"],
+        ["-o", "out.yaml"],
+        ["--description", "ignored"],
+        ["sample"],
+    ]
+)
+def test_batch_rejects_single_service_options(options, tmp_path, capsys):
+    """
+    Tests that the options of a single service are not silently ignored in batch mode
+    """
+    manifest = tmp_path / "batch.yaml"
+    manifest.write_text("services: []\n")
+    with pytest.raises(SystemExit) as e:
+        app.main(["--batch", str(manifest)] + options)
+    assert e.value.code == 2
+    assert "can not be used with --batch" in capsys.readouterr().err
+
+
+NAMESPACE_TEMPLATE = "{{ .service.namespace }}"
+
+MIXED_OPERATOR_YAML = """\
+apiVersion: v1
+kind: ServiceAccount
+metadata:
+  name: sample-operator
+---
+---
+- not
+- a resource
+---
+apiVersion: rbac.authorization.k8s.io/v1
+kind: ClusterRole
+metadata:
+  name: sample-operator
+rules: []
+---
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: sample-operator
+  namespace: elsewhere
+---
+apiVersion: v1
+kind: Service
+metadata:
+  name: sample-operator
+"""
+
+
+def test_update_yaml():
+    """
+    Tests that namespaced resources get the service namespace in their original order, that
+    cluster-scoped resources and explicit namespaces are kept, and that documents which are
+    not resources are dropped
+    """
+    updated = list(app.yaml.safe_load_all(app.update_yaml(MIXED_OPERATOR_YAML)))
+
+    assert [(obj["kind"], obj["metadata"].get("namespace")) for obj in updated] == [
+        ("ServiceAccount", NAMESPACE_TEMPLATE),
+        ("ClusterRole", None),
+        ("Deployment", "elsewhere"),
+        ("Service", NAMESPACE_TEMPLATE),
+    ]
+    assert updated[1]["rules"] == []
+
+
+def test_update_yaml_matches_a_dump_of_all_documents():
+    """
+    Tests that streaming the documents gives the YAML of dumping them all at once
+    """
+    expected = list(app.yaml.safe_load_all(OPERATOR_YAML + "---\n" + OPERATOR_YAML))
+    for obj in expected:
+        obj["metadata"]["namespace"] = NAMESPACE_TEMPLATE
+
+    assert app.update_yaml(OPERATOR_YAML + "---\n" + OPERATOR_YAML) == app.yaml.safe_dump_all(expected)
+
+
+@pytest.mark.parametrize("content", ["", "---\n---\n", "just a string\n"])
+def test_update_yaml_without_resources(content):
+    assert app.update_yaml(content) == ""
+
+
+def test_update_yaml_returns_the_original_content_on_error():
+    content = OPERATOR_YAML + "---\nmetadata: [unclosed\n"
+    assert app.update_yaml(content) == content
+
+
+def test_generate_fails_on_missing_input(yaml_server, tmp_path):
+    """
+    Tests that an input the server does not have fails the generation instead of raising
+    """
+    output = tmp_path / "sample.yaml"
+    status = app.generate_vsphere_app("sample", None, None, server_url(yaml_server, "/missing.yaml"),
+                                      str(output), False, False, app.FORMAT_PLAIN)
+    assert status == 1
+    assert not output.exists()
+
+
+def random_yaml(size, seed=0):
+    """
+    YAML of size characters that compresses differently at every gzip level
+    """
+    rng = random.Random(seed)
+    words = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9))) for _ in range(2000)]
+    lines = []
+    length = 0
+    while length < size:
+        (name, org, repo, arg) = rng.sample(words, 4)
+        lines.append("- name: {}-{}\n  image: registry.local/{}/{}:v{}.{}\n  args: [--{}={}]\n".format(
+            name, len(lines), org, repo, rng.randint(0, 9), rng.randint(0, 99), arg, rng.randint(0, 10 ** 6)))
+        length += len(lines[-1])
+    return "".join(lines)[:size]
+
+
+def gunzip(raw_content):
+    return gzip.decompress(base64.b64decode(raw_content, validate=True)).decode("utf-8")
+
+
+@pytest.mark.parametrize("delta", [-1, 0, 1, app.GZIP_CHUNK_SIZE + 1])
+def test_content_gzip_around_the_chunk_size(delta):
+    content = ("é" + OPERATOR_YAML) * (app.GZIP_CHUNK_SIZE // len(OPERATOR_YAML) + 1)
+    content = content[:app.GZIP_CHUNK_SIZE + delta]
+    assert gunzip(app.content_gzip(content)) == content
+
+
+@pytest.mark.parametrize("chunk_size", [1000, 1001, 1002, 4097])
+@pytest.mark.parametrize("content", [random_yaml(200000), "ünïcødé ✓ " * 20000])
+def test_content_gzip_carries_partial_base64_groups(monkeypatch, chunk_size, content):
+    """
+    Tests that encoding chunk by chunk gives the base64 of compressing the whole content at
+    once, whatever the length of the compressed data each chunk produces
+    """
+    monkeypatch.setattr(app, "GZIP_CHUNK_SIZE", chunk_size)
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    expected = compressor.compress(content.encode("utf-8")) + compressor.flush()
+
+    raw_content = app.content_gzip(content)
+    assert raw_content == base64.b64encode(expected).decode("ascii")
+    assert gunzip(raw_content) == content
+
+
+@pytest.mark.parametrize("content", ["", "plain ascii", "ünïcødé ✓", "🙂" * (app.GZIP_CHUNK_SIZE + 3)])
+def test_utf8_size(content):
+    assert app.utf8_size(content) == len(content.encode("utf-8"))
+
+
+@pytest.mark.parametrize(
+    "content, expected_format",
+    [
+        ("a" * (app.YAML_MAX_PLAIN_SIZE_IN_KB * 1000 - 1), app.FORMAT_PLAIN),
+        ("a" * (app.YAML_MAX_PLAIN_SIZE_IN_KB * 1000), app.FORMAT_GZIP),
+        # Fewer characters than the limit, but as many bytes once encoded
+        ("é" * (app.YAML_MAX_PLAIN_SIZE_IN_KB * 500), app.FORMAT_GZIP),
+    ]
+)
+def test_dump_yaml_gzips_from_the_plain_size_limit(content, expected_format):
+    (fmt, dumped) = app.dump_yaml(content, app.FORMAT_PLAIN)
+    assert fmt == expected_format
+    assert (dumped if fmt == app.FORMAT_PLAIN else gunzip(dumped)) == content
+
+
+def test_auto_content_gzip_picks_the_first_level_within_the_size_budget():
+    """
+    Tests that auto picks the fastest level whose output fits in the size budget, and the
+    smallest output when none does
+    """
+    content = random_yaml(app.YAML_MAX_PLAIN_SIZE_IN_KB * 1000)
+    sizes = {level: len(app.content_gzip(content, level)) / 1000 for level in app.GZIP_AUTO_LEVELS}
+    assert sizes[1] > sizes[6] > sizes[9]
+
+    for (size_budget, expected_level) in [(None, 9), (sizes[1], 1), (sizes[6], 6), ((sizes[6] + sizes[1]) / 2, 6),
+                                          (sizes[9], 9), (sizes[9] / 2, 9)]:
+        (level, raw_content) = app.auto_content_gzip(content, time_budget=60, size_budget=size_budget)
+        assert level == expected_level
+        assert raw_content == app.content_gzip(content, expected_level)
+    assert app.auto_content_gzip(content, time_budget=0, size_budget=sizes[9])[0] == 1
+
+    (fmt, raw_content) = app.dump_yaml(content, app.FORMAT_PLAIN, app.GZIP_LEVEL_AUTO, 60, sizes[6])
+    assert fmt == app.FORMAT_GZIP
+    assert gunzip(raw_content) == content
+    assert len(raw_content) / 1000 == sizes[6]
+
+
+def generate_sample(output, operator, update=False, **kwargs):
+    return app.generate_vsphere_app("sample", "1.0.0", None, str(operator), str(output), update, False,
+                                    app.FORMAT_PLAIN, **kwargs)
+
+
+# The commands as they were formatted in memory before the SSD was streamed into them
+DCLI_COMMAND = "dcli +show-unreleased com vmware vcenter namespacemanagement supervisorservices create " \
+               "--vsphere-spec-version-spec-content=\"{}\" --vsphere-spec-version-spec-accept-eula={}"
+
+GOVC_SCRIPT = """#!/bin/bash
+set -x
+
+# First argument of this script is the VC IP
+VC_IP=$1
+if [ -z "${{VC_IP}}" ]; then
+   echo "Please provide your vCenter IP: $0 <VC IP> <VC username> <VC password>"
+   exit 1
+fi
+# Second argument of this script is the VC username
+VC_USER=$2
+if [ -z "${{VC_USER}}" ]; then
+   echo "Please provide your vCenter username: $0 <VC IP> <VC username> <VC password>"
+   exit 1
+fi
+# Third argument of this script is the VC password
+VC_PASSWORD=$3
+if [ -z "${{VC_PASSWORD}}" ]; then
+   echo "Please provide your vCenter password: $0 <VC IP> <VC username> <VC password>"
+   exit 1
+fi
+
+GOVC_URL="$VC_USER:$VC_PASSWORD@$VC_IP"
+
+govc session.login -u ${{GOVC_URL}} -k -r -X POST /api/vcenter/namespace-management/supervisor-services <<< \
+'{{\"vsphere_spec\": {{ \"version_spec\" : {{ \"content\" : \"{}\", \"accept_EULA\" : {}, \"trusted_provider\": false }}}}}}'
+"""
+
+
+@pytest.mark.parametrize("eula, accept_eula", [(None, "false"), ("Sample EULA ✓", "true")])
+def test_generated_artifacts(tmp_path, eula, accept_eula):
+    """
+    Tests that the streamed commands match their in-memory rendering, that the JSON body
+    matches the govc request, and that the digests match the files they name
+    """
+    operator = tmp_path / "operator.yaml"
+    operator.write_text(OPERATOR_YAML)
+    output = tmp_path / "sample.yaml"
+    assert generate_sample(output, operator, eula=eula, json_body=True, digests=True) is None
+
+    content = base64.b64encode(output.read_bytes()).decode("utf-8")
+    assert (tmp_path / "sample-dcli.sh").read_text() == DCLI_COMMAND.format(content, accept_eula)
+    assert (tmp_path / "sample-govc.sh").read_text() == GOVC_SCRIPT.format(content, accept_eula)
+    assert json.loads((tmp_path / "sample-body.json").read_text()) == {"vsphere_spec": {"version_spec": {
+        "content": content, "accept_EULA": accept_eula == "true", "trusted_provider": False}}}
+
+    lines = (tmp_path / "sample.sha256").read_text().splitlines()
+    assert [line.split("  ")[1] for line in lines] == [
+        "sample.yaml", "sample-dcli.sh", "sample-govc.sh", "sample-body.json"]
+    for line in lines:
+        (digest, name) = line.split("  ")
+        assert hashlib.sha256((tmp_path / name).read_bytes()).hexdigest() == digest
+
+
+def test_generated_artifacts_on_stdout(tmp_path, capsysbinary):
+    """
+    Tests that without an output file, the SSD and commands are printed as before
+    """
+    operator = tmp_path / "operator.yaml"
+    operator.write_text(OPERATOR_YAML)
+    output = tmp_path / "sample.yaml"
+    assert generate_sample(output, operator) is None
+    capsysbinary.readouterr()
+    ssd = output.read_text()
+
+    assert generate_sample("", operator) is None
+    content = base64.b64encode(ssd.encode("utf-8")).decode("utf-8")
+    assert capsysbinary.readouterr().out.decode("utf-8") == "{}\n{}\n{}\n".format(
+        ssd, DCLI_COMMAND.format(content, "false"), GOVC_SCRIPT.format(content, "false"))
+
+
+def test_build_cache_skips_unchanged_services(tmp_path):
+    """
+    Tests that a service is skipped while its inputs, options and artifacts are unchanged,
+    and generated again otherwise or when forced
+    """
+    operator = tmp_path / "operator.yaml"
+    operator.write_text(OPERATOR_YAML)
+    output = tmp_path / "sample.yaml"
+
+    assert generate_sample(output, operator) is None
+    assert (tmp_path / "sample.build.json").exists()
+    assert generate_sample(output, operator) == 0
+    assert generate_sample(output, operator, force=True) is None
+    # Other options or inputs, and artifacts changed since, are built again
+    assert generate_sample(output, operator, json_body=True) is None
+    assert generate_sample(output, operator, json_body=True) == 0
+    assert generate_sample(output, operator, json_body=True, validate=False) is None
+    assert generate_sample(output, operator, json_body=True) is None
+    operator.write_text(OPERATOR_YAML.replace("v1", "v2"))
+    assert generate_sample(output, operator, json_body=True) is None
+    with open(str(tmp_path / "sample-dcli.sh"), "a") as f:
+        f.write("# edited\n")
+    assert generate_sample(output, operator, json_body=True) is None
+    (tmp_path / "sample-body.json").unlink()
+    assert generate_sample(output, operator, json_body=True) is None
+    assert generate_sample(output, operator, json_body=True) == 0
+
+
+class VcenterHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for the session and supervisor services endpoints of the vCenter REST API
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_DELETE(self):
+        self.reply(204)
+
+    def do_POST(self):
+        vcenter = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == app.VC_SESSION_PATH:
+            if self.headers.get("Authorization") != "Basic " + base64.b64encode(b"admin:secret").decode():
+                self.reply(401)
+                return
+            with vcenter.lock:
+                vcenter.logins += 1
+                token = "token-{}".format(vcenter.logins)
+                vcenter.tokens.add(token)
+            self.reply(201, json.dumps(token).encode())
+            return
+
+        if self.headers.get("vmware-api-session-id") not in vcenter.tokens:
+            self.reply(401)
+            return
+        with vcenter.lock:
+            vcenter.posts += 1
+            if vcenter.unavailable:
+                vcenter.unavailable -= 1
+                self.reply(503)
+                return
+            vcenter.in_flight += 1
+            vcenter.max_in_flight = max(vcenter.max_in_flight, vcenter.in_flight)
+        time.sleep(vcenter.delay)
+        content = json.loads(body)["vsphere_spec"]["version_spec"]["content"]
+        service_id = app.yaml.safe_load(base64.b64decode(content))["spec"]["serviceID"]
+        with vcenter.lock:
+            vcenter.in_flight -= 1
+            if service_id in vcenter.created:
+                self.reply(400, json.dumps({"messages": [
+                    {"default_message": "Supervisor service {} already exists".format(service_id)}]}).encode())
+                return
+            vcenter.created.append(service_id)
+            if len(vcenter.created) == vcenter.expire_after:
+                vcenter.tokens.clear()
+            if vcenter.gateway_timeouts:
+                # The gateway gave up waiting, after vCenter created the service
+                vcenter.gateway_timeouts -= 1
+                self.reply(504)
+                return
+        self.reply(204)
+
+
+@pytest.fixture
+def vcenter():
+    """
+    Starts an HTTP server standing in for vCenter, configured through its attributes
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), VcenterHandler)
+    server.lock = threading.Lock()
+    server.logins = 0
+    server.tokens = set()
+    server.posts = 0
+    server.unavailable = 0
+    server.gateway_timeouts = 0
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.delay = 0
+    server.created = []
+    server.expire_after = None
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def generated_services(tmp_path, count):
+    operator = tmp_path / "operator.yaml"
+    operator.write_text(OPERATOR_YAML)
+    services = []
+    for i in range(count):
+        service_id = "sample-{}".format(i)
+        output = tmp_path / "{}.yaml".format(service_id)
+        assert app.generate_vsphere_app(service_id, "1.0.0", None, str(operator), str(output), False, False,
+                                        app.FORMAT_PLAIN, json_body=True) is None
+        services.append((service_id, str(output)))
+    return services
+
+
+def test_submit_services_shares_one_session(vcenter, tmp_path):
+    """
+    Tests that services are submitted through one login, with retries on 503, a new login
+    once the session expired, and at most max_workers submissions at a time
+    """
+    services = generated_services(tmp_path, 6)
+    vcenter.unavailable = 1
+    vcenter.expire_after = 2
+    vcenter.delay = 0.1
+    client = app.SupervisorServiceClient(server_url(vcenter, ""), "admin", "secret", max_workers=2)
+
+    assert app.submit_services(client, services) == 0
+    assert sorted(vcenter.created) == [service_id for (service_id, _) in services]
+    assert vcenter.logins == 2
+    assert vcenter.max_in_flight == 2
+    # 6 services, the 503 retried and the requests rejected once the session expired
+    assert 7 <= vcenter.posts <= 8
+
+
+def test_submit_services_reports_failures(vcenter, tmp_path):
+    services = generated_services(tmp_path, 1)
+    client = app.SupervisorServiceClient(server_url(vcenter, ""), "admin", "wrong")
+    assert app.submit_services(client, services) == 1
+    assert vcenter.created == []
+
+    vcenter.unavailable = 10
+    client = app.SupervisorServiceClient(server_url(vcenter, ""), "admin", "secret", retries=1)
+    assert app.submit_services(client, services) == 1
+    assert vcenter.created == []
+
+
+def test_submit_posts_the_generated_json_body(vcenter, tmp_path, monkeypatch):
+    """
+    Tests that --submit generates the JSON body along with the service and posts it as is
+    """
+    operator = tmp_path / "operator.yaml"
+    operator.write_text(OPERATOR_YAML)
+    output = tmp_path / "sample.yaml"
+    monkeypatch.setenv("VC_PASSWORD", "secret")
+    assert app.main(["sample", "-p", str(operator), "-o", str(output), "--submit", server_url(vcenter, ""),
+                     "--vc-user", "admin"]) == 0
+    assert vcenter.created == ["sample"]
+    assert app.submission_body(str(output)) == (tmp_path / "sample-body.json").read_bytes()
+
+
+def test_create_service_does_not_retry_read_errors(vcenter, tmp_path):
+    """
+    Tests that a service whose response is lost is not created again
+    """
+    (service_id, ssd_file) = generated_services(tmp_path, 1)[0]
+    vcenter.delay = 1
+    with app.SupervisorServiceClient(server_url(vcenter, ""), "admin", "secret", timeout=0.3) as client:
+        result = client.submit(service_id, ssd_file)
+    assert "Timeout" in result["error"] or "timed out" in result["error"]
+    time.sleep(1)
+    assert vcenter.posts == 1
+
+
+def test_create_service_does_not_retry_gateway_timeouts(vcenter, tmp_path):
+    """
+    Tests that a service is not posted again after a 504, which the gateway may answer
+    once vCenter created the service, so the failure is not reported as a duplicate
+    """
+    services = generated_services(tmp_path, 1)
+    vcenter.gateway_timeouts = 1
+    client = app.SupervisorServiceClient(server_url(vcenter, ""), "admin", "secret")
+    with client:
+        result = client.submit(*services[0])
+    assert result["error"].startswith("504")
+    assert vcenter.posts == 1
+    assert vcenter.created == ["sample-0"]
+
+    with client:
+        result = client.submit(*services[0])
+    assert "already exists" in result["error"]
+
+
+TEMPLATED_OPERATOR_YAML = """\
+apiVersion: rbac.authorization.k8s.io/v1
+kind: Role
+metadata:
+  name: {{ .service.prefix }}-leader-election-role
+  namespace: {{ .service.namespace }}
+"""
+
+
+@pytest.mark.parametrize(
+    "content, spec_entry, update, expected_errors, expected_warnings",
+    [
+        (OPERATOR_YAML, "operatorYaml", True, [], []),
+        ("---\n" + OPERATOR_YAML + "---\n", "operatorYaml", False, [], []),
+        ("apiVersion: v1\nkind: ConfigMap\nmetadata: {}\n", "operatorYaml", False,
+         ["document 1: missing metadata.name"], []),
+        ("kind: ConfigMap\nmetadata:\n  name: a\n", "operatorYaml", False,
+         ["document 1 (ConfigMap/a): missing apiVersion"], []),
+        ("- a\n", "operatorYaml", False, ["document 1: not a mapping"], []),
+        ("apiVersion: v1\nkind: [\n", "operatorYaml", False,
+         ["YAML: invalid YAML, did not find expected node content: line 3, column 1"], []),
+        (TEMPLATED_OPERATOR_YAML, "operatorYaml", False, [],
+         ["YAML: {{ }} templating makes it invalid YAML: line 4, column 30"]),
+        (TEMPLATED_OPERATOR_YAML, "operatorYaml", True,
+         ["YAML: {{ }} templating makes it invalid YAML, update_yaml can not add the service namespace: "
+          "line 4, column 30"], []),
+        ("apiVersion: storage.k8s.io/v1\nkind: StorageClass\nmetadata:\n  name: a\n  namespace: b\n",
+         "operatorYaml", False, [], ["document 1 (StorageClass/a): cluster-scoped StorageClass has a namespace"]),
+        ("apiVersion: scheduling.k8s.io/v1\nkind: PriorityClass\nmetadata:\n  name: a\n", "operatorYaml", True,
+         [], ["document 1 (PriorityClass/a): update_yaml sets a namespace on cluster-scoped PriorityClass"]),
+        ("apiVersion: scheduling.k8s.io/v1\nkind: PriorityClass\nmetadata:\n  name: a\n", "operatorYaml", False,
+         [], []),
+        (OPERATOR_YAML, "crdYaml", False, [], ["document 1 (Deployment/sample-operator): Deployment in the CRD YAML"]),
+    ]
+)
+def test_validate_yaml(content, spec_entry, update, expected_errors, expected_warnings):
+    result = app.validate_yaml(content, spec_entry, update)
+    assert result.errors == ["{} {}".format(spec_entry, error) for error in expected_errors]
+    assert result.warnings == ["{} {}".format(spec_entry, warning) for warning in expected_warnings]
+    if update:
+        (updated_result, _) = app.validate_and_update_yaml(content)
+        assert (updated_result.errors, updated_result.warnings) == (result.errors, result.warnings)
+
+
+def test_generate_parses_the_operator_yaml_once(tmp_path, monkeypatch):
+    """
+    Tests that the operator YAML is validated and updated in the same pass
+    """
+    load_all = app.yaml.load_all
+    loads = []
+
+    def counting_load_all(stream, Loader):
+        loads.append(stream)
+        return load_all(stream, Loader=Loader)
+
+    monkeypatch.setattr(app.yaml, "load_all", counting_load_all)
+    operator = tmp_path / "operator.yaml"
+    operator.write_text(OPERATOR_YAML)
+    output = tmp_path / "sample.yaml"
+    assert generate_sample(output, operator, update=True) is None
+    assert loads == [OPERATOR_YAML]
+
+    ssd = app.yaml.safe_load(output.read_text())
+    assert "namespace: '{{ .service.namespace }}'" in ssd["spec"]["operatorYaml"]["content"]
+
+
+def test_validation_is_cached_across_services(tmp_path, monkeypatch):
+    """
+    Tests that services sharing a CRD, as the services a batch worker generates do, only
+    parse it once
+    """
+    load_all = app.yaml.load_all
+    loads = []
+
+    def counting_load_all(stream, Loader):
+        loads.append(stream)
+        return load_all(stream, Loader=Loader)
+
+    monkeypatch.setattr(app.yaml, "load_all", counting_load_all)
+    monkeypatch.setattr(app, "_validation_cache", {})
+    crd = tmp_path / "crd.yaml"
+    crd.write_text(CRD_YAML)
+    operator = tmp_path / "operator.yaml"
+    operator.write_text(OPERATOR_YAML)
+    for service_id in ("first", "second"):
+        assert app.generate_vsphere_app(service_id, "1.0.0", str(crd), str(operator),
+                                        str(tmp_path / "{}.yaml".format(service_id)), True, False,
+                                        app.FORMAT_PLAIN) is None
+    assert loads == [CRD_YAML, OPERATOR_YAML, OPERATOR_YAML]
+
+
+def test_generate_fails_on_invalid_yaml(tmp_path):
+    operator = tmp_path / "operator.yaml"
+    output = tmp_path / "sample.yaml"
+    operator.write_text(TEMPLATED_OPERATOR_YAML)
+    assert generate_sample(output, operator) is None
+    output.unlink()
+    assert generate_sample(output, operator, update=True) == 1
+    assert not output.exists()
+    assert generate_sample(output, operator, update=True, validate=False) is None